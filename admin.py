@@ -2,13 +2,26 @@ from flask import Blueprint, render_template, request, redirect, url_for, flash,
 from werkzeug.utils import secure_filename
 from datetime import datetime, timedelta
 from sqlalchemy import func
+from sqlalchemy.orm import defer, with_expression
 import logging
 import os
 import mimetypes
+import search_index
+import pagination
+import ingestion_jobs
 
 admin_bp = Blueprint('admin', __name__)
 logger = logging.getLogger(__name__)
 
+# Characters of long text columns loaded for list rows; the rest is fetched on demand
+PREVIEW_LENGTH = 300
+# Largest document accepted by the upload form
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+
+def _preview(column, length=PREVIEW_LENGTH):
+    """SQL expression with the first `length` characters of a text column (one more to detect truncation)"""
+    return func.substr(column, 1, length + 1)
+
 def admin_required(f):
     """Decorator to require admin authentication"""
     from functools import wraps
@@ -25,11 +38,14 @@ def dashboard():
     """Admin dashboard with statistics"""
     try:
         # Import here to avoid circular imports
-        from models import UserQuery, FAQ, Category, Document, WebSource, KnowledgeBase
+        from models import UserQuery, QueryRollup, FAQ, Category, Document, WebSource, KnowledgeBase
         from app import db
         
-        # Get basic statistics
-        total_queries = UserQuery.query.count()
+        # Get basic statistics (query counts come from the daily rollups)
+        # Queries logged before the rollups existed are aggregated once by the ingestion worker
+        rollups_job = ingestion_jobs.enqueue_rollups_backfill(session['admin_id'])
+        daily_rollups = QueryRollup.query.filter(QueryRollup.period == 'day')
+        total_queries = daily_rollups.with_entities(func.sum(QueryRollup.query_count)).scalar() or 0
         total_faqs = FAQ.query.filter_by(is_active=True).count()
         total_categories = Category.query.count()
         
@@ -44,18 +60,21 @@ def dashboard():
         # Get queries from last 7 days for chart
         week_ago = datetime.utcnow() - timedelta(days=7)
         daily_stats = db.session.query(
-            func.date(UserQuery.created_at).label('date'),
-            func.count(UserQuery.id).label('count')
+            QueryRollup.bucket_start.label('date'),
+            func.sum(QueryRollup.query_count).label('count')
         ).filter(
-            UserQuery.created_at >= week_ago
+            QueryRollup.period == 'day',
+            QueryRollup.bucket_start >= week_ago.replace(hour=0, minute=0, second=0, microsecond=0)
         ).group_by(
-            func.date(UserQuery.created_at)
+            QueryRollup.bucket_start
         ).all()
         
         # Calculate average response time
-        avg_response_time = db.session.query(
-            func.avg(UserQuery.response_time)
-        ).scalar() or 0
+        response_time_sum, response_time_count = daily_rollups.with_entities(
+            func.sum(QueryRollup.response_time_sum),
+            func.sum(QueryRollup.response_time_count)
+        ).one()
+        avg_response_time = (response_time_sum or 0) / response_time_count if response_time_count else 0
         
         return render_template('admin/dashboard.html',
                              total_queries=total_queries,
@@ -66,7 +85,8 @@ def dashboard():
                              total_kb_chunks=total_kb_chunks,
                              recent_queries=recent_queries,
                              daily_stats=daily_stats,
-                             avg_response_time=round(avg_response_time, 2))
+                             avg_response_time=round(avg_response_time, 2),
+                             rollups_pending=rollups_job is not None)
     except Exception as e:
         logger.error(f"Error in admin dashboard: {str(e)}")
         flash('Ошибка при загрузке панели управления', 'error')
@@ -181,6 +201,9 @@ def add_faq():
         
         db.session.add(faq)
         db.session.commit()
+        search_index.invalidate()
+        # Vector store is rebuilt by the ingestion worker, not in this request
+        ingestion_jobs.enqueue_embeddings_rebuild(session['admin_id'])
         flash('FAQ успешно добавлен', 'success')
         
     except Exception as e:
@@ -196,25 +219,44 @@ def queries():
     try:
         from models import UserQuery
         
-        page = request.args.get('page', 1, type=int)
         language = request.args.get('language')
         
-        query = UserQuery.query
+        # Only a preview of the response is read; large columns stay in the database
+        query = UserQuery.query.options(
+            defer(UserQuery.bot_response), defer(UserQuery.user_agent), defer(UserQuery.stage_timings),
+            with_expression(UserQuery.bot_response_preview, _preview(UserQuery.bot_response))
+        )
         if language:
             query = query.filter_by(language=language)
         
-        queries_list = query.order_by(UserQuery.created_at.desc()).paginate(
-            page=page, per_page=20, error_out=False
-        )
+        queries_list = pagination.paginate(query, UserQuery, per_page=20,
+                                           after=request.args.get('after'),
+                                           before=request.args.get('before'))
         
         return render_template('admin/queries.html', 
                              queries=queries_list,
-                             selected_language=language)
+                             selected_language=language,
+                             preview_length=PREVIEW_LENGTH)
     except Exception as e:
         logger.error(f"Error in queries page: {str(e)}")
         flash('Ошибка при загрузке запросов', 'error')
         return render_template('admin/queries.html', queries=None)
 
+@admin_bp.route('/api/queries/<int:query_id>')
+@admin_required
+def query_detail(query_id):
+    """Full text of one user query (loaded when a row is expanded)"""
+    from models import UserQuery
+    
+    query = UserQuery.query.get_or_404(query_id)
+    return jsonify({
+        'id': query.id,
+        'user_message': query.user_message,
+        'bot_response': query.bot_response,
+        'user_agent': query.user_agent,
+        'stage_timings': query.stage_timings
+    })
+
 @admin_bp.route('/login', methods=['GET', 'POST'])
 def login():
     """Admin login"""
@@ -248,11 +290,15 @@ def documents():
         from models import Document
         
         page = request.args.get('page', 1, type=int)
-        documents_list = Document.query.filter_by(is_active=True).order_by(
+        documents_list = Document.query.filter_by(is_active=True).options(
+            defer(Document.content_text),
+            with_expression(Document.content_preview, _preview(Document.content_text, 200))
+        ).order_by(
             Document.created_at.desc()
         ).paginate(page=page, per_page=10, error_out=False)
+        jobs = _latest_jobs('document', [document.id for document in documents_list.items])
         
-        return render_template('admin/documents.html', documents=documents_list)
+        return render_template('admin/documents.html', documents=documents_list, jobs=jobs)
     except Exception as e:
         logger.error(f"Error in documents page: {str(e)}")
         flash('Ошибка при загрузке документов', 'error')
@@ -266,54 +312,277 @@ def web_sources():
         from models import WebSource
         
         page = request.args.get('page', 1, type=int)
-        sources_list = WebSource.query.filter_by(is_active=True).order_by(
+        sources_list = WebSource.query.filter_by(is_active=True).options(
+            defer(WebSource.content_text),
+            with_expression(WebSource.content_preview, _preview(WebSource.content_text, 200))
+        ).order_by(
             WebSource.created_at.desc()
         ).paginate(page=page, per_page=10, error_out=False)
+        jobs = _latest_jobs('web', [source.id for source in sources_list.items])
         
-        return render_template('admin/web_sources.html', sources=sources_list)
+        return render_template('admin/web_sources.html', sources=sources_list, jobs=jobs)
     except Exception as e:
         logger.error(f"Error in web sources page: {str(e)}")
         flash('Ошибка при загрузке веб-источников', 'error')
         return render_template('admin/web_sources.html', sources=None)
 
+@admin_bp.route('/documents/upload', methods=['POST'])
+@admin_required
+def upload_document():
+    """Save an uploaded document and queue its ingestion"""
+    try:
+        from models import Document
+        from app import db
+        from document_processor import DocumentProcessor
+        
+        file = request.files.get('file')
+        if not file or not file.filename:
+            flash('Выберите файл для загрузки', 'error')
+            return redirect(url_for('admin.documents'))
+        
+        file_type = mimetypes.guess_type(file.filename)[0]
+        if file_type == 'application/msword':
+            # Legacy binary .doc has no text extractor
+            flash('Формат .doc не поддерживается: сохраните файл как .docx и загрузите снова', 'error')
+            return redirect(url_for('admin.documents'))
+        if file_type not in DocumentProcessor.SUPPORTED_TYPES:
+            flash('Неподдерживаемый формат файла', 'error')
+            return redirect(url_for('admin.documents'))
+        
+        file.stream.seek(0, os.SEEK_END)
+        if file.stream.tell() > MAX_UPLOAD_SIZE:
+            flash('Размер файла превышает 10 МБ', 'error')
+            return redirect(url_for('admin.documents'))
+        file.stream.seek(0)
+        
+        # secure_filename drops Cyrillic, the timestamp keeps stored names unique
+        name, extension = os.path.splitext(file.filename)
+        stored_name = (f"{datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}_"
+                       f"{secure_filename(name) or 'document'}{extension.lower()}")
+        file_path, file_size = DocumentProcessor().save_uploaded_file(file, stored_name)
+        
+        document = Document(
+            title=request.form.get('title', '').strip() or name,
+            filename=file.filename,
+            file_path=file_path,
+            file_type=file_type,
+            file_size=file_size,
+            uploaded_by=session['admin_id']
+        )
+        db.session.add(document)
+        db.session.commit()
+        
+        # Text extraction and chunking run in the ingestion worker, not in this request
+        ingestion_jobs.enqueue('document', document.id, session['admin_id'])
+        flash('Документ загружен и поставлен в очередь на обработку', 'success')
+    
+    except Exception as e:
+        logger.error(f"Error uploading document: {str(e)}")
+        flash('Ошибка при загрузке документа', 'error')
+    
+    return redirect(url_for('admin.documents'))
+
+@admin_bp.route('/documents/<int:doc_id>/delete', methods=['POST'])
+@admin_required
+def delete_document(doc_id):
+    """Deactivate a document and its knowledge base chunks"""
+    from models import Document
+    from app import db
+    
+    document = Document.query.get_or_404(doc_id)
+    try:
+        document.is_active = False
+        # Flushed first: a running ingestion job either sees the deletion or commits before it
+        db.session.flush()
+        _deactivate_source('document', doc_id)
+        db.session.commit()
+        search_index.invalidate()
+        ingestion_jobs.enqueue_embeddings_rebuild(session['admin_id'])
+        flash('Документ удален', 'success')
+    
+    except Exception as e:
+        logger.error(f"Error deleting document {doc_id}: {str(e)}")
+        flash('Ошибка при удалении документа', 'error')
+    
+    return redirect(url_for('admin.documents'))
+
+@admin_bp.route('/web-sources/add', methods=['POST'])
+@admin_required
+def add_web_source():
+    """Add a web source and queue its first scrape"""
+    try:
+        from models import WebSource
+        from app import db
+        from urllib.parse import urlparse
+        
+        title = request.form.get('title', '').strip()
+        url = request.form.get('url', '').strip()
+        frequency = request.form.get('frequency', 'manual')
+        
+        parsed_url = urlparse(url)
+        if not title or parsed_url.scheme not in ('http', 'https') or not parsed_url.netloc:
+            flash('Укажите название и корректный URL адрес', 'error')
+            return redirect(url_for('admin.web_sources'))
+        
+        source = WebSource(
+            title=title,
+            url=url,
+            scrape_frequency=frequency if frequency in ('manual', 'daily', 'weekly') else 'manual',
+            added_by=session['admin_id']
+        )
+        db.session.add(source)
+        db.session.commit()
+        
+        # The page is scraped by the ingestion worker, not in this request
+        ingestion_jobs.enqueue('web', source.id, session['admin_id'])
+        flash('Веб-источник добавлен и поставлен в очередь на загрузку', 'success')
+    
+    except Exception as e:
+        logger.error(f"Error adding web source: {str(e)}")
+        flash('Ошибка при добавлении веб-источника', 'error')
+    
+    return redirect(url_for('admin.web_sources'))
+
+@admin_bp.route('/web-sources/<int:source_id>/update', methods=['POST'])
+@admin_required
+def update_web_source(source_id):
+    """Queue a new scrape of a web source"""
+    from models import WebSource
+    
+    WebSource.query.get_or_404(source_id)
+    try:
+        ingestion_jobs.enqueue('web', source_id, session['admin_id'])
+        flash('Обновление веб-источника поставлено в очередь', 'success')
+    
+    except Exception as e:
+        logger.error(f"Error queueing update of web source {source_id}: {str(e)}")
+        flash('Ошибка при обновлении веб-источника', 'error')
+    
+    return redirect(url_for('admin.web_sources'))
+
+@admin_bp.route('/web-sources/<int:source_id>/delete', methods=['POST'])
+@admin_required
+def delete_web_source(source_id):
+    """Deactivate a web source and its knowledge base chunks"""
+    from models import WebSource
+    from app import db
+    
+    source = WebSource.query.get_or_404(source_id)
+    try:
+        source.is_active = False
+        # Flushed first: a running ingestion job either sees the deletion or commits before it
+        db.session.flush()
+        _deactivate_source('web', source_id)
+        db.session.commit()
+        search_index.invalidate()
+        ingestion_jobs.enqueue_embeddings_rebuild(session['admin_id'])
+        flash('Веб-источник удален', 'success')
+    
+    except Exception as e:
+        logger.error(f"Error deleting web source {source_id}: {str(e)}")
+        flash('Ошибка при удалении веб-источника', 'error')
+    
+    return redirect(url_for('admin.web_sources'))
+
+def _deactivate_source(source_type, source_id):
+    """Deactivate a deleted source's chunks and cancel its queued jobs (the caller commits)"""
+    from models import IngestionJob, KnowledgeBase
+    
+    KnowledgeBase.query.filter_by(source_type=source_type, source_id=source_id, is_active=True).update(
+        {'is_active': False}, synchronize_session=False)
+    IngestionJob.query.filter_by(job_type=source_type, source_id=source_id, status='queued').update(
+        {'status': 'failed', 'last_error': 'Source was deleted', 'finished_at': datetime.utcnow()},
+        synchronize_session=False)
+
+def _job_to_dict(job):
+    """Ingestion job as returned by the progress API"""
+    def timestamp(value):
+        return value.isoformat() if value else None
+    
+    return {
+        'id': job.id,
+        'job_type': job.job_type,
+        'source_id': job.source_id,
+        'status': job.status,
+        'attempts': job.attempts,
+        'max_attempts': job.max_attempts,
+        'progress_current': job.progress_current,
+        'progress_total': job.progress_total,
+        'last_error': job.last_error,
+        'run_after': timestamp(job.run_after),
+        'created_at': timestamp(job.created_at),
+        'started_at': timestamp(job.started_at),
+        'finished_at': timestamp(job.finished_at)
+    }
+
+def _latest_jobs(job_type, source_ids):
+    """Most recent ingestion job of each listed source, keyed by source id"""
+    from models import IngestionJob
+    from app import db
+    
+    if not source_ids:
+        return {}
+    latest_ids = db.session.query(func.max(IngestionJob.id)).filter(
+        IngestionJob.job_type == job_type, IngestionJob.source_id.in_(source_ids)
+    ).group_by(IngestionJob.source_id)
+    jobs = IngestionJob.query.filter(IngestionJob.id.in_(latest_ids.scalar_subquery())).all()
+    return {job.source_id: _job_to_dict(job) for job in jobs}
+
 @admin_bp.route('/knowledge-base')
 @admin_required
 def knowledge_base():
     """View knowledge base"""
     try:
         from models import KnowledgeBase
+        from app import db
         
-        page = request.args.get('page', 1, type=int)
         source_type = request.args.get('source_type', '')
         
-        query = KnowledgeBase.query.filter_by(is_active=True)
+        query = KnowledgeBase.query.filter_by(is_active=True).options(
+            defer(KnowledgeBase.content_chunk), defer(KnowledgeBase.search_tokens),
+            with_expression(KnowledgeBase.content_preview, _preview(KnowledgeBase.content_chunk))
+        )
         if source_type:
             query = query.filter_by(source_type=source_type)
         
-        kb_entries = query.order_by(KnowledgeBase.created_at.desc()).paginate(
-            page=page, per_page=20, error_out=False
-        )
+        kb_entries = pagination.paginate(query, KnowledgeBase, per_page=20,
+                                         after=request.args.get('after'),
+                                         before=request.args.get('before'))
         
         # Get statistics
-        total_chunks = KnowledgeBase.query.filter_by(is_active=True).count()
-        doc_chunks = KnowledgeBase.query.filter_by(is_active=True, source_type='document').count()
-        web_chunks = KnowledgeBase.query.filter_by(is_active=True, source_type='web').count()
+        chunk_counts = dict(db.session.query(
+            KnowledgeBase.source_type, func.count(KnowledgeBase.id)
+        ).filter_by(is_active=True).group_by(KnowledgeBase.source_type).all())
         
         stats = {
-            'total': total_chunks,
-            'documents': doc_chunks,
-            'web': web_chunks
+            'total': sum(chunk_counts.values()),
+            'documents': chunk_counts.get('document', 0),
+            'web': chunk_counts.get('web', 0)
         }
         
         return render_template('admin/knowledge_base.html', 
                              entries=kb_entries, 
                              stats=stats,
-                             selected_source_type=source_type)
+                             selected_source_type=source_type,
+                             preview_length=PREVIEW_LENGTH)
     except Exception as e:
         logger.error(f"Error in knowledge base page: {str(e)}")
         flash('Ошибка при загрузке базы знаний', 'error')
         return render_template('admin/knowledge_base.html', entries=None, stats={})
 
+@admin_bp.route('/api/knowledge-base/<int:entry_id>')
+@admin_required
+def knowledge_base_entry(entry_id):
+    """Full text of one knowledge base chunk (loaded when a row is expanded)"""
+    from models import KnowledgeBase
+    
+    entry = KnowledgeBase.query.get_or_404(entry_id)
+    return jsonify({
+        'id': entry.id,
+        'content_chunk': entry.content_chunk,
+        'extra_data': entry.extra_data
+    })
+
 @admin_bp.route('/logout')
 def logout():
     """Admin logout"""
@@ -322,50 +591,60 @@ def logout():
     return redirect(url_for('admin.login'))
 
 
+def _average(total, count):
+    """Mean from a rollup sum and count (0 when there is nothing to average)"""
+    return (total or 0) / count if count else 0
+
+
 @admin_bp.route('/api/analytics/agents')
 @admin_required
 def agent_analytics():
     """Get agent usage analytics"""
     try:
-        from models import UserQuery
+        from models import QueryRollup
         from app import db
         
+        # Daily rollups of queries answered by an agent ('' = no agent)
+        agent_rollups = (QueryRollup.period == 'day', QueryRollup.agent_type != '')
+        
         # Get agent usage statistics
         agent_stats = db.session.query(
-            UserQuery.agent_type,
-            UserQuery.agent_name,
-            func.count(UserQuery.id).label('total_queries'),
-            func.avg(UserQuery.response_time).label('avg_response_time'),
-            func.avg(UserQuery.agent_confidence).label('avg_confidence')
+            QueryRollup.agent_type,
+            QueryRollup.agent_name,
+            func.sum(QueryRollup.query_count).label('total_queries'),
+            func.sum(QueryRollup.response_time_sum).label('response_time_sum'),
+            func.sum(QueryRollup.response_time_count).label('response_time_count'),
+            func.sum(QueryRollup.confidence_sum).label('confidence_sum'),
+            func.sum(QueryRollup.confidence_count).label('confidence_count')
         ).filter(
-            UserQuery.agent_type.isnot(None)
+            *agent_rollups
         ).group_by(
-            UserQuery.agent_type, UserQuery.agent_name
+            QueryRollup.agent_type, QueryRollup.agent_name
         ).all()
         
         # Get language distribution by agent
         language_stats = db.session.query(
-            UserQuery.agent_type,
-            UserQuery.language,
-            func.count(UserQuery.id).label('count')
+            QueryRollup.agent_type,
+            QueryRollup.language,
+            func.sum(QueryRollup.query_count).label('count')
         ).filter(
-            UserQuery.agent_type.isnot(None)
+            *agent_rollups
         ).group_by(
-            UserQuery.agent_type, UserQuery.language
+            QueryRollup.agent_type, QueryRollup.language
         ).all()
         
         # Get daily usage for the last 30 days
         thirty_days_ago = datetime.utcnow() - timedelta(days=30)
         
         daily_stats = db.session.query(
-            func.date(UserQuery.created_at).label('date'),
-            UserQuery.agent_type,
-            func.count(UserQuery.id).label('count')
+            QueryRollup.bucket_start.label('date'),
+            QueryRollup.agent_type,
+            func.sum(QueryRollup.query_count).label('count')
         ).filter(
-            UserQuery.created_at >= thirty_days_ago,
-            UserQuery.agent_type.isnot(None)
+            *agent_rollups,
+            QueryRollup.bucket_start >= thirty_days_ago.replace(hour=0, minute=0, second=0, microsecond=0)
         ).group_by(
-            func.date(UserQuery.created_at), UserQuery.agent_type
+            QueryRollup.bucket_start, QueryRollup.agent_type
         ).all()
         
         # Format data for frontend
@@ -375,8 +654,8 @@ def agent_analytics():
                     'agent_type': stat.agent_type,
                     'agent_name': stat.agent_name,
                     'total_queries': stat.total_queries,
-                    'avg_response_time': round(stat.avg_response_time or 0, 2),
-                    'avg_confidence': round(stat.avg_confidence or 0, 2)
+                    'avg_response_time': round(_average(stat.response_time_sum, stat.response_time_count), 2),
+                    'avg_confidence': round(_average(stat.confidence_sum, stat.confidence_count), 2)
                 }
                 for stat in agent_stats
             ],
@@ -390,7 +669,7 @@ def agent_analytics():
             ],
             'daily_stats': [
                 {
-                    'date': stat.date.isoformat(),
+                    'date': stat.date.date().isoformat(),
                     'agent_type': stat.agent_type,
                     'count': stat.count
                 }
@@ -410,31 +689,31 @@ def agent_analytics():
 def analytics_summary():
     """Get summary analytics for dashboard"""
     try:
-        from models import UserQuery
+        from models import QueryRollup
         from app import db
         
+        agent_rollups = (QueryRollup.period == 'day', QueryRollup.agent_type != '')
+        
         # Get total queries by agent
         agent_totals = db.session.query(
-            UserQuery.agent_type,
-            UserQuery.agent_name,
-            func.count(UserQuery.id).label('total')
+            QueryRollup.agent_type,
+            QueryRollup.agent_name,
+            func.sum(QueryRollup.query_count).label('total')
         ).filter(
-            UserQuery.agent_type.isnot(None)
+            *agent_rollups
         ).group_by(
-            UserQuery.agent_type, UserQuery.agent_name
+            QueryRollup.agent_type, QueryRollup.agent_name
         ).all()
         
         # Get success rate (queries with high confidence)
         success_stats = db.session.query(
-            UserQuery.agent_type,
-            func.count(UserQuery.id).label('total'),
-            func.count(
-                db.case((UserQuery.agent_confidence >= 0.5, 1))
-            ).label('successful')
+            QueryRollup.agent_type,
+            func.sum(QueryRollup.query_count).label('total'),
+            func.sum(QueryRollup.confident_count).label('successful')
         ).filter(
-            UserQuery.agent_type.isnot(None)
+            *agent_rollups
         ).group_by(
-            UserQuery.agent_type
+            QueryRollup.agent_type
         ).all()
         
         result = {
@@ -462,3 +741,127 @@ def analytics_summary():
     except Exception as e:
         logger.error(f"Error getting analytics summary: {str(e)}")
         return jsonify({'error': 'Failed to get summary data'}), 500
+
+
+
+@admin_bp.route('/api/analytics/stages')
+@admin_required
+def stage_analytics():
+    """Get p50/p95 latency of each chat pipeline stage, overall and per agent"""
+    try:
+        from models import UserQuery
+        from stage_timing import STAGES, percentile
+        
+        days = request.args.get('days', 7, type=int)
+        since = datetime.utcnow() - timedelta(days=days)
+        # Only the small JSON column is loaded; the most recent rows are enough for percentiles
+        rows = UserQuery.query.with_entities(
+            UserQuery.agent_type, UserQuery.stage_timings
+        ).filter(
+            UserQuery.created_at >= since,
+            UserQuery.stage_timings.isnot(None)
+        ).order_by(UserQuery.created_at.desc()).limit(20000).all()
+        
+        samples = {}
+        for row in rows:
+            for stage, ms in (row.stage_timings or {}).items():
+                for group in ('all', row.agent_type or 'unknown'):
+                    samples.setdefault(group, {}).setdefault(stage, []).append(ms)
+        
+        result = {}
+        for group, stages in samples.items():
+            result[group] = {}
+            for stage in sorted(stages, key=lambda name: STAGES.index(name) if name in STAGES else len(STAGES)):
+                values = sorted(stages[stage])
+                result[group][stage] = {
+                    'count': len(values),
+                    'p50': percentile(values, 50),
+                    'p95': percentile(values, 95)
+                }
+        
+        return jsonify({'queries': len(rows), 'days': days, 'stages': result})
+        
+    except Exception as e:
+        logger.error(f"Error getting stage analytics: {str(e)}")
+        return jsonify({'error': 'Failed to get stage timings'}), 500
+
+
+@admin_bp.route('/api/analytics/performance')
+@admin_required
+def performance_analytics():
+    """Get runtime performance counters of this worker process"""
+    try:
+        from response_cache import response_cache
+        from mistral_client import get_mistral_client
+        from resilience import llm_policy
+        from single_flight import single_flight
+        import admission
+        import query_log
+        
+        return jsonify({
+            'response_cache': response_cache.stats(),
+            'llm_client': get_mistral_client().stats(),
+            'llm_resilience': llm_policy.stats(),
+            'single_flight': single_flight.stats(),
+            'admission': admission.stats(),
+            'query_log': query_log.stats()
+        })
+        
+    except Exception as e:
+        logger.error(f"Error getting performance analytics: {str(e)}")
+        return jsonify({'error': 'Failed to get performance data'}), 500
+
+
+@admin_bp.route('/api/ingestion/jobs')
+@admin_required
+def ingestion_jobs_list():
+    """Recent ingestion jobs, optionally filtered by job_type and status"""
+    try:
+        from models import IngestionJob
+        
+        limit = min(request.args.get('limit', 50, type=int), 200)
+        query = IngestionJob.query
+        if request.args.get('job_type'):
+            query = query.filter_by(job_type=request.args['job_type'])
+        if request.args.get('status'):
+            query = query.filter_by(status=request.args['status'])
+        jobs = query.order_by(IngestionJob.id.desc()).limit(limit).all()
+        
+        return jsonify({'jobs': [_job_to_dict(job) for job in jobs]})
+    
+    except Exception as e:
+        logger.error(f"Error listing ingestion jobs: {str(e)}")
+        return jsonify({'error': 'Failed to list ingestion jobs'}), 500
+
+
+@admin_bp.route('/api/ingestion/jobs/<int:job_id>')
+@admin_required
+def ingestion_job(job_id):
+    """Status and progress of one ingestion job (polled by the documents and web sources pages)"""
+    from models import IngestionJob
+    
+    return jsonify(_job_to_dict(IngestionJob.query.get_or_404(job_id)))
+
+
+@admin_bp.route('/api/ingestion/jobs', methods=['POST'])
+@admin_required
+def enqueue_ingestion_job():
+    """Queue a knowledge base update: {"job_type": "document" | "web", "source_id": id}"""
+    try:
+        from models import Document, WebSource
+        
+        data = request.get_json(silent=True) or {}
+        job_type = data.get('job_type')
+        source_id = data.get('source_id')
+        model = {'document': Document, 'web': WebSource}.get(job_type)
+        if model is None or not isinstance(source_id, int):
+            return jsonify({'error': 'job_type must be "document" or "web" and source_id an integer'}), 400
+        if model.query.get(source_id) is None:
+            return jsonify({'error': 'Source not found'}), 404
+        
+        job = ingestion_jobs.enqueue(job_type, source_id, session['admin_id'])
+        return jsonify(_job_to_dict(job)), 202
+    
+    except Exception as e:
+        logger.error(f"Error enqueueing ingestion job: {str(e)}")
+        return jsonify({'error': 'Failed to enqueue ingestion job'}), 500
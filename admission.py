@@ -0,0 +1,249 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Per-client token buckets, keyed by client IP address (behind the proxy: see app.TRUSTED_PROXIES)
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+RATE_LIMIT_PER_MINUTE = float(os.environ.get("RATE_LIMIT_REQUESTS_PER_MINUTE", "60"))
+# Requests a client may send at once before the per-minute rate applies
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", "10"))
+# Clients whose buckets are remembered; the least recently seen are forgotten first
+RATE_LIMIT_MAX_CLIENTS = 10000
+# Outbound LLM calls in flight per worker, requests allowed to wait for a slot and how long
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "8"))
+LLM_QUEUE_SIZE = int(os.environ.get("LLM_QUEUE_SIZE", "16"))
+LLM_QUEUE_TIMEOUT = float(os.environ.get("LLM_QUEUE_TIMEOUT_SECONDS", "2"))
+
+
+class AdmissionRejected(Exception):
+    """Raised instead of queueing an LLM call when the worker is saturated"""
+
+
+class RateLimiter:
+    """Token bucket per client key, refilled continuously at `rate` per second"""
+
+    def __init__(self, per_minute: float = RATE_LIMIT_PER_MINUTE, burst: float = RATE_LIMIT_BURST,
+                 max_clients: int = RATE_LIMIT_MAX_CLIENTS):
+        self.rate = per_minute / 60.0
+        self.burst = max(burst, 1.0)
+        self.max_clients = max_clients
+        # key -> (tokens, last refill time)
+        self._buckets: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+
+    def allow(self, *keys: str) -> Optional[float]:
+        """Take a token from every key's bucket; None if allowed, else seconds until retry"""
+        now = time.monotonic()
+        keys = [key for key in keys if key]
+        with self._lock:
+            buckets = [self._refill(key, now) for key in keys]
+            empty = [tokens for tokens in buckets if tokens < 1.0]
+            if empty:
+                self.limited += 1
+                return (1.0 - min(empty)) / self.rate if self.rate > 0 else 60.0
+            for key, tokens in zip(keys, buckets):
+                self._buckets[key] = (tokens - 1.0, now)
+            self.allowed += 1
+            return None
+
+    def _refill(self, key: str, now: float) -> float:
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        tokens = min(tokens + (now - updated) * self.rate, self.burst)
+        # Re-inserted at the end: the dict stays ordered by last use
+        self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+        return tokens
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'clients': len(self._buckets),
+                'allowed': self.allowed,
+                'rate_limited': self.limited,
+            }
+
+
+class _Waiter:
+    """A call queued for an LLM slot: a thread (future is None) or an event-loop task"""
+    __slots__ = ('loop', 'future', 'granted')
+
+    def __init__(self, loop=None, future=None):
+        self.loop = loop
+        self.future = future
+        self.granted = False
+
+
+class ConcurrencyLimiter:
+    """Semaphore with a bounded wait queue: overflow is rejected at once
+
+    A call that finds all slots busy waits at most `queue_timeout` and only
+    if fewer than `queue_size` calls are already waiting. Everything else is
+    shed, so a burst turns into quick fallback answers instead of a pile of
+    requests timing out against the model.
+
+    Sync (worker thread) and async (event loop) callers share one FIFO of
+    waiters: a finished call hands its slot directly to the next waiter of
+    either kind, so `active` never exceeds the limit and nobody sleeps while
+    a slot is free.
+    """
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, queue_size: int = LLM_QUEUE_SIZE,
+                 queue_timeout: float = LLM_QUEUE_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.timeouts = 0
+        self._condition = threading.Condition()
+        self._waiters: deque = deque()
+
+    @contextmanager
+    def slot(self):
+        """Hold one slot for the duration of an LLM call; raises AdmissionRejected"""
+        with self._condition:
+            if not self._try_acquire():
+                waiter = self._enqueue(_Waiter())
+                deadline = time.monotonic() + self.queue_timeout
+                while not waiter.granted:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._waiters.remove(waiter)
+                        self.waiting -= 1
+                        self.timeouts += 1
+                        self.shed += 1
+                        raise AdmissionRejected("LLM queue wait timed out")
+                    self._condition.wait(remaining)
+            self.admitted += 1
+        try:
+            yield
+        finally:
+            self._release()
+
+    @asynccontextmanager
+    async def aslot(self):
+        """Event-loop variant of slot() for the ASGI pipeline"""
+        waiter = None
+        with self._condition:
+            if self._try_acquire():
+                self.admitted += 1
+            else:
+                loop = asyncio.get_running_loop()
+                waiter = self._enqueue(_Waiter(loop, loop.create_future()))
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(waiter.future, self.queue_timeout)
+            except BaseException as e:
+                with self._condition:
+                    still_queued = waiter in self._waiters
+                    if still_queued:
+                        self._waiters.remove(waiter)
+                        self.waiting -= 1
+                    if isinstance(e, asyncio.TimeoutError):
+                        self.timeouts += 1
+                        self.shed += 1
+                # Granted just before the timeout or cancellation: pass the slot on
+                # (a grant still in flight is passed on by _grant_async instead)
+                if not still_queued and waiter.future.done() and not waiter.future.cancelled():
+                    self._release()
+                if isinstance(e, asyncio.TimeoutError):
+                    raise AdmissionRejected("LLM queue wait timed out")
+                raise
+            with self._condition:
+                self.admitted += 1
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _try_acquire(self) -> bool:
+        """Take a free slot (lock held); queued callers go first"""
+        if self.active < self.max_concurrency and not self._waiters:
+            self.active += 1
+            return True
+        return False
+
+    def _enqueue(self, waiter: _Waiter) -> _Waiter:
+        """Join the wait queue (lock held) or raise if it is full"""
+        if self.waiting >= self.queue_size:
+            self.shed += 1
+            raise AdmissionRejected("LLM queue is full")
+        self.waiting += 1
+        self.queued += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        self._waiters.append(waiter)
+        return waiter
+
+    def _release(self):
+        """Hand the slot to the next waiter, or free it"""
+        with self._condition:
+            if not self._waiters:
+                self.active -= 1
+                return
+            waiter = self._waiters.popleft()
+            self.waiting -= 1
+            if waiter.future is None:
+                waiter.granted = True
+                self._condition.notify_all()
+                return
+        # The future belongs to its event loop: resolve it there
+        try:
+            waiter.loop.call_soon_threadsafe(self._grant_async, waiter)
+        except RuntimeError:  # Loop already closed
+            self._release()
+
+    def _grant_async(self, waiter: _Waiter):
+        if waiter.future.done():
+            # Timed out or cancelled meanwhile: the slot goes to the next one
+            self._release()
+        else:
+            waiter.future.set_result(None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._condition:
+            return {
+                'max_concurrency': self.max_concurrency,
+                'active': self.active,
+                'queue_depth': self.waiting,
+                'max_queue_depth': self.max_waiting,
+                'admitted': self.admitted,
+                'queued': self.queued,
+                'shed': self.shed,
+                'queue_timeouts': self.timeouts,
+            }
+
+
+def check_rate_limit(ip_address: Optional[str]) -> Optional[float]:
+    """None if the client may send a chat request now, else seconds until it may retry"""
+    if not RATE_LIMIT_ENABLED:
+        return None
+    return rate_limiter.allow(f"ip:{ip_address}" if ip_address else '')
+
+
+def rate_limit_message(language: str) -> str:
+    if language == 'kz':
+        return "Сұраулар тым көп. Біраз күтіп, қайталап көріңіз."
+    return "Слишком много запросов. Подождите немного и попробуйте еще раз."
+
+
+def stats() -> Dict[str, Any]:
+    return {**llm_slots.stats(), **rate_limiter.stats()}
+
+
+rate_limiter = RateLimiter()
+# Shared by the sync and async Mistral clients of this process
+llm_slots = ConcurrencyLimiter()
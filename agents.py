@@ -1,8 +1,10 @@
 # Импорт необходимых модулей
 import logging
 from abc import ABC, abstractmethod
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, AsyncIterator, Generator, Iterator, Optional, List, Tuple, Union
 from enum import Enum
+from stage_timing import stage
+from text_processing import normalize_text, stem
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
@@ -17,6 +19,42 @@ class AgentType(Enum):
     GENERAL = "general"  # Общие вопросы
 
 
+class ResponseStream:
+    """
+    Ответ, отдаваемый частями по мере генерации.
+    
+    Итерация возвращает части текста; после ее завершения в result
+    находится итоговый результат в том же формате, что и у process_message.
+    """
+    
+    def __init__(self, generator: Generator[str, None, Dict[str, Any]]):
+        self._generator = generator
+        self.result: Optional[Dict[str, Any]] = None
+    
+    def __iter__(self) -> Iterator[str]:
+        self.result = yield from self._generator
+
+
+class AsyncResponseStream:
+    """
+    Асинхронный вариант ResponseStream.
+    
+    Асинхронные генераторы не могут возвращать значение, поэтому внутренний
+    генератор последним элементом отдает словарь с итоговым результатом.
+    """
+    
+    def __init__(self, generator: AsyncIterator[Union[str, Dict[str, Any]]]):
+        self._generator = generator
+        self.result: Optional[Dict[str, Any]] = None
+    
+    async def __aiter__(self) -> AsyncIterator[str]:
+        async for item in self._generator:
+            if isinstance(item, dict):
+                self.result = item
+            else:
+                yield item
+
+
 class BaseAgent(ABC):
     """
     Базовый класс для всех агентов системы.
@@ -25,12 +63,19 @@ class BaseAgent(ABC):
     метод process_message для обработки сообщений пользователей.
     """
     
+    # Префиксы слов, при наличии которых уверенность агента повышается
+    boost_prefixes: List[str] = []
+    # Вклад каждого ключевого слова и префикса в уверенность
+    keyword_weight = 0.3
+    boost_weight = 0.2
+    
     def __init__(self, agent_type: AgentType, name: str, description: str):
         self.agent_type = agent_type
         self.name = name
         self.description = description
+        # Кэш основ ключевых слов по языкам
+        self._keyword_stems: Dict[str, Tuple[str, ...]] = {}
         
-    @abstractmethod
     def can_handle(self, message: str, language: str = "ru") -> float:
         """
         Определяет, может ли агент обработать данное сообщение.
@@ -42,7 +87,25 @@ class BaseAgent(ABC):
         Returns:
             float: Уверенность от 0.0 до 1.0 в том, что агент может обработать сообщение
         """
-        pass
+        keyword_count = self.count_keywords(message, language)
+        return self.confidence_from_matches(keyword_count, self.has_prefix(message, self.boost_prefixes))
+    
+    def confidence_from_matches(self, keyword_count: int, boosted: bool) -> float:
+        """
+        Рассчитывает уверенность по результатам поиска ключевых слов.
+        
+        Args:
+            keyword_count: Количество найденных ключевых слов
+            boosted: Найден ли один из префиксов boost_prefixes
+            
+        Returns:
+            float: Уверенность от 0.0 до 1.0
+        """
+        # Базовая уверенность на основе ключевых слов
+        confidence = min(keyword_count * self.keyword_weight, 0.9)
+        if boosted:
+            confidence += self.boost_weight
+        return min(confidence, 1.0)
     
     @abstractmethod
     def get_system_prompt(self, language: str = "ru") -> str:
@@ -69,6 +132,45 @@ class BaseAgent(ABC):
         """
         return []
     
+    def get_keyword_stems(self, language: str = "ru") -> Tuple[str, ...]:
+        """
+        Возвращает основы ключевых слов, чтобы совпадали разные словоформы
+        ("стипендия", "стипендии", "стипендию").
+        
+        Args:
+            language: Язык ключевых слов
+            
+        Returns:
+            Tuple[str, ...]: Уникальные основы ключевых слов
+        """
+        if language not in self._keyword_stems:
+            self._keyword_stems[language] = tuple(dict.fromkeys(
+                stem(word, language)
+                for keyword in self.get_keywords(language)
+                for word in normalize_text(keyword).split()
+            ))
+        return self._keyword_stems[language]
+    
+    def count_keywords(self, message: str, language: str = "ru") -> int:
+        """
+        Подсчитывает ключевые слова агента, с которых начинается какое-либо слово сообщения.
+        
+        Args:
+            message: Сообщение пользователя
+            language: Язык сообщения
+            
+        Returns:
+            int: Количество найденных ключевых слов
+        """
+        text = f" {normalize_text(message)}"
+        return sum(1 for keyword_stem in self.get_keyword_stems(language) if f" {keyword_stem}" in text)
+    
+    @staticmethod
+    def has_prefix(message: str, prefixes: List[str]) -> bool:
+        """Проверяет, начинается ли какое-либо слово сообщения с одного из префиксов"""
+        text = f" {normalize_text(message)}"
+        return any(f" {prefix}" in text for prefix in prefixes)
+    
     def process_message(self, message: str, language: str = "ru") -> Dict[str, Any]:
         """
         Обрабатывает сообщение пользователя.
@@ -82,28 +184,27 @@ class BaseAgent(ABC):
         """
         try:
             # Import here to avoid circular imports
-            from mistral_client import MistralClient
+            from mistral_client import get_mistral_client
             
-            # Initialize Mistral client
-            mistral_client = MistralClient()
+            # Вопрос почти совпадает с вопросом из FAQ - отвечаем без обращения к LLM
+            direct_answer = self._get_direct_faq_answer(message, language)
+            if direct_answer:
+                return direct_answer
             
-            # Try to get relevant context, but handle import errors gracefully
-            context = ""
-            context_used = False
-            try:
-                from utils import get_relevant_context
-                context = get_relevant_context(message, language)
-                context_used = bool(context.strip())
-            except ImportError:
-                logger.warning("Unable to import context retrieval, using empty context")
+            # Общий для процесса клиент с пулом keep-alive соединений
+            mistral_client = get_mistral_client()
+            
+            context, context_used = self._get_context(message, language)
             
             # Получаем ответ от Mistral
-            response = mistral_client.get_response(message, context, language)
+            with stage('llm'):
+                response, from_llm = mistral_client.generate(message, context, language)
             
             return {
                 'response': response,
                 'confidence': self.can_handle(message, language),
                 'context_used': context_used,
+                'response_source': 'llm' if from_llm else 'fallback',
                 'agent_type': self.agent_type.value,
                 'agent_name': self.name
             }
@@ -115,10 +216,157 @@ class BaseAgent(ABC):
                 'response': fallback,
                 'confidence': 0.1,
                 'context_used': False,
+                'response_source': 'fallback',
                 'agent_type': self.agent_type.value,
                 'agent_name': self.name
             }
     
+    def stream_message(self, message: str, language: str = "ru") -> ResponseStream:
+        """
+        Потоковая версия process_message: ответ модели отдается по частям.
+        
+        Args:
+            message: Сообщение пользователя
+            language: Язык сообщения
+            
+        Returns:
+            ResponseStream: Части ответа, итоговый результат в ResponseStream.result
+        """
+        return ResponseStream(self._stream_message(message, language))
+    
+    def _stream_message(self, message: str, language: str = "ru") -> Generator[str, None, Dict[str, Any]]:
+        try:
+            from mistral_client import get_mistral_client
+            
+            # Готовый ответ из FAQ отдается одним куском
+            direct_answer = self._get_direct_faq_answer(message, language)
+            if direct_answer:
+                yield direct_answer['response']
+                return direct_answer
+            
+            context, context_used = self._get_context(message, language)
+            
+            with stage('llm'):
+                response, from_llm = yield from get_mistral_client().stream(message, context, language)
+            
+            return {
+                'response': response,
+                'confidence': self.can_handle(message, language),
+                'context_used': context_used,
+                'response_source': 'llm' if from_llm else 'fallback',
+                'agent_type': self.agent_type.value,
+                'agent_name': self.name
+            }
+            
+        except Exception as e:
+            logger.error(f"Error in {self.name} agent: {str(e)}")
+            fallback = self._get_fallback_response(language)
+            yield fallback
+            return {
+                'response': fallback,
+                'confidence': 0.1,
+                'context_used': False,
+                'response_source': 'fallback',
+                'agent_type': self.agent_type.value,
+                'agent_name': self.name
+            }
+    
+    def astream_message(self, message: str, language: str = "ru") -> AsyncResponseStream:
+        """
+        Асинхронная версия stream_message для ASGI режима.
+        
+        Обращения к базе данных и поиск выполняются в пуле потоков,
+        ожидание ответа модели не блокирует цикл событий.
+        
+        Args:
+            message: Сообщение пользователя
+            language: Язык сообщения
+            
+        Returns:
+            AsyncResponseStream: Части ответа, итоговый результат в AsyncResponseStream.result
+        """
+        return AsyncResponseStream(self._astream_message(message, language))
+    
+    async def _astream_message(self, message: str, language: str = "ru") -> AsyncIterator[Union[str, Dict[str, Any]]]:
+        try:
+            from mistral_client import get_async_mistral_client
+            from utils import run_in_thread
+            
+            direct_answer = await run_in_thread(self._get_direct_faq_answer, message, language)
+            if direct_answer:
+                yield direct_answer['response']
+                yield direct_answer
+                return
+            
+            context, context_used = await run_in_thread(self._get_context, message, language)
+            
+            response, from_llm = "", False
+            with stage('llm'):
+                async for item in get_async_mistral_client().stream(message, context, language):
+                    if isinstance(item, tuple):
+                        response, from_llm = item
+                    else:
+                        yield item
+            
+            yield {
+                'response': response,
+                'confidence': self.can_handle(message, language),
+                'context_used': context_used,
+                'response_source': 'llm' if from_llm else 'fallback',
+                'agent_type': self.agent_type.value,
+                'agent_name': self.name
+            }
+            
+        except Exception as e:
+            logger.error(f"Error in {self.name} agent: {str(e)}")
+            fallback = self._get_fallback_response(language)
+            yield fallback
+            yield {
+                'response': fallback,
+                'confidence': 0.1,
+                'context_used': False,
+                'response_source': 'fallback',
+                'agent_type': self.agent_type.value,
+                'agent_name': self.name
+            }
+    
+    def _get_context(self, message: str, language: str = "ru") -> Tuple[str, bool]:
+        """Возвращает контекст из FAQ и базы знаний и признак того, что он не пустой"""
+        # Try to get relevant context, but handle import errors gracefully
+        try:
+            from utils import get_relevant_context
+            context = get_relevant_context(message, language)
+            return context, bool(context.strip())
+        except ImportError:
+            logger.warning("Unable to import context retrieval, using empty context")
+            return "", False
+    
+    def _get_direct_faq_answer(self, message: str, language: str = "ru") -> Optional[Dict[str, Any]]:
+        """Возвращает готовый ответ из FAQ, если сходство вопроса выше порога"""
+        try:
+            from utils import get_direct_faq_answer
+            with stage('faq'):
+                match = get_direct_faq_answer(message, language)
+        except Exception as e:
+            logger.warning(f"FAQ direct answer lookup failed: {str(e)}")
+            return None
+        
+        if not match:
+            return None
+        
+        faq, score = match
+        logger.info(f"Direct FAQ answer {faq.id} (score: {score:.2f}) by {self.name}")
+        return {
+            'response': faq.answer_kz if language == 'kz' else faq.answer_ru,
+            'confidence': self.can_handle(message, language),
+            'context_used': True,
+            'response_source': 'faq',
+            'faq_id': faq.id,
+            'faq_score': score,
+            'agent_type': self.agent_type.value,
+            'agent_name': self.name
+        }
+    
     def _get_fallback_response(self, language: str = "ru") -> str:
         """Возвращает резервный ответ при ошибке"""
         fallback_responses = {
@@ -131,6 +379,8 @@ class BaseAgent(ABC):
 class AdmissionAgent(BaseAgent):
     """Агент для обработки вопросов поступления"""
     
+    boost_prefixes = ['поступ', 'зачисл', 'абитур', 'прием']
+    
     def __init__(self):
         super().__init__(
             AgentType.ADMISSION,
@@ -138,23 +388,6 @@ class AdmissionAgent(BaseAgent):
             "Вопросы поступления и зачисления"
         )
     
-    def can_handle(self, message: str, language: str = "ru") -> float:
-        """Определяет релевантность для вопросов поступления"""
-        keywords = self.get_keywords(language)
-        message_lower = message.lower()
-        
-        # Подсчитываем количество ключевых слов в сообщении
-        keyword_count = sum(1 for keyword in keywords if keyword in message_lower)
-        
-        # Базовая уверенность на основе ключевых слов
-        confidence = min(keyword_count * 0.3, 0.9)
-        
-        # Дополнительные проверки
-        if any(word in message_lower for word in ['поступ', 'зачисл', 'абитур', 'прием']):
-            confidence += 0.2
-        
-        return min(confidence, 1.0)
-    
     def get_keywords(self, language: str = "ru") -> List[str]:
         """Ключевые слова для поступления"""
         if language == "kz":
@@ -185,6 +418,10 @@ class AdmissionAgent(BaseAgent):
 class ScholarshipAgent(BaseAgent):
     """Агент для обработки вопросов о стипендиях"""
     
+    boost_prefixes = ['стипенд', 'деньги', 'оплат', 'финанс']
+    keyword_weight = 0.35
+    boost_weight = 0.25
+    
     def __init__(self):
         super().__init__(
             AgentType.SCHOLARSHIP,
@@ -192,20 +429,6 @@ class ScholarshipAgent(BaseAgent):
             "Вопросы стипендий и финансовой поддержки"
         )
     
-    def can_handle(self, message: str, language: str = "ru") -> float:
-        """Определяет релевантность для вопросов стипендий"""
-        keywords = self.get_keywords(language)
-        message_lower = message.lower()
-        
-        keyword_count = sum(1 for keyword in keywords if keyword in message_lower)
-        confidence = min(keyword_count * 0.35, 0.9)
-        
-        # Дополнительные проверки для финансовых вопросов
-        if any(word in message_lower for word in ['стипенд', 'деньги', 'оплат', 'финанс']):
-            confidence += 0.25
-        
-        return min(confidence, 1.0)
-    
     def get_keywords(self, language: str = "ru") -> List[str]:
         """Ключевые слова для стипендий"""
         if language == "kz":
@@ -233,6 +456,8 @@ class ScholarshipAgent(BaseAgent):
 class AcademicAgent(BaseAgent):
     """Агент для обработки учебных вопросов"""
     
+    boost_prefixes = ['учеб', 'занят', 'предмет', 'курс', 'экзамен']
+    
     def __init__(self):
         super().__init__(
             AgentType.ACADEMIC,
@@ -240,20 +465,6 @@ class AcademicAgent(BaseAgent):
             "Учебные вопросы и образовательный процесс"
         )
     
-    def can_handle(self, message: str, language: str = "ru") -> float:
-        """Определяет релевантность для учебных вопросов"""
-        keywords = self.get_keywords(language)
-        message_lower = message.lower()
-        
-        keyword_count = sum(1 for keyword in keywords if keyword in message_lower)
-        confidence = min(keyword_count * 0.3, 0.9)
-        
-        # Проверка на учебные темы
-        if any(word in message_lower for word in ['учеб', 'занят', 'предмет', 'курс', 'экзамен']):
-            confidence += 0.2
-        
-        return min(confidence, 1.0)
-    
     def get_keywords(self, language: str = "ru") -> List[str]:
         """Ключевые слова для учебных вопросов"""
         if language == "kz":
@@ -281,6 +492,10 @@ class AcademicAgent(BaseAgent):
 class StudentLifeAgent(BaseAgent):
     """Агент для обработки вопросов студенческой жизни"""
     
+    boost_prefixes = ['общежит', 'кружок', 'спорт', 'мероприят']
+    keyword_weight = 0.35
+    boost_weight = 0.25
+    
     def __init__(self):
         super().__init__(
             AgentType.STUDENT_LIFE,
@@ -288,20 +503,6 @@ class StudentLifeAgent(BaseAgent):
             "Студенческая жизнь и внеучебная деятельность"
         )
     
-    def can_handle(self, message: str, language: str = "ru") -> float:
-        """Определяет релевантность для вопросов студенческой жизни"""
-        keywords = self.get_keywords(language)
-        message_lower = message.lower()
-        
-        keyword_count = sum(1 for keyword in keywords if keyword in message_lower)
-        confidence = min(keyword_count * 0.35, 0.9)
-        
-        # Проверка на темы студенческой жизни
-        if any(word in message_lower for word in ['общежит', 'кружок', 'спорт', 'мероприят']):
-            confidence += 0.25
-        
-        return min(confidence, 1.0)
-    
     def get_keywords(self, language: str = "ru") -> List[str]:
         """Ключевые слова для студенческой жизни"""
         if language == "kz":
@@ -342,6 +543,10 @@ class GeneralAgent(BaseAgent):
         # Если никто другой не может ответить, он станет резервным
         return 0.3
     
+    def confidence_from_matches(self, keyword_count: int, boosted: bool) -> float:
+        """Уверенность общего агента не зависит от ключевых слов"""
+        return 0.3
+    
     def get_keywords(self, language: str = "ru") -> List[str]:
         """Общие ключевые слова"""
         if language == "kz":
@@ -383,39 +588,72 @@ class AgentRouter:
             StudentLifeAgent(),
             GeneralAgent()
         ]
+        # Ключевые слова и префиксы всех агентов в одном автомате на язык:
+        # уверенность всех агентов считается за один проход по сообщению
+        from keyword_matcher import AgentMatcher
+        self.matcher = AgentMatcher(self.agents)
         
         logger.info(f"AgentRouter initialized with {len(self.agents)} agents")
     
-    def route_message(self, message: str, language: str = "ru") -> Dict[str, Any]:
+    def route_message(self, message: str, language: str = "ru",
+                      agent_type: Optional[str] = None) -> Dict[str, Any]:
         """
         Маршрутизирует сообщение к наиболее подходящему агенту.
         
+        Перед обращением к LLM проверяется кэш ответов: одинаковые (или почти
+        одинаковые) вопросы к тому же агенту на том же языке получают сохраненный ответ.
+        
         Args:
             message: Сообщение пользователя
             language: Язык сообщения
+            agent_type: Тип агента, выбранный пользователем явно (необязательно)
             
         Returns:
             Dict: Результат обработки сообщения выбранным агентом
         """
         try:
-            # Получаем уверенность каждого агента
-            agent_confidences = []
-            for agent in self.agents:
-                confidence = agent.can_handle(message, language)
-                agent_confidences.append((agent, confidence))
-                logger.debug(f"Agent {agent.name}: confidence {confidence:.2f}")
+            with stage('route'):
+                best_agent, best_confidence = self.select_agent(message, language, agent_type)
             
-            # Сортируем по уверенности (по убыванию)
-            agent_confidences.sort(key=lambda x: x[1], reverse=True)
+            logger.info(f"Selected agent: {best_agent.name} (confidence: {best_confidence:.2f})")
             
-            # Выбираем агента с наибольшей уверенностью
-            best_agent, best_confidence = agent_confidences[0]
+            # Проверяем кэш ответов до обращения к LLM
+            from response_cache import question_hash, response_cache
+            agent_key = best_agent.agent_type.value
+            with stage('cache'):
+                cached_response = response_cache.get(message, language, agent_key)
+            if cached_response is not None:
+                return {
+                    'response': cached_response,
+                    'confidence': best_confidence,
+                    'context_used': False,
+                    'response_source': 'cache',
+                    'agent_type': agent_key,
+                    'agent_name': best_agent.name,
+                    'selected_confidence': best_confidence
+                }
             
-            logger.info(f"Selected agent: {best_agent.name} (confidence: {best_confidence:.2f})")
+            # Одинаковые вопросы, заданные одновременно, ждут один вызов LLM
+            from single_flight import single_flight
+            with stage('coalesce'):
+                flight = single_flight.join(question_hash(message, language, agent_key))
+            if flight.result is not None:
+                return self._coalesced_result(flight.result, best_confidence)
             
             # Обрабатываем сообщение выбранным агентом
-            result = best_agent.process_message(message, language)
+            result = None
+            try:
+                result = best_agent.process_message(message, language)
+            finally:
+                # Ожидающим отдается копия: лидер еще дополняет свой результат ниже
+                flight.complete(dict(result) if result is not None else None)
             result['selected_confidence'] = best_confidence
+            if agent_type:
+                result['confidence'] = best_confidence
+            
+            # Кэшируем только настоящие ответы модели
+            if result.get('response_source') == 'llm':
+                response_cache.put(message, language, agent_key, result['response'])
             
             return result
             
@@ -428,6 +666,208 @@ class AgentRouter:
             result['error'] = str(e)
             return result
     
+    def stream_message(self, message: str, language: str = "ru",
+                       agent_type: Optional[str] = None) -> ResponseStream:
+        """
+        Потоковая версия route_message: ответ отдается по частям по мере генерации.
+        
+        Args:
+            message: Сообщение пользователя
+            language: Язык сообщения
+            agent_type: Тип агента, выбранный пользователем явно (необязательно)
+            
+        Returns:
+            ResponseStream: Части ответа, итоговый результат в ResponseStream.result
+        """
+        return ResponseStream(self._stream_message(message, language, agent_type))
+    
+    def _stream_message(self, message: str, language: str = "ru",
+                        agent_type: Optional[str] = None) -> Generator[str, None, Dict[str, Any]]:
+        try:
+            with stage('route'):
+                best_agent, best_confidence = self.select_agent(message, language, agent_type)
+        except Exception as e:
+            logger.error(f"Error in agent routing: {str(e)}")
+            # В случае ошибки используем общего агента
+            best_agent, best_confidence = self.agents[-1], 0.1
+        logger.info(f"Selected agent: {best_agent.name} (confidence: {best_confidence:.2f})")
+        
+        from response_cache import question_hash, response_cache
+        agent_key = best_agent.agent_type.value
+        with stage('cache'):
+            cached_response = response_cache.get(message, language, agent_key)
+        if cached_response is not None:
+            yield cached_response
+            return {
+                'response': cached_response,
+                'confidence': best_confidence,
+                'context_used': False,
+                'response_source': 'cache',
+                'agent_type': agent_key,
+                'agent_name': best_agent.name,
+                'selected_confidence': best_confidence
+            }
+        
+        from single_flight import single_flight
+        with stage('coalesce'):
+            flight = single_flight.join(question_hash(message, language, agent_key))
+        if flight.result is not None:
+            result = self._coalesced_result(flight.result, best_confidence)
+            yield result['response']
+            return result
+        
+        result = None
+        try:
+            stream = best_agent.stream_message(message, language)
+            yield from stream
+            result = stream.result
+        finally:
+            # Ожидающим отдается копия: лидер еще дополняет свой результат ниже
+            flight.complete(dict(result) if result is not None else None)
+        result['selected_confidence'] = best_confidence
+        if agent_type:
+            result['confidence'] = best_confidence
+        
+        if result.get('response_source') == 'llm':
+            response_cache.put(message, language, agent_key, result['response'])
+        
+        return result
+    
+    async def aroute_message(self, message: str, language: str = "ru",
+                             agent_type: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Асинхронная версия route_message для ASGI режима.
+        
+        Args:
+            message: Сообщение пользователя
+            language: Язык сообщения
+            agent_type: Тип агента, выбранный пользователем явно (необязательно)
+            
+        Returns:
+            Dict: Результат обработки сообщения выбранным агентом
+        """
+        stream = self.astream_message(message, language, agent_type)
+        async for _ in stream:
+            pass
+        return stream.result
+    
+    def astream_message(self, message: str, language: str = "ru",
+                        agent_type: Optional[str] = None) -> AsyncResponseStream:
+        """
+        Асинхронная версия stream_message для ASGI режима.
+        
+        Args:
+            message: Сообщение пользователя
+            language: Язык сообщения
+            agent_type: Тип агента, выбранный пользователем явно (необязательно)
+            
+        Returns:
+            AsyncResponseStream: Части ответа, итоговый результат в AsyncResponseStream.result
+        """
+        return AsyncResponseStream(self._astream_message(message, language, agent_type))
+    
+    async def _astream_message(self, message: str, language: str = "ru",
+                               agent_type: Optional[str] = None) -> AsyncIterator[Union[str, Dict[str, Any]]]:
+        from response_cache import question_hash, response_cache
+        from utils import run_in_thread
+        
+        try:
+            with stage('route'):
+                best_agent, best_confidence = self.select_agent(message, language, agent_type)
+        except Exception as e:
+            logger.error(f"Error in agent routing: {str(e)}")
+            best_agent, best_confidence = self.agents[-1], 0.1
+        logger.info(f"Selected agent: {best_agent.name} (confidence: {best_confidence:.2f})")
+        
+        # Промах кэша может обратиться к истории запросов в БД
+        agent_key = best_agent.agent_type.value
+        with stage('cache'):
+            cached_response = await run_in_thread(response_cache.get, message, language, agent_key)
+        if cached_response is not None:
+            yield cached_response
+            yield {
+                'response': cached_response,
+                'confidence': best_confidence,
+                'context_used': False,
+                'response_source': 'cache',
+                'agent_type': agent_key,
+                'agent_name': best_agent.name,
+                'selected_confidence': best_confidence
+            }
+            return
+        
+        from single_flight import single_flight
+        with stage('coalesce'):
+            flight = await single_flight.join_async(question_hash(message, language, agent_key))
+        if flight.result is not None:
+            result = self._coalesced_result(flight.result, best_confidence)
+            yield result['response']
+            yield result
+            return
+        
+        result = None
+        try:
+            stream = best_agent.astream_message(message, language)
+            async for piece in stream:
+                yield piece
+            result = stream.result
+        finally:
+            # Ожидающим отдается копия: лидер еще дополняет свой результат ниже
+            flight.complete(dict(result) if result is not None else None)
+        result['selected_confidence'] = best_confidence
+        if agent_type:
+            result['confidence'] = best_confidence
+        
+        if result.get('response_source') == 'llm':
+            response_cache.put(message, language, agent_key, result['response'])
+        
+        yield result
+    
+    @staticmethod
+    def _coalesced_result(shared: Dict[str, Any], best_confidence: float) -> Dict[str, Any]:
+        """
+        Копия результата, полученного другим запросом с тем же вопросом.
+        
+        Ответ модели помечается как 'coalesced', чтобы он не учитывался
+        повторно как обращение к LLM и не попадал в кэш второй раз.
+        """
+        result = dict(shared)
+        if result.get('response_source') == 'llm':
+            result['response_source'] = 'coalesced'
+        result['selected_confidence'] = best_confidence
+        return result
+    
+    def select_agent(self, message: str, language: str = "ru",
+                     agent_type: Optional[str] = None) -> Tuple[BaseAgent, float]:
+        """
+        Выбирает агента для сообщения.
+        
+        Args:
+            message: Сообщение пользователя
+            language: Язык сообщения
+            agent_type: Тип агента, выбранный пользователем явно (необязательно)
+            
+        Returns:
+            Tuple: Агент и уверенность (1.0 для явно выбранного агента)
+        """
+        if agent_type:
+            for agent in self.agents:
+                if agent.agent_type.value == agent_type:
+                    return agent, 1.0
+        
+        # Получаем уверенность каждого агента за один проход по сообщению
+        agent_confidences = []
+        for agent, (keyword_count, boosted) in zip(self.agents, self.matcher.scan(message, language)):
+            confidence = agent.confidence_from_matches(keyword_count, boosted)
+            agent_confidences.append((agent, confidence))
+            logger.debug(f"Agent {agent.name}: confidence {confidence:.2f}")
+        
+        # Сортируем по уверенности (по убыванию)
+        agent_confidences.sort(key=lambda x: x[1], reverse=True)
+        
+        # Выбираем агента с наибольшей уверенностью
+        return agent_confidences[0]
+    
     def get_available_agents(self) -> List[Dict[str, str]]:
         """
         Возвращает список доступных агентов.
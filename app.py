@@ -19,6 +19,18 @@ class Base(DeclarativeBase):
 # Инициализация объекта базы данных
 db = SQLAlchemy(model_class=Base)
 
+# Число доверенных прокси перед приложением: адрес клиента берется из X-Forwarded-For
+# (используется и в asgi.py)
+TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", "1"))
+
+# Источники, которым разрешены кросс-доменные запросы (используется и в asgi.py)
+CORS_ORIGINS = [
+    "https://7a0463a0-cbab-40ed-8964-1461cf93cb8a-00-tv6bvx5wqo3s.pike.replit.dev",
+    "https://*.replit.dev",  # Разрешить все поддомены replit.dev
+    "http://localhost:*",  # Для локальной разработки
+    "https://localhost:*"  # Для локальной разработки с HTTPS
+]
+
 
 def create_app():
     """Функция создания и настройки Flask приложения"""
@@ -28,7 +40,7 @@ def create_app():
     app.secret_key = os.environ.get("SESSION_SECRET",
                                     "dev-secret-key-change-in-production")
     # Настройка ProxyFix для работы за прокси
-    app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=1, x_host=1)
 
     # Настройка базы данных
     database_url = os.environ.get("DATABASE_URL", "sqlite:///bolashakbot.db")
@@ -39,19 +51,25 @@ def create_app():
         "pool_pre_ping": True,  # Проверка соединения перед использованием
     }
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # Поисковый движок для контекста: bm25 (в памяти), fts (полнотекстовый поиск БД)
+    # или vector (векторный поиск по эмбеддингам)
+    app.config["RETRIEVAL_BACKEND"] = os.environ.get("RETRIEVAL_BACKEND", "bm25")
+    # Порог сходства с вопросом FAQ, при котором ответ выдается без обращения к LLM (0 - отключено)
+    app.config["FAQ_DIRECT_ANSWER_THRESHOLD"] = float(os.environ.get("FAQ_DIRECT_ANSWER_THRESHOLD", "0.8"))
+    # Максимальный размер контекста (FAQ + база знаний) в токенах, передаваемого в LLM
+    app.config["CONTEXT_TOKEN_BUDGET"] = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "1000"))
 
     # Инициализация базы данных с приложением
     db.init_app(app)
 
+    # Счетчики и гистограммы запросов для /metrics
+    import metrics
+    metrics.init_app(app)
+
     # Настройка CORS (разрешение кросс-доменных запросов)
     CORS(
         app,
-        origins=[
-            "https://7a0463a0-cbab-40ed-8964-1461cf93cb8a-00-tv6bvx5wqo3s.pike.replit.dev",
-            "https://*.replit.dev",  # Разрешить все поддомены replit.dev
-            "http://localhost:*",  # Для локальной разработки
-            "https://localhost:*"  # Для локальной разработки с HTTPS
-        ],
+        origins=CORS_ORIGINS,
         supports_credentials=True)
 
     # Импорт модулей с маршрутами (blueprints)
@@ -72,6 +90,15 @@ def create_app():
         # Создание всех таблиц в базе данных
         db.create_all()
 
+        # Новые столбцы и индексы в уже существующих таблицах (create_all их не добавляет)
+        from schema import ensure_schema
+        ensure_schema()
+
+        # Полнотекстовые индексы (tsvector/GIN или FTS5) для режима fts
+        if app.config["RETRIEVAL_BACKEND"] == "fts":
+            from fulltext_search import ensure_fulltext_schema
+            ensure_fulltext_schema()
+
         # Инициализация начальных данных с задержкой
         # Commented out for now to avoid circular imports
         # try:
@@ -0,0 +1,288 @@
+"""ASGI entry point
+
+The chat endpoints (/api/chat and /api/chat/stream) are served natively by an
+async pipeline: routing runs on the event loop, retrieval and database writes
+run in a thread pool, and the LLM is called through httpx.AsyncClient. One
+worker process can therefore keep hundreds of chats in flight while waiting
+for the model. Every other route (admin pages, widget assets, auth) is the
+regular Flask application, run in a small WSGI thread pool.
+
+Run with:
+    gunicorn -k uvicorn_worker.UvicornWorker --bind 0.0.0.0:5000 asgi:application
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from typing import Optional, Tuple
+
+from a2wsgi import WSGIMiddleware
+
+from admission import check_rate_limit, rate_limit_message
+from app import app, CORS_ORIGINS, TRUSTED_PROXIES
+import metrics
+import query_log
+import stage_timing
+from mistral_client import close_async_mistral_client
+from utils import run_in_thread
+from views import initialize_agent_router, record_user_query
+
+logger = logging.getLogger(__name__)
+
+# Threads for blocking work of the async pipeline (retrieval, DB); keep below the DB pool size
+THREAD_POOL_SIZE = int(os.environ.get("ASYNC_THREAD_POOL_SIZE", "8"))
+# Threads serving the sync Flask routes
+WSGI_THREADS = int(os.environ.get("WSGI_THREADS", "4"))
+MAX_BODY_SIZE = 64 * 1024
+
+flask_application = WSGIMiddleware(app, workers=WSGI_THREADS)
+
+
+class _BadRequest(Exception):
+    def __init__(self, status: int, message: str, headers: Optional[list] = None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers or []
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] == 'http' and scope['method'] == 'POST':
+        handler = _CHAT_ROUTES.get(scope['path'])
+        if handler is not None:
+            await handler(scope, receive, send)
+            return
+    await flask_application(scope, receive, send)
+
+
+async def chat(scope, receive, send):
+    """Async /api/chat: same request and response as the Flask view"""
+    language = 'ru'
+    started = time.perf_counter()
+    status, result = 200, None
+    try:
+        user_message, language, agent_type = await _read_chat_request(receive)
+        _check_rate_limit(scope, language)
+        start_time = time.time()
+        timings = stage_timing.start()
+
+        router = initialize_agent_router()
+        result = await router.aroute_message(user_message, language, agent_type)
+        response_time = time.time() - start_time
+
+        # The query log converts the timings when it inserts the row, so 'db' is included
+        with stage_timing.stage('db'):
+            await run_in_thread(record_user_query, user_message, language, result, response_time,
+                                None, *_client_info(scope), timings)
+
+        logger.info(
+            f"Chat response generated in {response_time:.2f}s "
+            f"by {result.get('agent_name', 'Unknown')} agent (async)"
+        )
+        await _send_json(scope, send, 200, {
+            'response': result['response'],
+            'response_time': response_time,
+            'agent_name': result.get('agent_name'),
+            'agent_type': result.get('agent_type'),
+            'confidence': result.get('confidence', 0.0),
+            'response_source': result.get('response_source', 'llm')
+        }, [(b'server-timing', timings.server_timing().encode('latin-1'))])
+
+    except _BadRequest as e:
+        status = e.status
+        await _send_json(scope, send, e.status, {'error': e.message}, e.headers)
+    except Exception as e:
+        status = 500
+        logger.error(f"Error in async chat endpoint: {str(e)}")
+        await _send_json(scope, send, 500, {'error': _error_message(language)})
+    finally:
+        stage_timing.finish()
+        _observe('/api/chat', status, started, result, language)
+
+
+async def chat_stream(scope, receive, send):
+    """Async /api/chat/stream: same Server-Sent Events as the Flask view"""
+    started = time.perf_counter()
+    try:
+        user_message, language, agent_type = await _read_chat_request(receive)
+        _check_rate_limit(scope, language)
+    except _BadRequest as e:
+        await _send_json(scope, send, e.status, {'error': e.message}, e.headers)
+        _observe('/api/chat/stream', e.status, started, None, 'ru')
+        return
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ] + _cors_headers(scope),
+    })
+
+    start_time = time.time()
+    first_token_time = None
+    timings = stage_timing.start()
+    result = None
+    try:
+        router = initialize_agent_router()
+        stream = router.astream_message(user_message, language, agent_type)
+        async for piece in stream:
+            if first_token_time is None:
+                first_token_time = time.time() - start_time
+            await _send_event(send, 'token', {'text': piece})
+
+        result = stream.result
+        response_time = time.time() - start_time
+        await run_in_thread(record_user_query, user_message, language, result, response_time,
+                            first_token_time, *_client_info(scope), timings.as_ms())
+
+        await _send_event(send, 'done', {
+            'response_time': response_time,
+            'first_token_time': first_token_time,
+            'agent_name': result.get('agent_name'),
+            'agent_type': result.get('agent_type'),
+            'confidence': result.get('confidence', 0.0),
+            'response_source': result.get('response_source', 'llm')
+        })
+
+    except Exception as e:
+        logger.error(f"Error in async chat stream endpoint: {str(e)}")
+        await _send_event(send, 'error', {'error': _error_message(language)})
+    finally:
+        stage_timing.finish(timings)
+
+    await send({'type': 'http.response.body', 'body': b''})
+    _observe('/api/chat/stream', 200, started, result, language)
+
+
+_CHAT_ROUTES = {
+    '/api/chat': chat,
+    '/api/chat/stream': chat_stream,
+}
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # asyncio.to_thread uses the loop's default executor
+            asyncio.get_running_loop().set_default_executor(
+                ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE, thread_name_prefix='chat-io')
+            )
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_async_mistral_client()
+            if query_log.query_log is not None:
+                # Queued chat records are written before the worker exits
+                await asyncio.to_thread(query_log.query_log.close)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def _read_chat_request(receive) -> Tuple[str, str, Optional[str]]:
+    """(message, language, agent_type) from the JSON body, validated like the Flask view"""
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise _BadRequest(400, 'Сообщение не найдено')
+        body += message.get('body', b'')
+        if len(body) > MAX_BODY_SIZE:
+            raise _BadRequest(413, 'Сообщение слишком длинное')
+        if not message.get('more_body'):
+            break
+
+    try:
+        data = json.loads(body) if body else None
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or 'message' not in data:
+        raise _BadRequest(400, 'Сообщение не найдено')
+
+    user_message = str(data['message']).strip()
+    if not user_message:
+        raise _BadRequest(400, 'Пустое сообщение')
+    return user_message, data.get('language', 'ru'), data.get('agent_type')
+
+
+def _check_rate_limit(scope, language: str):
+    """Raise a 429 when the client ran out of its request tokens"""
+    retry_after = check_rate_limit(_client_address(scope))
+    if retry_after is not None:
+        raise _BadRequest(429, rate_limit_message(language),
+                          [(b'retry-after', str(max(int(retry_after + 0.999), 1)).encode())])
+
+
+def _observe(endpoint: str, status: int, started: float, result: Optional[dict], language: str):
+    """Request metrics of an async chat (the Flask routes are recorded by metrics.init_app)"""
+    if result is not None:
+        metrics.observe_chat(result)
+    metrics.observe_request(endpoint, status, time.perf_counter() - started,
+                            result.get('agent_type') if result else None, language)
+
+
+def _client_info(scope) -> Tuple[str, Optional[str], str]:
+    """(session id, client address, user agent) as stored on UserQuery"""
+    return '', _client_address(scope), _header(scope, b'user-agent') or ''
+
+
+def _client_address(scope) -> Optional[str]:
+    """Client address behind TRUSTED_PROXIES proxies, read like ProxyFix(x_for=...) does"""
+    forwarded = _header(scope, b'x-forwarded-for')
+    if TRUSTED_PROXIES and forwarded:
+        addresses = [address.strip() for address in forwarded.split(',')]
+        if len(addresses) >= TRUSTED_PROXIES:
+            return addresses[-TRUSTED_PROXIES]
+    client = scope.get('client')
+    return client[0] if client else None
+
+
+def _header(scope, name: bytes) -> Optional[str]:
+    for key, value in scope.get('headers', ()):
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def _cors_headers(scope) -> list:
+    """CORS headers for the allowed origins (wildcards as in CORS_ORIGINS)"""
+    origin = _header(scope, b'origin')
+    if not origin or not any(fnmatch(origin.lower(), pattern) for pattern in CORS_ORIGINS):
+        return []
+    return [
+        (b'access-control-allow-origin', origin.encode('latin-1')),
+        (b'access-control-allow-credentials', b'true'),
+        (b'vary', b'Origin'),
+    ]
+
+
+def _error_message(language: str) -> str:
+    if language == 'kz':
+        return "Кешіріңіз, қате орын алды. Қайталап көріңіз."
+    return "Извините, произошла ошибка. Попробуйте еще раз."
+
+
+async def _send_json(scope, send, status: int, data: dict, headers: Optional[list] = None):
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+        ] + (headers or []) + _cors_headers(scope),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _send_event(send, event: str, data: dict):
+    chunk = f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
@@ -0,0 +1,147 @@
+import logging
+import re
+from typing import List, Optional, Set
+
+from text_processing import normalize_text
+
+logger = logging.getLogger(__name__)
+
+# Sentence end followed by whitespace, or a line break
+_SENTENCE_RE = re.compile(r'(?<=[.!?…])\s+|\n+')
+# Largest overlap looked for between neighbouring chunks (chunk_text uses 100 chars)
+MAX_OVERLAP = 300
+MIN_OVERLAP = 20
+# Sentences at least this similar (word-set Jaccard) to an earlier one are dropped
+NEAR_DUPLICATE_SIMILARITY = 0.9
+NEAR_DUPLICATE_MIN_WORDS = 5
+# Do not bother with a truncated passage smaller than this
+MIN_PASSAGE_TOKENS = 30
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count; Cyrillic text averages about 3 characters per token"""
+    return len(text) // 3 + 1
+
+
+def merge_overlapping(first: str, second: str) -> str:
+    """Join two consecutive chunks, dropping the text they share"""
+    tail = first[-MAX_OVERLAP:]
+    probe = second[:MIN_OVERLAP]
+    position = tail.find(probe)
+    while position != -1:
+        shared = tail[position:]
+        if second.startswith(shared):
+            return first + second[len(shared):]
+        position = tail.find(probe, position + 1)
+    return f"{first}\n{second}"
+
+
+class _Passage:
+    """A run of consecutive chunks from one source"""
+
+    def __init__(self, label: str, source: tuple, chunk_index: Optional[int], text: str):
+        self.label = label
+        self.source = source
+        self.first_index = chunk_index
+        self.last_index = chunk_index
+        self.text = text
+
+
+def _merge_chunks(entries: list) -> List[_Passage]:
+    """Merge knowledge base hits that are neighbours in the same source, keeping rank order"""
+    passages: List[_Passage] = []
+    for entry in entries:
+        label = "Документ" if entry.source_type == 'document' else "Веб-сайт"
+        source = (entry.source_type, entry.source_id)
+        chunk_index = (entry.extra_data or {}).get('chunk_index')
+        passages.append(_Passage(label, source, chunk_index, entry.content_chunk))
+
+    merged = True
+    while merged:
+        merged = False
+        for i, passage in enumerate(passages):
+            if passage.first_index is None:
+                continue
+            for j, other in enumerate(passages):
+                if other.source != passage.source or other.first_index != passage.last_index + 1:
+                    continue
+                passage.text = merge_overlapping(passage.text, other.text)
+                passage.last_index = other.last_index
+                # The merged passage keeps the better rank of the two
+                passages[min(i, j)] = passage
+                del passages[max(i, j)]
+                merged = True
+                break
+            if merged:
+                break
+    return passages
+
+
+class _SentenceFilter:
+    """Drops sentences that already appeared (exactly or nearly) earlier in the context"""
+
+    def __init__(self):
+        self.seen: Set[str] = set()
+        self.word_sets: List[frozenset] = []
+
+    def is_new(self, sentence: str) -> bool:
+        key = normalize_text(sentence)
+        if not key or key in self.seen:
+            return False
+        words = frozenset(key.split())
+        if len(words) >= NEAR_DUPLICATE_MIN_WORDS:
+            for other in self.word_sets:
+                if len(words & other) / len(words | other) >= NEAR_DUPLICATE_SIMILARITY:
+                    return False
+            self.word_sets.append(words)
+        self.seen.add(key)
+        return True
+
+    def filter(self, text: str) -> List[str]:
+        return [sentence for sentence in _SENTENCE_RE.split(text)
+                if sentence.strip() and self.is_new(sentence.strip())]
+
+
+def assemble_context(faqs: list, entries: list, language: str = "ru", token_budget: int = 1000) -> str:
+    """Build the LLM context from ranked FAQ and knowledge base hits within a token budget
+
+    FAQs come first, then knowledge base passages in rank order. Neighbouring
+    chunks of one source are merged without their overlap, repeated sentences
+    are removed, and the text stops once the budget is used up.
+    """
+    parts: List[str] = []
+    remaining = token_budget
+    sentences = _SentenceFilter()
+
+    for faq in faqs:
+        if language == 'kz':
+            part = f"FAQ - С: {faq.question_kz}\nЖ: {faq.answer_kz}"
+            answer = faq.answer_kz
+        else:
+            part = f"FAQ - В: {faq.question_ru}\nО: {faq.answer_ru}"
+            answer = faq.answer_ru
+        cost = estimate_tokens(part)
+        if cost > remaining:
+            break
+        sentences.filter(answer)
+        parts.append(part)
+        remaining -= cost
+
+    for passage in _merge_chunks(entries):
+        if remaining < MIN_PASSAGE_TOKENS:
+            break
+        prefix = f"{passage.label} - "
+        kept: List[str] = []
+        cost = estimate_tokens(prefix)
+        for sentence in sentences.filter(passage.text):
+            sentence_cost = estimate_tokens(sentence) + 1
+            if cost + sentence_cost > remaining:
+                break
+            kept.append(sentence.strip())
+            cost += sentence_cost
+        if kept:
+            parts.append(prefix + " ".join(kept))
+            remaining -= cost
+
+    logger.debug(f"Context assembled: {len(parts)} parts, ~{token_budget - remaining} tokens")
+    return "\n\n".join(parts)
@@ -1,20 +1,145 @@
+import codecs
+import hashlib
+import io
+import json
 import os
 import logging
 import mimetypes
-from typing import Optional, List, Dict
+from functools import wraps
+from typing import Callable, Optional, List, Dict, Iterable, Iterator, Tuple
 import trafilatura
 import requests
 from datetime import datetime
+import search_index
+import embedding_store
+import extraction
+from metrics import INGESTION_CHUNKS, INGESTION_JOBS
+from text_processing import chunk_terms
 
 logger = logging.getLogger(__name__)
 
+# Knowledge base rows per executemany INSERT / COPY batch during ingestion
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", "1000"))
+# Characters of a streamed text file kept in Document.content_text (the chunks cover the whole file)
+CONTENT_TEXT_LIMIT = int(os.environ.get("INGEST_CONTENT_TEXT_LIMIT", "1000000"))
+# Characters read from a text file at a time
+TEXT_READ_BLOCK = 64 * 1024
+# Columns written by COPY (the model defaults are filled in by _copy_chunks)
+COPY_COLUMNS = ('source_type', 'source_id', 'content_chunk', 'chunk_hash', 'language',
+                'search_tokens', 'extra_data', 'is_active', 'created_at', 'updated_at')
+
+def content_hash(text: Optional[str]) -> str:
+    """SHA-256 of a text, used to detect unchanged sources and chunks"""
+    return hashlib.sha256((text or '').encode('utf-8')).hexdigest()
+
+def iter_chunks(pieces: Iterable[str], chunk_size: int = 1000, overlap: int = 100) -> Iterator[str]:
+    """Split a text, given as consecutive pieces, into knowledge base chunks
+
+    A chunk ends at the last sentence end or newline of its window if that
+    lies far enough in (otherwise after chunk_size characters) and the next
+    one starts `overlap` characters earlier. Only the unconsumed tail of the
+    text is buffered, so memory is bounded by the piece and chunk size.
+    The boundaries are exactly those of the original in-memory chunker, so
+    unchanged documents keep their chunk hashes.
+    """
+    buffer = ''
+    # Position of buffer[0] in the whole text
+    offset = 0
+    emitted = False
+    for piece in pieces:
+        buffer += piece
+        start = 0
+        while len(buffer) - start > chunk_size:
+            end = start + chunk_size
+            # Try to find a good break point (sentence end)
+            break_point = max(buffer.rfind('.', start, end), buffer.rfind('\n', start, end)) - start
+            # The break point is relative to the window but compared with the chunk's
+            # position in the text, as the original chunker did: only chunks starting
+            # in the first chunk_size // 2 characters end at a sentence
+            if break_point > offset + start + chunk_size // 2:
+                chunk = buffer[start:start + break_point + 1]
+                start = start + break_point + 1 - overlap
+            else:
+                chunk = buffer[start:end]
+                start = end - overlap
+            emitted = True
+            chunk = chunk.strip()
+            if chunk:
+                yield chunk
+        buffer = buffer[start:]
+        offset += start
+    if not emitted:
+        # A text that fits into one chunk is kept as it is
+        if buffer:
+            yield buffer
+        return
+    chunk = buffer.strip()
+    if chunk:
+        yield chunk
+
+class _TextScan:
+    """Hash, chunk count and leading characters of a text, taken while it streams past"""
+    
+    def __init__(self, keep: int = CONTENT_TEXT_LIMIT):
+        self.keep = keep
+        self.head: List[str] = []
+        self.head_length = 0
+        self.chunk_count = 0
+        self._hash = hashlib.sha256()
+    
+    def watch(self, pieces: Iterable[str]) -> Iterator[str]:
+        for piece in pieces:
+            self._hash.update(piece.encode('utf-8'))
+            if self.head_length < self.keep:
+                self.head.append(piece[:self.keep - self.head_length])
+                self.head_length += len(self.head[-1])
+            yield piece
+    
+    def run(self, pieces: Iterable[str]) -> '_TextScan':
+        for _ in iter_chunks(self.watch(pieces)):
+            self.chunk_count += 1
+        return self
+    
+    @property
+    def text_hash(self) -> str:
+        """Same value as content_hash() of the whole text"""
+        return self._hash.hexdigest()
+    
+    @property
+    def text(self) -> str:
+        return ''.join(self.head)
+
+def _copy_value(value) -> str:
+    """A value in PostgreSQL COPY text format"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value, ensure_ascii=False)
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+def _copy_chunks(connection, rows: List[Dict]):
+    """COPY knowledge base rows into PostgreSQL through the connection's psycopg2 cursor"""
+    now = datetime.utcnow()
+    buffer = io.StringIO()
+    for row in rows:
+        values = dict(row, is_active=True, created_at=now, updated_at=now)
+        buffer.write('\t'.join(_copy_value(values.get(column)) for column in COPY_COLUMNS))
+        buffer.write('\n')
+    buffer.seek(0)
+    with connection.connection.cursor() as cursor:
+        cursor.copy_expert(f"COPY knowledge_base ({', '.join(COPY_COLUMNS)}) FROM STDIN", buffer)
+
 class DocumentProcessor:
     """Processor for extracting text content from documents"""
     
     SUPPORTED_TYPES = {
         'text/plain': '.txt',
         'application/pdf': '.pdf',
-        'application/msword': '.doc',
         'application/vnd.openxmlformats-officedocument.wordprocessingml.document': '.docx',
         'text/html': '.html'
     }
@@ -23,18 +148,37 @@ class DocumentProcessor:
         self.upload_folder = upload_folder
         os.makedirs(upload_folder, exist_ok=True)
     
+    def detect_encoding(self, file_path: str) -> str:
+        """utf-8 if the whole file decodes as UTF-8, otherwise cp1251 (read block by block)"""
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        try:
+            with open(file_path, 'rb') as f:
+                while True:
+                    block = f.read(TEXT_READ_BLOCK)
+                    if not block:
+                        decoder.decode(b'', final=True)
+                        return 'utf-8'
+                    decoder.decode(block)
+        except UnicodeDecodeError:
+            return 'cp1251'
+    
+    def iter_text_file(self, file_path: str) -> Iterator[str]:
+        """Text of a text file in blocks of TEXT_READ_BLOCK characters"""
+        encoding = self.detect_encoding(file_path)
+        with open(file_path, 'r', encoding=encoding) as f:
+            while True:
+                block = f.read(TEXT_READ_BLOCK)
+                if not block:
+                    return
+                yield block
+    
     def process_text_file(self, file_path: str) -> str:
         """Extract text from text files"""
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read()
-        except UnicodeDecodeError:
-            try:
-                with open(file_path, 'r', encoding='cp1251') as f:
-                    return f.read()
-            except Exception as e:
-                logger.error(f"Error reading text file {file_path}: {str(e)}")
-                return ""
+            return ''.join(self.iter_text_file(file_path))
+        except Exception as e:
+            logger.error(f"Error reading text file {file_path}: {str(e)}")
+            return ""
     
     def process_html_file(self, file_path: str) -> str:
         """Extract text from HTML files"""
@@ -46,28 +190,48 @@ class DocumentProcessor:
             logger.error(f"Error processing HTML file {file_path}: {str(e)}")
             return ""
     
-    def process_pdf_file(self, file_path: str) -> str:
-        """Extract text from PDF files (basic implementation)"""
+    def process_pdf_file(self, file_path: str, progress: Optional[Callable[[int, int], None]] = None) -> str:
+        """Extract text from PDF files (in a separate process, see extraction.py)"""
         try:
-            # For now, return placeholder - would need PyPDF2 or similar
-            logger.warning("PDF processing not fully implemented")
-            return f"[PDF файл: {os.path.basename(file_path)}] - содержимое требует дополнительной обработки"
+            return extraction.extract_text(file_path, extraction.PDF, progress)
         except Exception as e:
+            # Not an empty text: the caller must not mark the document as processed
             logger.error(f"Error processing PDF file {file_path}: {str(e)}")
-            return ""
+            raise extraction.ExtractionError(str(e)) from e
+    
+    def process_docx_file(self, file_path: str, progress: Optional[Callable[[int, int], None]] = None) -> str:
+        """Extract text from DOCX files (in a separate process, see extraction.py)"""
+        try:
+            return extraction.extract_text(file_path, extraction.DOCX, progress)
+        except Exception as e:
+            # Not an empty text: the caller must not mark the document as processed
+            logger.error(f"Error processing DOCX file {file_path}: {str(e)}")
+            raise extraction.ExtractionError(str(e)) from e
     
-    def process_document(self, file_path: str, file_type: str) -> str:
-        """Process document and extract text content"""
+    def process_document(self, file_path: str, file_type: str,
+                         progress: Optional[Callable[[int, int], None]] = None) -> str:
+        """Process document and extract text content
+        
+        progress(page, total_pages) is called while PDF and DOCX files are parsed.
+        Raises extraction.ExtractionError when a PDF or DOCX file cannot be parsed
+        and extraction.UnsupportedFileType for types without an extractor.
+        """
         try:
             if file_type == 'text/plain':
                 return self.process_text_file(file_path)
             elif file_type == 'text/html':
                 return self.process_html_file(file_path)
             elif file_type == 'application/pdf':
-                return self.process_pdf_file(file_path)
+                return self.process_pdf_file(file_path, progress)
+            elif file_type == extraction.DOCX:
+                return self.process_docx_file(file_path, progress)
+            elif file_type == 'application/msword':
+                # Legacy binary .doc has no pure-Python parser; it has to be saved as .docx
+                raise extraction.UnsupportedFileType("Legacy .doc files are not supported, save the file as .docx")
             else:
-                logger.warning(f"Unsupported file type: {file_type}")
-                return f"[Неподдерживаемый тип файла: {file_type}]"
+                raise extraction.UnsupportedFileType(f"Unsupported file type: {file_type}")
+        except extraction.ExtractionError:
+            raise
         except Exception as e:
             logger.error(f"Error processing document {file_path}: {str(e)}")
             return ""
@@ -85,32 +249,7 @@ class DocumentProcessor:
     
     def chunk_text(self, text: str, chunk_size: int = 1000, overlap: int = 100) -> List[str]:
         """Split text into chunks for knowledge base"""
-        if not text or len(text) <= chunk_size:
-            return [text] if text else []
-        
-        chunks = []
-        start = 0
-        
-        while start < len(text):
-            end = start + chunk_size
-            if end >= len(text):
-                chunks.append(text[start:])
-                break
-            
-            # Try to find a good break point (sentence end)
-            chunk = text[start:end]
-            last_period = chunk.rfind('.')
-            last_newline = chunk.rfind('\n')
-            break_point = max(last_period, last_newline)
-            
-            if break_point > start + chunk_size // 2:
-                chunks.append(text[start:start + break_point + 1])
-                start = start + break_point + 1 - overlap
-            else:
-                chunks.append(chunk)
-                start = end - overlap
-        
-        return [chunk.strip() for chunk in chunks if chunk.strip()]
+        return list(iter_chunks([text] if text else [], chunk_size, overlap))
 
 class WebScraper:
     """Scraper for extracting content from web sources"""
@@ -154,6 +293,20 @@ class WebScraper:
             logger.error(f"URL validation failed for {url}: {str(e)}")
             return False
 
+def _count_update(source_type: str):
+    """Count knowledge base updates (True/False result, an exception is a failure) for /metrics"""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            success = False
+            try:
+                success = method(*args, **kwargs)
+                return success
+            finally:
+                INGESTION_JOBS.inc(source_type=source_type, status='success' if success else 'failure')
+        return wrapper
+    return decorator
+
 class KnowledgeBaseUpdater:
     """Updates knowledge base from various sources"""
     
@@ -165,50 +318,65 @@ class KnowledgeBaseUpdater:
         self.document_processor = DocumentProcessor()
         self.web_scraper = WebScraper()
     
-    def update_from_document(self, document_id: int) -> bool:
-        """Update knowledge base from document"""
+    @_count_update('document')
+    def update_from_document(self, document_id: int,
+                             progress: Optional[Callable[[int, int], None]] = None) -> bool:
+        """Update knowledge base from document
+        
+        progress(page, total_pages) reports PDF/DOCX extraction. A failed
+        extraction leaves the document unprocessed and raises ExtractionError,
+        so the ingestion job records the reason and retries.
+        """
         try:
             document = self.Document.query.get(document_id)
             if not document:
                 logger.error(f"Document {document_id} not found")
                 return False
             
-            # Process document if not already processed
-            if not document.is_processed:
-                text_content = self.document_processor.process_document(
-                    document.file_path, 
-                    mimetypes.guess_type(document.filename)[0] or 'text/plain'
-                )
-                document.content_text = text_content
+            file_type = mimetypes.guess_type(document.filename)[0] or 'text/plain'
+            if file_type == 'text/plain' and os.path.exists(document.file_path):
+                # Text files are streamed from disk: never held in memory as a whole
+                read_text = lambda: self.document_processor.iter_text_file(document.file_path)
+                scan = _TextScan().run(read_text())
+                document.content_text = scan.text
                 document.is_processed = True
-                self.db.session.commit()
-            
-            # Clear existing knowledge base entries for this document
-            self.KnowledgeBase.query.filter_by(
-                source_type='document', 
-                source_id=document_id
-            ).delete()
+            else:
+                # Process document if not already processed
+                if not document.is_processed:
+                    text_content = self.document_processor.process_document(document.file_path, file_type, progress)
+                    document.content_text = text_content
+                    document.is_processed = True
+                    self.db.session.commit()
+                read_text = lambda: [document.content_text] if document.content_text else []
+                scan = _TextScan().run(read_text())
             
-            # Create new chunks
-            chunks = self.document_processor.chunk_text(document.content_text)
-            for i, chunk in enumerate(chunks):
-                kb_entry = self.KnowledgeBase(
-                    source_type='document',
-                    source_id=document_id,
-                    content_chunk=chunk,
-                    extra_data={'chunk_index': i, 'total_chunks': len(chunks)}
-                )
-                self.db.session.add(kb_entry)
+            # Nothing to do when the text is the one the chunks were built from
+            if document.content_hash == scan.text_hash:
+                self.db.session.commit()
+                logger.info(f"Document {document_id} is unchanged, knowledge base left as is")
+                return True
             
+            added, deactivated = self._sync_chunks('document', document_id, iter_chunks(read_text()),
+                                                   scan.chunk_count)
+            if self._source_deleted(self.Document, document_id):
+                return False
+            document.content_hash = scan.text_hash
             self.db.session.commit()
-            logger.info(f"Updated knowledge base with {len(chunks)} chunks from document {document_id}")
+            self._content_changed(added, deactivated)
+            INGESTION_CHUNKS.inc(added, source_type='document')
+            logger.info(f"Updated knowledge base from document {document_id}: {scan.chunk_count} chunks, "
+                        f"{added} added, {deactivated} removed")
             return True
             
+        except extraction.ExtractionError:
+            self.db.session.rollback()
+            raise
         except Exception as e:
             logger.error(f"Error updating knowledge base from document {document_id}: {str(e)}")
             self.db.session.rollback()
             return False
     
+    @_count_update('web')
     def update_from_web_source(self, web_source_id: int) -> bool:
         """Update knowledge base from web source"""
         try:
@@ -223,29 +391,26 @@ class KnowledgeBaseUpdater:
                 logger.error(f"Failed to scrape content from {web_source.url}")
                 return False
             
+            text_hash = content_hash(text_content)
+            if web_source.content_hash == text_hash:
+                web_source.last_scraped = datetime.utcnow()
+                self.db.session.commit()
+                logger.info(f"Web source {web_source_id} is unchanged, knowledge base left as is")
+                return True
+            
+            chunks = self.document_processor.chunk_text(text_content)
+            added, deactivated = self._sync_chunks('web', web_source_id, chunks, len(chunks), {'url': web_source.url})
+            if self._source_deleted(self.WebSource, web_source_id):
+                return False
             # Update web source
             web_source.content_text = text_content
             web_source.last_scraped = datetime.utcnow()
-            
-            # Clear existing knowledge base entries for this web source
-            self.KnowledgeBase.query.filter_by(
-                source_type='web', 
-                source_id=web_source_id
-            ).delete()
-            
-            # Create new chunks
-            chunks = self.document_processor.chunk_text(text_content)
-            for i, chunk in enumerate(chunks):
-                kb_entry = self.KnowledgeBase(
-                    source_type='web',
-                    source_id=web_source_id,
-                    content_chunk=chunk,
-                    extra_data={'chunk_index': i, 'total_chunks': len(chunks), 'url': web_source.url}
-                )
-                self.db.session.add(kb_entry)
-            
+            web_source.content_hash = text_hash
             self.db.session.commit()
-            logger.info(f"Updated knowledge base with {len(chunks)} chunks from web source {web_source_id}")
+            self._content_changed(added, deactivated)
+            INGESTION_CHUNKS.inc(added, source_type='web')
+            logger.info(f"Updated knowledge base from web source {web_source_id}: {len(chunks)} chunks, "
+                        f"{added} added, {deactivated} removed")
             return True
             
         except Exception as e:
@@ -253,29 +418,125 @@ class KnowledgeBaseUpdater:
             self.db.session.rollback()
             return False
     
+    def _sync_chunks(self, source_type: str, source_id: int, chunks: Iterable[str], total_chunks: int,
+                     extra_data: Optional[Dict] = None) -> Tuple[int, int]:
+        """Make the source's knowledge base rows match `chunks`, touching only what changed
+        
+        Chunks whose hash already exists keep their row (a deactivated one is
+        reactivated); new chunks are inserted and rows whose chunk is gone are
+        deactivated. Returns (added, deactivated) where added counts inserted
+        and reactivated rows; the caller commits.
+        
+        `chunks` may be a generator: new rows are written every
+        INGEST_BATCH_SIZE chunks, the updates are a few bulk statements at the end.
+        """
+        from sqlalchemy import select, update
+        
+        KnowledgeBase = self.KnowledgeBase
+        rows = self.db.session.execute(
+            select(KnowledgeBase.id, KnowledgeBase.chunk_hash, KnowledgeBase.is_active, KnowledgeBase.extra_data)
+            .where(KnowledgeBase.source_type == source_type, KnowledgeBase.source_id == source_id)
+            .order_by(KnowledgeBase.is_active.desc(), KnowledgeBase.id)
+        ).all()
+        existing: Dict[str, List] = {}
+        for row in rows:
+            existing.setdefault(row.chunk_hash, []).append(row)
+        
+        new_rows = []
+        inserted = 0
+        reactivate_ids = []
+        metadata_updates = []
+        for i, chunk in enumerate(chunks):
+            chunk_hash = content_hash(chunk)
+            metadata = {'chunk_index': i, 'total_chunks': total_chunks, **(extra_data or {})}
+            matches = existing.get(chunk_hash)
+            if matches:
+                row = matches.pop(0)
+                if not row.is_active:
+                    reactivate_ids.append(row.id)
+                if row.extra_data != metadata:
+                    metadata_updates.append({'id': row.id, 'extra_data': metadata})
+                continue
+        
+            language, search_tokens = chunk_terms(chunk)
+            new_rows.append({
+                'source_type': source_type,
+                'source_id': source_id,
+                'content_chunk': chunk,
+                'chunk_hash': chunk_hash,
+                'language': language,
+                'search_tokens': search_tokens,
+                'extra_data': metadata
+            })
+            if len(new_rows) >= INGEST_BATCH_SIZE:
+                self._insert_chunks(new_rows)
+                inserted += len(new_rows)
+                new_rows = []
+        deactivate_ids = [row.id for leftovers in existing.values() for row in leftovers if row.is_active]
+        
+        session = self.db.session
+        if deactivate_ids:
+            session.execute(update(KnowledgeBase).where(KnowledgeBase.id.in_(deactivate_ids)).values(is_active=False))
+        if reactivate_ids:
+            session.execute(update(KnowledgeBase).where(KnowledgeBase.id.in_(reactivate_ids)).values(is_active=True))
+        if metadata_updates:
+            # ORM bulk UPDATE by primary key: one executemany
+            session.execute(update(KnowledgeBase), metadata_updates)
+        self._insert_chunks(new_rows)
+        inserted += len(new_rows)
+        return inserted + len(reactivate_ids), len(deactivate_ids)
+        
+    def _source_deleted(self, model, source_id: int) -> bool:
+        """True (and the new chunks rolled back) if the source was deleted during the update
+        
+        The row is locked until the commit (FOR UPDATE on PostgreSQL), so a
+        delete either happened before this check or deactivates the new chunks after it.
+        """
+        from sqlalchemy import select
+        
+        is_active = self.db.session.execute(
+            select(model.is_active).where(model.id == source_id).with_for_update()
+        ).scalar()
+        if is_active:
+            return False
+        self.db.session.rollback()
+        logger.info(f"{model.__name__} {source_id} was deleted during the update, chunks discarded")
+        return True
+    
+    def _insert_chunks(self, rows: List[Dict]):
+        """Insert knowledge base rows in batches, in the session's transaction
+        
+        PostgreSQL (psycopg2) gets COPY FROM STDIN, other databases one
+        multi-row INSERT (executemany) per batch.
+        """
+        from sqlalchemy import insert
+        
+        if not rows:
+            return
+        connection = self.db.session.connection()
+        use_copy = connection.dialect.name == 'postgresql' and connection.dialect.driver == 'psycopg2'
+        for start in range(0, len(rows), INGEST_BATCH_SIZE):
+            batch = rows[start:start + INGEST_BATCH_SIZE]
+            if use_copy:
+                _copy_chunks(connection, batch)
+            else:
+                connection.execute(insert(self.KnowledgeBase.__table__), batch)
+        
+    def _content_changed(self, added: int, deactivated: int):
+        """Rebuild search indexes and drop cached answers only if chunks were added or removed"""
+        if added or deactivated:
+            search_index.invalidate()
+            embedding_store.rebuild_if_enabled()
+    
     def get_relevant_content(self, query: str, language: str = 'ru', limit: int = 5) -> List[str]:
         """Get relevant content from knowledge base"""
         try:
-            query_lower = query.lower()
-            keywords = [word for word in query_lower.split() if len(word) > 2]
-            
-            if not keywords:
-                return []
-            
-            # Simple keyword matching - in production, use vector similarity
-            relevant_entries = []
-            
-            for keyword in keywords[:3]:  # Limit to first 3 keywords
-                entries = self.KnowledgeBase.query.filter(
-                    self.KnowledgeBase.is_active == True,
-                    self.KnowledgeBase.content_chunk.ilike(f'%{keyword}%')
-                ).limit(limit).all()
-                
-                for entry in entries:
-                    if entry not in relevant_entries:
-                        relevant_entries.append(entry)
+            # Import here to avoid circular imports
+            from utils import search_knowledge_base
             
-            return [entry.content_chunk for entry in relevant_entries[:limit]]
+            # Single ranked query through the configured retrieval backend
+            relevant_entries = search_knowledge_base(query, language, limit)
+            return [entry.content_chunk for entry in relevant_entries]
             
         except Exception as e:
             logger.error(f"Error getting relevant content: {str(e)}")
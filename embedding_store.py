@@ -0,0 +1,318 @@
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: rebuilds are not serialized across processes
+    fcntl = None
+
+from vector_search import DIMENSIONS, EmbeddingIndex, VectorIndex, embed_text
+
+logger = logging.getLogger(__name__)
+
+# Shared index file, written by ingestion and mapped read-only by every worker
+STORE_PATH = os.environ.get("EMBEDDING_STORE_PATH", os.path.join("data", "embeddings.idx"))
+# How often (seconds) a worker stats the file to notice a newer generation
+CHECK_INTERVAL = float(os.environ.get("EMBEDDING_STORE_CHECK_SECONDS", "2"))
+# Seconds before a failed background build of a missing store is attempted again
+RETRY_INTERVAL = float(os.environ.get("EMBEDDING_STORE_RETRY_SECONDS", "300"))
+
+MAGIC = b"BLSKEMB\0"
+FORMAT_VERSION = 1
+
+# Row kinds; rows are stored grouped by kind so each group is one contiguous slice
+KIND_KB = 0
+KIND_FAQ_RU = 1
+KIND_FAQ_KZ = 2
+KINDS = (KIND_KB, KIND_FAQ_RU, KIND_FAQ_KZ)
+
+# magic, format version, dimensions, generation, row count,
+# ids offset, vectors offset, then (start, end) row range for each kind
+_HEADER = struct.Struct("<8sIIQQQQ" + "QQ" * len(KINDS))
+HEADER_SIZE = 128
+# Vectors start on a cache-line boundary
+_ALIGNMENT = 64
+
+
+class EmbeddingStore:
+    """Read-only memory-mapped view of an embedding index file
+
+    File layout (little endian):
+        header    HEADER_SIZE bytes, see _HEADER
+        ids       int64[row count]
+        vectors   float32[row count, dimensions], 64-byte aligned
+    """
+
+    def __init__(self, path: str, file_id: tuple, mapping: mmap.mmap):
+        self.path = path
+        self.file_id = file_id
+        self._mmap = mapping
+
+        header = _HEADER.unpack_from(mapping, 0)
+        magic, version, dimensions, generation, count, ids_offset, vectors_offset = header[:7]
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not an embedding store")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported embedding store version {version}")
+
+        self.dimensions = dimensions
+        self.generation = generation
+        self.ids = np.frombuffer(mapping, dtype=np.int64, count=count, offset=ids_offset)
+        self.vectors = np.frombuffer(
+            mapping, dtype=np.float32, count=count * dimensions, offset=vectors_offset
+        ).reshape(count, dimensions)
+        ranges = header[7:]
+        self.ranges: Dict[int, tuple] = {
+            kind: (ranges[2 * i], ranges[2 * i + 1]) for i, kind in enumerate(KINDS)
+        }
+
+    @classmethod
+    def open(cls, path: str) -> 'EmbeddingStore':
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(path, _file_id(stat), mapping)
+
+    def section(self, kind: int) -> VectorIndex:
+        """Zero-copy VectorIndex over one kind of rows"""
+        start, end = self.ranges[kind]
+        return VectorIndex(self.ids[start:end], self.vectors[start:end])
+
+    def to_index(self) -> EmbeddingIndex:
+        faq = {'ru': self.section(KIND_FAQ_RU), 'kz': self.section(KIND_FAQ_KZ)}
+        return EmbeddingIndex(faq, self.section(KIND_KB))
+
+
+def _file_id(stat: os.stat_result) -> tuple:
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def write_store(path: str, sections: Dict[int, VectorIndex], generation: int):
+    """Atomically write a new store file (readers keep their old mapping until they remap)"""
+    count = sum(len(sections[kind]) for kind in KINDS)
+    ids_offset = HEADER_SIZE
+    vectors_offset = ids_offset + count * 8
+    vectors_offset += -vectors_offset % _ALIGNMENT
+
+    ranges = []
+    start = 0
+    for kind in KINDS:
+        ranges.extend((start, start + len(sections[kind])))
+        start += len(sections[kind])
+
+    header = _HEADER.pack(
+        MAGIC, FORMAT_VERSION, DIMENSIONS, generation, count, ids_offset, vectors_offset, *ranges
+    )
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.embeddings-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header.ljust(HEADER_SIZE, b'\0'))
+            for kind in KINDS:
+                np.ascontiguousarray(sections[kind].ids, dtype=np.int64).tofile(f)
+            f.write(b'\0' * (vectors_offset - f.tell()))
+            for kind in KINDS:
+                np.ascontiguousarray(sections[kind].matrix, dtype=np.float32).tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+    logger.info(f"Embedding store generation {generation} written: {count} rows -> {path}")
+
+
+def rebuild(path: str = STORE_PATH) -> int:
+    """Re-embed changed content and write the next store generation
+
+    Knowledge base chunks are never edited in place, so vectors of chunks that
+    are still active are copied from the previous generation; only new chunks
+    and the (small) FAQ table are embedded again.
+    """
+    from app import db
+    from models import FAQ, KnowledgeBase
+
+    previous = _open_if_compatible(path)
+    generation = previous.generation + 1 if previous else 1
+
+    active_ids = np.fromiter(
+        (row_id for row_id, in db.session.query(KnowledgeBase.id).filter(
+            KnowledgeBase.is_active == True
+        ).order_by(KnowledgeBase.id)),
+        dtype=np.int64,
+    )
+    kb_matrix = np.empty((len(active_ids), DIMENSIONS), dtype=np.float32)
+
+    missing = np.ones(len(active_ids), dtype=bool)
+    if previous is not None:
+        old = previous.section(KIND_KB)
+        order = np.argsort(old.ids)
+        positions = np.searchsorted(old.ids, active_ids, sorter=order)
+        positions = np.clip(positions, 0, max(len(order) - 1, 0))
+        if len(order):
+            found = old.ids[order[positions]] == active_ids
+            kb_matrix[found] = old.matrix[order[positions[found]]]
+            missing = ~found
+
+    missing_ids = active_ids[missing].tolist()
+    position_by_id = {int(row_id): position for position, row_id in enumerate(active_ids)}
+    for start in range(0, len(missing_ids), 500):
+        batch = missing_ids[start:start + 500]
+        rows = db.session.query(KnowledgeBase.id, KnowledgeBase.content_chunk).filter(
+            KnowledgeBase.id.in_(batch)
+        )
+        for row_id, content_chunk in rows:
+            kb_matrix[position_by_id[row_id]] = embed_text(content_chunk)
+
+    faq_rows = db.session.query(
+        FAQ.id, FAQ.question_ru, FAQ.answer_ru, FAQ.question_kz, FAQ.answer_kz
+    ).filter(FAQ.is_active == True).all()
+    sections = {
+        KIND_KB: VectorIndex(active_ids, kb_matrix),
+        KIND_FAQ_RU: VectorIndex.from_texts([(row[0], f"{row[1]} {row[1]} {row[2]}") for row in faq_rows]),
+        KIND_FAQ_KZ: VectorIndex.from_texts([(row[0], f"{row[3]} {row[3]} {row[4]}") for row in faq_rows]),
+    }
+    write_store(path, sections, generation)
+    logger.info(f"Embedded {len(missing_ids)} new chunks, reused {len(active_ids) - len(missing_ids)}")
+    return generation
+
+
+@contextmanager
+def _rebuild_lock(path: str, blocking: bool = True) -> Iterator[bool]:
+    """flock serializing store writers across processes; yields False if busy and not blocking"""
+    if fcntl is None:
+        yield True
+        return
+    lock_path = path + '.lock'
+    os.makedirs(os.path.dirname(os.path.abspath(lock_path)), exist_ok=True)
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def rebuild_if_enabled(raise_errors: bool = False):
+    """Refresh the shared store after an ingestion when the vector backend is in use
+
+    Called by the ingestion worker; concurrent rebuilds are serialized, each
+    one reuses the vectors written by the previous.
+    """
+    from flask import current_app
+
+    if current_app.config.get("RETRIEVAL_BACKEND") != "vector":
+        return
+    try:
+        with _rebuild_lock(STORE_PATH):
+            rebuild()
+    except Exception as e:
+        logger.error(f"Error rebuilding embedding store: {str(e)}")
+        if raise_errors:
+            raise
+
+
+_build_thread: Optional[threading.Thread] = None
+_build_failed_at: Optional[float] = None
+_build_lock = threading.Lock()
+
+
+def build_in_background():
+    """Start writing a missing store without blocking the caller (a chat request)
+
+    One thread per process at a time, and one process at a time through the
+    file lock; after a failure nothing is attempted for RETRY_INTERVAL, so
+    requests go straight to BM25 results meanwhile.
+    """
+    from flask import current_app
+    global _build_thread
+
+    with _build_lock:
+        if _build_thread is not None and _build_thread.is_alive():
+            return
+        if _build_failed_at is not None and time.monotonic() - _build_failed_at < RETRY_INTERVAL:
+            return
+        _build_thread = threading.Thread(target=_build_missing, args=(current_app._get_current_object(),),
+                                         name='embedding-store-build', daemon=True)
+        _build_thread.start()
+
+
+def _build_missing(app):
+    global _build_failed_at
+
+    try:
+        with app.app_context(), _rebuild_lock(STORE_PATH, blocking=False) as acquired:
+            # Busy lock: another process is writing the store already
+            if acquired and _open_if_compatible(STORE_PATH) is None:
+                rebuild()
+        _build_failed_at = None
+    except Exception as e:
+        _build_failed_at = time.monotonic()
+        logger.error(f"Error building embedding store, retrying in {RETRY_INTERVAL:.0f}s: {str(e)}")
+
+
+def _open_if_compatible(path: str) -> Optional[EmbeddingStore]:
+    """Open the store if it exists and matches the configured dimensions"""
+    try:
+        store = EmbeddingStore.open(path)
+    except FileNotFoundError:
+        return None
+    except (ValueError, struct.error) as e:
+        logger.warning(f"Ignoring embedding store {path}: {str(e)}")
+        return None
+    if store.dimensions != DIMENSIONS:
+        logger.warning(f"Ignoring embedding store {path}: built for {store.dimensions} dimensions")
+        return None
+    return store
+
+
+_store: Optional[EmbeddingStore] = None
+_store_index: Optional[EmbeddingIndex] = None
+_last_check = 0.0
+_lock = threading.Lock()
+
+
+def get_index(path: str = STORE_PATH, force: bool = False) -> Optional[EmbeddingIndex]:
+    """Index backed by the shared mapping, remapped when a newer generation appears"""
+    global _store, _store_index, _last_check
+
+    now = time.monotonic()
+    if not force and now - _last_check < CHECK_INTERVAL:
+        return _store_index
+
+    with _lock:
+        if not force and now - _last_check < CHECK_INTERVAL:
+            return _store_index
+        _last_check = now
+        try:
+            file_id = _file_id(os.stat(path))
+        except FileNotFoundError:
+            _store, _store_index = None, None
+            return None
+
+        if _store is None or file_id != _store.file_id:
+            store = _open_if_compatible(path)
+            if store is not None:
+                logger.info(f"Mapped embedding store generation {store.generation}")
+            _store = store
+            _store_index = store.to_index() if store is not None else None
+        return _store_index
@@ -0,0 +1,159 @@
+"""PDF and DOCX text extraction in child processes
+
+Every file is parsed in its own child process under CPU-time and memory
+limits and a wall-clock timeout, so a heavy or malicious document cannot
+hang or exhaust the calling worker. Pages are sent back as soon as they are
+parsed, which gives page-level progress and lets the chunker consume them
+as a stream. Up to EXTRACTION_PROCESSES files are parsed at the same time
+per worker process; further callers wait for a free slot.
+"""
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+from typing import Callable, Iterator, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # Windows: only the wall-clock timeout applies
+    resource = None
+
+# Time the extractor may take per file (spent waiting for its pages, not in the consumer)
+TIMEOUT = float(os.environ.get("EXTRACTION_TIMEOUT_SECONDS", "120"))
+# CPU seconds and address space of one extractor process
+CPU_SECONDS = int(os.environ.get("EXTRACTION_CPU_SECONDS", "60"))
+MEMORY_MB = int(os.environ.get("EXTRACTION_MEMORY_MB", "1024"))
+# Files extracted in parallel by one worker process
+PROCESSES = int(os.environ.get("EXTRACTION_PROCESSES", str(os.cpu_count() or 2)))
+# DOCX has no pages: paragraphs are sent (and reported) in sections of this size
+DOCX_SECTION_PARAGRAPHS = 200
+
+PDF = 'application/pdf'
+DOCX = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+SUPPORTED_TYPES = (PDF, DOCX)
+
+ProgressCallback = Callable[[int, int], None]
+
+_slots = threading.BoundedSemaphore(PROCESSES)
+
+
+class ExtractionError(Exception):
+    """The file could not be parsed: unreadable, too slow or over its resource limits"""
+
+
+class UnsupportedFileType(ExtractionError):
+    """The file type has no text extractor; retrying cannot help"""
+
+
+def _pdf_pages(file_path: str) -> Iterator[Tuple[int, str]]:
+    from pypdf import PdfReader
+
+    reader = PdfReader(file_path)
+    total = len(reader.pages)
+    for page in reader.pages:
+        yield total, page.extract_text() or ''
+
+
+def _docx_pages(file_path: str) -> Iterator[Tuple[int, str]]:
+    import docx
+
+    document = docx.Document(file_path)
+    lines = [paragraph.text for paragraph in document.paragraphs]
+    for table in document.tables:
+        for row in table.rows:
+            lines.append(' | '.join(cell.text for cell in row.cells))
+    total = max((len(lines) + DOCX_SECTION_PARAGRAPHS - 1) // DOCX_SECTION_PARAGRAPHS, 1)
+    for start in range(0, max(len(lines), 1), DOCX_SECTION_PARAGRAPHS):
+        yield total, '\n'.join(lines[start:start + DOCX_SECTION_PARAGRAPHS])
+
+
+def _limit_resources():
+    if resource is None:
+        return
+    # SIGXCPU ends the process once it used CPU_SECONDS
+    resource.setrlimit(resource.RLIMIT_CPU, (CPU_SECONDS, CPU_SECONDS + 1))
+    memory = MEMORY_MB * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+
+
+def _extract_main(file_type: str, file_path: str):
+    """Child process: one JSON line per page on stdout, then {"done": true} or {"error": message}"""
+    def send(message):
+        sys.stdout.write(json.dumps(message) + '\n')
+        sys.stdout.flush()
+
+    try:
+        _limit_resources()
+        pages = _pdf_pages if file_type == PDF else _docx_pages
+        for number, (total, text) in enumerate(pages(file_path), 1):
+            send({'page': number, 'total': total, 'text': text})
+        send({'done': True})
+    except BaseException as e:
+        send({'error': f"{type(e).__name__}: {e}"})
+
+
+def _read_lines(stream, lines: 'queue.Queue[Optional[bytes]]'):
+    for line in stream:
+        lines.put(line)
+    lines.put(None)
+
+
+def extract_pages(file_path: str, file_type: str, progress: Optional[ProgressCallback] = None,
+                  timeout: float = TIMEOUT) -> Iterator[str]:
+    """Text of a PDF or DOCX file page by page, parsed in a child process
+
+    progress(page_number, total_pages) is called for every page. Raises
+    ExtractionError when the file cannot be parsed within its limits.
+    """
+    if file_type not in SUPPORTED_TYPES:
+        raise UnsupportedFileType(f"Unsupported file type: {file_type}")
+
+    name = os.path.basename(file_path)
+    with _slots:
+        # A fresh interpreter running this file: nothing of the app (DB connections,
+        # threads, the Flask app itself) is forked or re-imported into the parser
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), file_type, file_path],
+                                   stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        lines: 'queue.Queue[Optional[bytes]]' = queue.Queue()
+        threading.Thread(target=_read_lines, args=(process.stdout, lines), daemon=True).start()
+        remaining = timeout
+        try:
+            while True:
+                waited_from = time.monotonic()
+                try:
+                    line = lines.get(timeout=max(remaining, 0))
+                except queue.Empty:
+                    raise ExtractionError(f"Extraction of {name} timed out after {timeout:.0f}s")
+                remaining -= time.monotonic() - waited_from
+                if line is None:
+                    process.wait(1)
+                    raise ExtractionError(f"Extractor of {name} exited with code {process.returncode} "
+                                          f"(resource limit exceeded?)")
+
+                message = json.loads(line)
+                if 'page' in message:
+                    if progress is not None:
+                        progress(message['page'], message['total'])
+                    yield message['text']
+                elif message.get('done'):
+                    return
+                else:
+                    raise ExtractionError(message['error'])
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            process.stdout.close()
+
+
+def extract_text(file_path: str, file_type: str, progress: Optional[ProgressCallback] = None,
+                 timeout: float = TIMEOUT) -> str:
+    """Whole text of a PDF or DOCX file (pages separated by blank lines)"""
+    return '\n\n'.join(page for page in extract_pages(file_path, file_type, progress, timeout) if page)
+
+
+if __name__ == '__main__':
+    _extract_main(sys.argv[1], sys.argv[2])
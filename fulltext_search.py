@@ -0,0 +1,178 @@
+import logging
+from typing import List
+
+from sqlalchemy import select, text
+
+from app import db
+from models import FAQ, KnowledgeBase
+from text_processing import query_terms, tokenize
+
+logger = logging.getLogger(__name__)
+
+# Text search configuration used for each chat language on PostgreSQL
+PG_CONFIGS = {'ru': 'russian', 'kz': 'simple'}
+
+_POSTGRES_SCHEMA = [
+    # Chunks may be in either language, so keep stemmed and raw lexemes side by side
+    """ALTER TABLE knowledge_base ADD COLUMN IF NOT EXISTS content_tsv tsvector
+       GENERATED ALWAYS AS (
+           to_tsvector('russian', coalesce(content_chunk, ''))
+           || to_tsvector('simple', coalesce(content_chunk, ''))
+       ) STORED""",
+    "CREATE INDEX IF NOT EXISTS ix_knowledge_base_content_tsv ON knowledge_base USING GIN (content_tsv)",
+    """ALTER TABLE faqs ADD COLUMN IF NOT EXISTS question_ru_tsv tsvector
+       GENERATED ALWAYS AS (to_tsvector('russian', coalesce(question_ru, ''))) STORED""",
+    "CREATE INDEX IF NOT EXISTS ix_faqs_question_ru_tsv ON faqs USING GIN (question_ru_tsv)",
+    """ALTER TABLE faqs ADD COLUMN IF NOT EXISTS question_kz_tsv tsvector
+       GENERATED ALWAYS AS (to_tsvector('simple', coalesce(question_kz, ''))) STORED""",
+    "CREATE INDEX IF NOT EXISTS ix_faqs_question_kz_tsv ON faqs USING GIN (question_kz_tsv)",
+]
+
+_SQLITE_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS knowledge_base_fts USING fts5(
+           content_chunk, content='knowledge_base', content_rowid='id',
+           tokenize='unicode61 remove_diacritics 0')""",
+    """CREATE TRIGGER IF NOT EXISTS knowledge_base_fts_ai AFTER INSERT ON knowledge_base BEGIN
+           INSERT INTO knowledge_base_fts(rowid, content_chunk) VALUES (new.id, new.content_chunk);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS knowledge_base_fts_ad AFTER DELETE ON knowledge_base BEGIN
+           INSERT INTO knowledge_base_fts(knowledge_base_fts, rowid, content_chunk)
+           VALUES ('delete', old.id, old.content_chunk);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS knowledge_base_fts_au AFTER UPDATE OF content_chunk ON knowledge_base BEGIN
+           INSERT INTO knowledge_base_fts(knowledge_base_fts, rowid, content_chunk)
+           VALUES ('delete', old.id, old.content_chunk);
+           INSERT INTO knowledge_base_fts(rowid, content_chunk) VALUES (new.id, new.content_chunk);
+       END""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS faqs_fts USING fts5(
+           question_ru, question_kz, content='faqs', content_rowid='id',
+           tokenize='unicode61 remove_diacritics 0')""",
+    """CREATE TRIGGER IF NOT EXISTS faqs_fts_ai AFTER INSERT ON faqs BEGIN
+           INSERT INTO faqs_fts(rowid, question_ru, question_kz)
+           VALUES (new.id, new.question_ru, new.question_kz);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS faqs_fts_ad AFTER DELETE ON faqs BEGIN
+           INSERT INTO faqs_fts(faqs_fts, rowid, question_ru, question_kz)
+           VALUES ('delete', old.id, old.question_ru, old.question_kz);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS faqs_fts_au AFTER UPDATE OF question_ru, question_kz ON faqs BEGIN
+           INSERT INTO faqs_fts(faqs_fts, rowid, question_ru, question_kz)
+           VALUES ('delete', old.id, old.question_ru, old.question_kz);
+           INSERT INTO faqs_fts(rowid, question_ru, question_kz)
+           VALUES (new.id, new.question_ru, new.question_kz);
+       END""",
+]
+
+
+def _columns(model) -> str:
+    """Explicit mapped column list, so tsvector columns are not selected"""
+    table = model.__tablename__
+    return ', '.join(f"{table}.{column.name}" for column in model.__table__.columns)
+
+
+def _dialect() -> str:
+    """Database dialect picked from DATABASE_URL ('postgresql' or 'sqlite')"""
+    return db.engine.dialect.name
+
+
+def ensure_fulltext_schema():
+    """Create full-text columns, indexes and sync triggers if they are missing"""
+    dialect = _dialect()
+    with db.engine.begin() as conn:
+        if dialect == 'postgresql':
+            for statement in _POSTGRES_SCHEMA:
+                conn.execute(text(statement))
+        elif dialect == 'sqlite':
+            existing = {row[0] for row in conn.execute(text(
+                "SELECT name FROM sqlite_master WHERE name IN ('knowledge_base_fts', 'faqs_fts')"
+            ))}
+            for statement in _SQLITE_SCHEMA:
+                conn.execute(text(statement))
+            # External content tables start empty, so index rows that already exist
+            if 'knowledge_base_fts' not in existing:
+                conn.execute(text("INSERT INTO knowledge_base_fts(knowledge_base_fts) VALUES ('rebuild')"))
+            if 'faqs_fts' not in existing:
+                conn.execute(text("INSERT INTO faqs_fts(faqs_fts) VALUES ('rebuild')"))
+        else:
+            logger.warning(f"Full-text search is not supported for dialect {dialect}")
+            return
+    logger.info(f"Full-text search schema ready ({dialect})")
+
+
+def _pg_tsquery(query: str, language: str) -> str:
+    """OR-query in to_tsquery syntax
+
+    The russian configuration stems on its own; Kazakh ('simple') gets our stems
+    with prefix matching instead.
+    """
+    if language == 'kz':
+        terms = [f"{term}:*" for term in query_terms(query, language)]
+    else:
+        terms = tokenize(query, language)
+    return ' | '.join(dict.fromkeys(terms))
+
+
+def _fts5_query(query: str, language: str) -> str:
+    """OR-query in FTS5 syntax: quoted stems with prefix matching"""
+    return ' OR '.join(f'"{term}"*' for term in dict.fromkeys(query_terms(query, language)))
+
+
+def search_faqs(query: str, language: str = 'ru', limit: int = 3) -> List[FAQ]:
+    """Ranked active FAQs whose question matches the query"""
+    dialect = _dialect()
+    if dialect == 'postgresql':
+        ts_query = _pg_tsquery(query, language)
+        if not ts_query:
+            return []
+        column = 'question_kz_tsv' if language == 'kz' else 'question_ru_tsv'
+        statement = text(f"""
+            SELECT {_columns(FAQ)} FROM faqs, to_tsquery(:config, :query) AS query
+            WHERE faqs.is_active AND faqs.{column} @@ query
+            ORDER BY ts_rank_cd(faqs.{column}, query) DESC
+            LIMIT :limit
+        """).bindparams(config=PG_CONFIGS.get(language, 'russian'), query=ts_query, limit=limit)
+    elif dialect == 'sqlite':
+        fts_query = _fts5_query(query, language)
+        if not fts_query:
+            return []
+        column = 'question_kz' if language == 'kz' else 'question_ru'
+        statement = text(f"""
+            SELECT {_columns(FAQ)} FROM faqs_fts JOIN faqs ON faqs.id = faqs_fts.rowid
+            WHERE faqs_fts MATCH :query AND faqs.is_active = 1
+            ORDER BY bm25(faqs_fts)
+            LIMIT :limit
+        """).bindparams(query=f"{column} : ({fts_query})", limit=limit)
+    else:
+        return []
+
+    return db.session.execute(select(FAQ).from_statement(statement)).scalars().all()
+
+
+def search_knowledge_base(query: str, language: str = 'ru', limit: int = 3) -> List[KnowledgeBase]:
+    """Ranked active knowledge base chunks matching the query"""
+    dialect = _dialect()
+    if dialect == 'postgresql':
+        ts_query = _pg_tsquery(query, language)
+        if not ts_query:
+            return []
+        statement = text(f"""
+            SELECT {_columns(KnowledgeBase)} FROM knowledge_base, to_tsquery(:config, :query) AS query
+            WHERE knowledge_base.is_active AND knowledge_base.content_tsv @@ query
+            ORDER BY ts_rank_cd(knowledge_base.content_tsv, query) DESC
+            LIMIT :limit
+        """).bindparams(config=PG_CONFIGS.get(language, 'russian'), query=ts_query, limit=limit)
+    elif dialect == 'sqlite':
+        fts_query = _fts5_query(query, language)
+        if not fts_query:
+            return []
+        statement = text(f"""
+            SELECT {_columns(KnowledgeBase)} FROM knowledge_base_fts
+            JOIN knowledge_base ON knowledge_base.id = knowledge_base_fts.rowid
+            WHERE knowledge_base_fts MATCH :query AND knowledge_base.is_active = 1
+            ORDER BY bm25(knowledge_base_fts)
+            LIMIT :limit
+        """).bindparams(query=fts_query, limit=limit)
+    else:
+        return []
+
+    return db.session.execute(select(KnowledgeBase).from_statement(statement)).scalars().all()
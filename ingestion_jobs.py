@@ -0,0 +1,302 @@
+"""Database-backed queue of knowledge base updates and the worker that runs them
+
+The admin only inserts an IngestionJob row; scraping, PDF/DOCX extraction
+and chunking happen in a separate worker process, so they never block or
+time out a web worker. Jobs are claimed with a conditional UPDATE (safe
+with several worker processes), failed attempts are retried with
+exponential backoff, and jobs of a worker that died are requeued once
+their heartbeat is stale.
+
+Run the worker with:
+    python ingestion_jobs.py [concurrency]
+"""
+import logging
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Jobs run at the same time by one worker process
+CONCURRENCY = int(os.environ.get("INGESTION_WORKER_CONCURRENCY", "2"))
+# Attempts per job and the delay before the first retry (doubled for every further one)
+MAX_ATTEMPTS = int(os.environ.get("INGESTION_MAX_ATTEMPTS", "3"))
+RETRY_BASE_SECONDS = float(os.environ.get("INGESTION_RETRY_BASE_SECONDS", "30"))
+# How often an idle worker looks for new jobs
+POLL_INTERVAL = float(os.environ.get("INGESTION_POLL_SECONDS", "2"))
+# A running job without a heartbeat for this long belongs to a dead worker
+STALE_AFTER = float(os.environ.get("INGESTION_STALE_SECONDS", "900"))
+# Minimum interval between progress writes, and heartbeat interval, of a running job
+PROGRESS_INTERVAL = 1.0
+HEARTBEAT_INTERVAL = 30.0
+
+# 'embeddings' rebuilds the shared vector store (source_id 0) after FAQ edits and deletions;
+# 'rollups' builds the analytics rollups from the query log once after an upgrade (source_id 0)
+JOB_TYPES = ('document', 'web', 'embeddings', 'rollups')
+SOURCE_JOB_TYPES = ('document', 'web')
+ACTIVE_STATUSES = ('queued', 'running')
+
+
+def enqueue(job_type: str, source_id: int, created_by: Optional[int] = None):
+    """Queue an update of a document or web source (an already queued or running one is reused)"""
+    from app import db
+    from models import IngestionJob
+
+    if job_type not in JOB_TYPES:
+        raise ValueError(f"Unknown ingestion job type: {job_type}")
+    # A running rebuild may have read the content before this change, so only a queued one is reused
+    statuses = ('queued',) if job_type == 'embeddings' else ACTIVE_STATUSES
+    job = IngestionJob.query.filter(
+        IngestionJob.job_type == job_type,
+        IngestionJob.source_id == source_id,
+        IngestionJob.status.in_(statuses)
+    ).first()
+    if job is not None:
+        return job
+    job = IngestionJob(job_type=job_type, source_id=source_id, max_attempts=MAX_ATTEMPTS,
+                       created_by=created_by)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def enqueue_embeddings_rebuild(created_by: Optional[int] = None):
+    """Queue a rebuild of the shared embedding store if the vector backend is in use"""
+    from flask import current_app
+
+    if current_app.config.get("RETRIEVAL_BACKEND") != "vector":
+        return None
+    return enqueue('embeddings', 0, created_by)
+
+
+def enqueue_rollups_backfill(created_by: Optional[int] = None):
+    """Queue building the analytics rollups if queries older than them exist (None otherwise)"""
+    import rollups
+
+    if not rollups.backfill_pending():
+        return None
+    return enqueue('rollups', 0, created_by)
+
+
+def claim(worker_id: str) -> Optional[int]:
+    """Mark the next due job as running by this worker and return its id"""
+    from sqlalchemy import update
+    from app import db
+    from models import IngestionJob
+
+    now = datetime.utcnow()
+    candidates = db.session.query(IngestionJob.id).filter(
+        IngestionJob.status == 'queued', IngestionJob.run_after <= now
+    ).order_by(IngestionJob.run_after, IngestionJob.id).limit(5).all()
+    for (job_id,) in candidates:
+        # Only one worker's UPDATE matches while the job is still queued
+        claimed = db.session.execute(
+            update(IngestionJob)
+            .where(IngestionJob.id == job_id, IngestionJob.status == 'queued')
+            .values(status='running', locked_by=worker_id, attempts=IngestionJob.attempts + 1,
+                    started_at=now, heartbeat_at=now, progress_current=0, progress_total=None)
+        ).rowcount
+        db.session.commit()
+        if claimed:
+            return job_id
+    return None
+
+
+def requeue_stale() -> int:
+    """Put running jobs whose worker stopped sending heartbeats back in the queue"""
+    from sqlalchemy import update
+    from app import db
+    from models import IngestionJob
+
+    cutoff = datetime.utcnow() - timedelta(seconds=STALE_AFTER)
+    count = db.session.execute(
+        update(IngestionJob)
+        .where(IngestionJob.status == 'running', IngestionJob.heartbeat_at < cutoff)
+        .values(status='queued', locked_by=None, run_after=datetime.utcnow(),
+                last_error='Worker stopped responding')
+    ).rowcount
+    db.session.commit()
+    if count:
+        logger.warning(f"Requeued {count} stale ingestion jobs")
+    return count
+
+
+class _Progress:
+    """progress(page, total) callback that records the job's progress, plus a heartbeat thread
+
+    Writes go through their own connection and transaction: the job's
+    session may be in the middle of its ingestion.
+    """
+
+    def __init__(self, engine, job_id: int):
+        self.engine = engine
+        self.job_id = job_id
+        self._written = 0.0
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self._done.set()
+        self._thread.join()
+
+    def __call__(self, current: int, total: Optional[int] = None):
+        now = time.monotonic()
+        if now - self._written < PROGRESS_INTERVAL and current != total:
+            return
+        self._written = now
+        self.write(progress_current=current, progress_total=total)
+
+    def _beat(self):
+        # Also covers steps without progress reports (scraping, chunking)
+        while not self._done.wait(HEARTBEAT_INTERVAL):
+            try:
+                self.write()
+            except Exception as e:
+                logger.error(f"Heartbeat of ingestion job {self.job_id} failed: {str(e)}")
+
+    def write(self, **values):
+        from sqlalchemy import update
+        from models import IngestionJob
+
+        values = {key: value for key, value in values.items() if value is not None}
+        with self.engine.begin() as connection:
+            connection.execute(update(IngestionJob).where(IngestionJob.id == self.job_id)
+                               .values(heartbeat_at=datetime.utcnow(), **values))
+
+
+def run(job_id: int) -> bool:
+    """Run a claimed job and record the outcome (retry with backoff, or failed)"""
+    from app import db
+    import embedding_store
+    import extraction
+    import rollups
+    from document_processor import KnowledgeBaseUpdater
+    from models import Document, IngestionJob, KnowledgeBase, WebSource
+
+    job = db.session.get(IngestionJob, job_id)
+    job_type, source_id = job.job_type, job.source_id
+    if job_type in SOURCE_JOB_TYPES:
+        source = db.session.get(Document if job_type == 'document' else WebSource, source_id)
+        if source is None or not source.is_active:
+            # Deleted after the job was queued: its chunks must not come back
+            job.status = 'failed'
+            job.last_error = 'Source was deleted'
+            job.locked_by = None
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+            return False
+    db.session.commit()
+
+    updater = KnowledgeBaseUpdater(db, {'Document': Document, 'WebSource': WebSource,
+                                        'KnowledgeBase': KnowledgeBase})
+    error = None
+    retry = True
+    try:
+        with _Progress(db.engine, job_id) as progress:
+            if job_type == 'document':
+                success = updater.update_from_document(source_id, progress)
+            elif job_type == 'web':
+                success = updater.update_from_web_source(source_id)
+            elif job_type == 'rollups':
+                rollups.rebuild()
+                success = True
+            else:
+                embedding_store.rebuild_if_enabled(raise_errors=True)
+                success = True
+        if not success:
+            error = 'Update failed, see the worker log'
+    except extraction.UnsupportedFileType as e:
+        db.session.rollback()
+        error = str(e)
+        retry = False
+        logger.error(f"Ingestion job {job_id} cannot be processed: {error}")
+    except Exception as e:
+        db.session.rollback()
+        error = str(e)
+        logger.error(f"Ingestion job {job_id} raised: {error}")
+
+    job = db.session.get(IngestionJob, job_id)
+    job.locked_by = None
+    job.heartbeat_at = datetime.utcnow()
+    if error is None:
+        job.status = 'succeeded'
+        job.last_error = None
+        job.finished_at = datetime.utcnow()
+    elif retry and job.attempts < job.max_attempts:
+        # Exponential backoff with jitter, so a broken site is not hammered
+        delay = RETRY_BASE_SECONDS * 2 ** (job.attempts - 1) * random.uniform(0.8, 1.2)
+        job.status = 'queued'
+        job.last_error = error
+        job.run_after = datetime.utcnow() + timedelta(seconds=delay)
+        logger.warning(f"Ingestion job {job_id} failed (attempt {job.attempts}), retrying in {delay:.0f}s")
+    else:
+        job.status = 'failed'
+        job.last_error = error
+        job.finished_at = datetime.utcnow()
+        logger.error(f"Ingestion job {job_id} failed after {job.attempts} attempts: {error}")
+    db.session.commit()
+    return error is None
+
+
+class IngestionWorker:
+    """Runs queued jobs on `concurrency` threads until stop() is called"""
+
+    def __init__(self, concurrency: int = CONCURRENCY):
+        self.concurrency = max(concurrency, 1)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._stop = threading.Event()
+
+    def stop(self, *_):
+        logger.info("Ingestion worker stopping after the running jobs")
+        self._stop.set()
+
+    def run_forever(self):
+        from app import app
+        import metrics
+
+        # Ingestion counters reach /metrics through this process's snapshot file (METRICS_DIR)
+        metrics.registry.ensure_writer()
+        with app.app_context():
+            requeue_stale()
+        threads = [threading.Thread(target=self._loop, name=f'ingestion-{i}') for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        logger.info(f"Ingestion worker {self.worker_id} started with {self.concurrency} threads")
+        for thread in threads:
+            thread.join()
+
+    def _loop(self):
+        from app import app
+
+        last_stale_check = time.monotonic()
+        while not self._stop.is_set():
+            with app.app_context():
+                try:
+                    if time.monotonic() - last_stale_check > STALE_AFTER / 2:
+                        last_stale_check = time.monotonic()
+                        requeue_stale()
+                    job_id = claim(self.worker_id)
+                    if job_id is not None:
+                        logger.info(f"Running ingestion job {job_id}")
+                        run(job_id)
+                        continue
+                except Exception as e:
+                    logger.error(f"Ingestion worker error: {str(e)}")
+            self._stop.wait(POLL_INTERVAL)
+
+
+if __name__ == '__main__':
+    worker = IngestionWorker(int(sys.argv[1]) if len(sys.argv) > 1 else CONCURRENCY)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.run_forever()
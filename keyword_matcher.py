@@ -0,0 +1,94 @@
+import logging
+from collections import deque
+from typing import Dict, Generic, Hashable, Iterator, List, Sequence, Set, Tuple, TypeVar
+
+from text_processing import LANGUAGES, normalize_text
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T', bound=Hashable)
+
+
+class AhoCorasick(Generic[T]):
+    """Aho-Corasick automaton: finds every occurrence of many patterns in one pass over a text"""
+
+    def __init__(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._outputs: List[List[T]] = [[]]
+        self._built = False
+
+    def add(self, pattern: str, value: T):
+        """Register a pattern; value is reported for each occurrence"""
+        if self._built:
+            raise RuntimeError("Cannot add patterns after build()")
+        node = 0
+        for char in pattern:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._outputs.append([])
+            node = next_node
+        self._outputs[node].append(value)
+
+    def build(self) -> 'AhoCorasick[T]':
+        """Compute failure links breadth-first and merge outputs along them"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._outputs[child].extend(self._outputs[self._fail[child]])
+        self._built = True
+        return self
+
+    def iter_matches(self, text: str) -> Iterator[T]:
+        """Values of all patterns occurring in text (once per occurrence)"""
+        goto, fail, outputs = self._goto, self._fail, self._outputs
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if outputs[node]:
+                yield from outputs[node]
+
+
+class AgentMatcher:
+    """Keyword stems and boost prefixes of all agents compiled into one automaton per language
+
+    Patterns are matched at word starts: both the patterns and the normalized
+    message are prefixed with a space.
+    """
+
+    def __init__(self, agents: Sequence):
+        self.agent_count = len(agents)
+        self._automata: Dict[str, AhoCorasick] = {}
+        for language in LANGUAGES:
+            automaton: AhoCorasick = AhoCorasick()
+            for position, agent in enumerate(agents):
+                for keyword_stem in agent.get_keyword_stems(language):
+                    automaton.add(f" {keyword_stem}", (position, keyword_stem))
+                for prefix in agent.boost_prefixes:
+                    automaton.add(f" {normalize_text(prefix)}", (position, None))
+            self._automata[language] = automaton.build()
+        logger.info(f"Keyword matcher built for {len(agents)} agents")
+
+    def scan(self, message: str, language: str = 'ru') -> List[Tuple[int, bool]]:
+        """(number of distinct keywords found, boost prefix found) for every agent"""
+        automaton = self._automata.get(language, self._automata['ru'])
+        keywords: List[Set[str]] = [set() for _ in range(self.agent_count)]
+        boosted = [False] * self.agent_count
+        for position, keyword_stem in automaton.iter_matches(f" {normalize_text(message)}"):
+            if keyword_stem is None:
+                boosted[position] = True
+            else:
+                keywords[position].add(keyword_stem)
+        return [(len(found), boost) for found, boost in zip(keywords, boosted)]
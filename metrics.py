@@ -0,0 +1,530 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: workers prune the directory without a lock
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Directory of per-worker snapshot files; with gunicorn every worker writes its own
+# file and /metrics sums all of them. Empty: only the serving process is reported.
+# Files of exited workers are folded into one archive per server (see prune_dead_workers).
+METRICS_DIR = os.environ.get("METRICS_DIR", "")
+# How often (seconds) a worker rewrites its snapshot file
+SNAPSHOT_INTERVAL = float(os.environ.get("METRICS_SNAPSHOT_SECONDS", "1"))
+
+# Seconds; from cache hits (milliseconds) to slow LLM answers
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LabelValues = Tuple[str, ...]
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[LabelValues, object] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, object]) -> LabelValues:
+        return tuple(str(labels.get(name) if labels.get(name) is not None else '') for name in self.labelnames)
+
+    def samples(self) -> Dict[LabelValues, object]:
+        with self._lock:
+            return {key: self._copy(value) for key, value in self._values.items()}
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def set(self, value: float, **labels):
+        """Mirror a cumulative count kept elsewhere in the process (see add_collector)"""
+        with self._lock:
+            self._values[self._key(labels)] = float(value)
+
+
+class Gauge(Metric):
+    """Current value; summed over the workers that are still alive"""
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = float(value)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (not cumulative) counts, the last one is +Inf; then sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    @staticmethod
+    def _copy(value):
+        return [list(value[0]), value[1]]
+
+
+class Registry:
+    """Metrics of this process plus the snapshot files of the other workers"""
+
+    def __init__(self, directory: str = METRICS_DIR, interval: float = SNAPSHOT_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.metrics: Dict[str, Metric] = {}
+        self._collectors: List[Callable[[], None]] = []
+        self._writer_pid: Optional[int] = None
+        self._writer_path: Optional[str] = None
+        self._writer_lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, collector: Callable[[], None]):
+        """Callback that refreshes gauges and mirrored counters before every snapshot"""
+        self._collectors.append(collector)
+
+    def collect(self):
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.debug(f"Metrics collector failed: {str(e)}")
+
+    def snapshot(self) -> Dict[str, list]:
+        return {
+            name: [[list(key), value] for key, value in metric.samples().items()]
+            for name, metric in self.metrics.items()
+        }
+
+    # Multi-process files
+
+    def ensure_writer(self):
+        """Start this worker's snapshot thread (again after a fork)"""
+        if not self.directory or self._writer_pid == os.getpid():
+            return
+        with self._writer_lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._writer_pid = os.getpid()
+            # Unique per process start: a reused PID must not overwrite an old worker's file
+            self._writer_path = self._path(f"{os.getpid()}_{uuid.uuid4().hex[:12]}")
+            os.makedirs(self.directory, exist_ok=True)
+            try:
+                self.prune_dead_workers()
+            except OSError as e:
+                logger.warning(f"Could not prune metrics snapshots: {str(e)}")
+            threading.Thread(target=self._write_loop, name='metrics-writer', daemon=True).start()
+
+    def _write_loop(self):
+        while True:
+            self.write_snapshot()
+            time.sleep(self.interval)
+
+    def write_snapshot(self):
+        if self._writer_pid != os.getpid():
+            return
+        self._collect_in_app_context()
+        parent = os.getppid()
+        data = {'pid': os.getpid(), 'started': _process_started(os.getpid()),
+                'ppid': parent, 'parent_started': _process_started(parent), 'metrics': self.snapshot()}
+        try:
+            _write_json(self._writer_path, data)
+        except OSError as e:
+            logger.warning(f"Could not write metrics snapshot: {str(e)}")
+
+    def _collect_in_app_context(self):
+        # Collectors may need the database engine
+        from app import app
+
+        with app.app_context():
+            self.collect()
+
+    def prune_dead_workers(self):
+        """Fold the snapshots of exited workers into their server's archive file
+
+        Counters of a worker that gunicorn replaced stay in the sums (they
+        must not go backwards while the server runs); files and archives
+        left by a server that is no longer running are deleted.
+        """
+        with _directory_lock(self.directory):
+            archives: Dict[str, Dict] = {}
+            dead_files = []
+            for path, data in self._snapshot_files():
+                if data.get('archive'):
+                    if not _process_alive(data.get('pid'), data.get('started')):
+                        os.unlink(path)
+                    else:
+                        archives[path] = data
+                    continue
+                if path == self._writer_path or _process_alive(data.get('pid'), data.get('started')):
+                    continue
+                dead_files.append(path)
+                parent, parent_started = data.get('ppid'), data.get('parent_started')
+                if not _process_alive(parent, parent_started):
+                    continue  # Left by an earlier run of the server
+                archive_path = self._path(f"archive_{parent}_{parent_started}")
+                archive = archives.setdefault(archive_path, {
+                    'archive': True, 'pid': parent, 'started': parent_started, 'metrics': {}})
+                archive['metrics'] = self._merge_snapshots(archive['metrics'], data.get('metrics', {}))
+            for path, archive in archives.items():
+                _write_json(path, archive)
+            for path in dead_files:
+                os.unlink(path)
+        if dead_files:
+            logger.info(f"Pruned {len(dead_files)} metrics snapshots of exited workers")
+
+    def _merge_snapshots(self, first: Dict[str, list], second: Dict[str, list]) -> Dict[str, list]:
+        # Gauges of exited workers no longer describe anything
+        merged = {}
+        for snapshot in (first, second):
+            for name, samples in snapshot.items():
+                metric = self.metrics.get(name)
+                if metric is None or metric.kind == 'gauge':
+                    continue
+                target = merged.setdefault(name, {})
+                for labels, value in samples:
+                    _merge(metric, target, tuple(labels), value)
+        return {name: [[list(key), value] for key, value in samples.items()]
+                for name, samples in merged.items()}
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, f"metrics_{name}.json")
+
+    def _snapshot_files(self) -> List[Tuple[str, Dict]]:
+        files = []
+        if not self.directory or not os.path.isdir(self.directory):
+            return files
+        for entry in os.scandir(self.directory):
+            if not entry.name.startswith('metrics_') or not entry.name.endswith('.json'):
+                continue
+            try:
+                with open(entry.path, encoding='utf-8') as f:
+                    files.append((entry.path, json.load(f)))
+            except (OSError, ValueError):
+                continue
+        return files
+
+    def _worker_snapshots(self) -> List[Tuple[bool, Dict[str, list]]]:
+        """(alive, metrics) of every other worker's file and of the archives"""
+        return [
+            (not data.get('archive') and _process_alive(data.get('pid'), data.get('started')),
+             data.get('metrics', {}))
+            for path, data in self._snapshot_files()
+            if path != self._writer_path
+        ]
+
+    # Exposition
+
+    def render(self) -> str:
+        """All workers' metrics in the Prometheus text format"""
+        self.collect()
+        merged: Dict[str, Dict[LabelValues, object]] = {
+            name: metric.samples() for name, metric in self.metrics.items()
+        }
+        for alive, snapshot in self._worker_snapshots():
+            for name, samples in snapshot.items():
+                metric = self.metrics.get(name)
+                if metric is None or (metric.kind == 'gauge' and not alive):
+                    # Gauges of exited workers no longer describe anything; counters stay
+                    continue
+                target = merged[name]
+                for labels, value in samples:
+                    _merge(metric, target, tuple(labels), value)
+
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for key, value in sorted(merged[name].items()):
+                labels = list(zip(metric.labelnames, key))
+                if metric.kind == 'histogram':
+                    lines.extend(_histogram_lines(metric, labels, value))
+                else:
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _merge(metric: Metric, target: Dict[LabelValues, object], key: LabelValues, value):
+    if metric.kind == 'histogram':
+        if len(value[0]) != len(metric.buckets) + 1:
+            return  # Written with other buckets by an older deployment
+        current = target.get(key)
+        if current is None:
+            target[key] = [list(value[0]), value[1]]
+        else:
+            current[0] = [a + b for a, b in zip(current[0], value[0])]
+            current[1] += value[1]
+    else:
+        target[key] = target.get(key, 0.0) + value
+
+
+def _histogram_lines(metric: Histogram, labels: list, value) -> List[str]:
+    counts, total = value
+    lines = []
+    cumulative = 0
+    for bound, count in zip(metric.buckets + (float('inf'),), counts):
+        cumulative += count
+        bucket_labels = labels + [('le', '+Inf' if bound == float('inf') else repr(bound))]
+        lines.append(f"{metric.name}_bucket{_format_labels(bucket_labels)} {cumulative}")
+    lines.append(f"{metric.name}_sum{_format_labels(labels)} {_format_value(total)}")
+    lines.append(f"{metric.name}_count{_format_labels(labels)} {cumulative}")
+    return lines
+
+
+def _format_labels(labels: list) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _pid_alive(pid) -> bool:
+    try:
+        os.kill(int(pid), 0)
+    except PermissionError:
+        return True  # Exists, owned by another user
+    except (OSError, TypeError, ValueError):
+        return False
+    return True
+
+
+def _process_started(pid) -> Optional[int]:
+    """Start time of a process in clock ticks since boot (None where /proc is unavailable)"""
+    try:
+        with open(f"/proc/{int(pid)}/stat", encoding='utf-8') as f:
+            # Fields after the parenthesized command name; starttime is field 22
+            return int(f.read().rsplit(')', 1)[1].split()[19])
+    except (OSError, TypeError, ValueError, IndexError):
+        return None
+
+
+def _process_alive(pid, started: Optional[int]) -> bool:
+    """The process is running and is not a later process that reused its PID"""
+    if not _pid_alive(pid):
+        return False
+    current = _process_started(pid)
+    return started is None or current is None or current == started
+
+
+def _write_json(path: str, data: Dict):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def _directory_lock(directory: str):
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(os.path.join(directory, '.prune.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+registry = Registry()
+
+
+def _register(metric: Metric) -> Metric:
+    return registry.register(metric)
+
+
+# Request metrics, recorded by the Flask hooks and the ASGI chat handlers
+HTTP_REQUESTS = _register(Counter(
+    'bolashak_http_requests_total', 'HTTP requests by endpoint, agent, language and status',
+    ('endpoint', 'agent_type', 'language', 'status')))
+HTTP_LATENCY = _register(Histogram(
+    'bolashak_http_request_duration_seconds', 'HTTP request latency (full stream for SSE)',
+    ('endpoint', 'agent_type', 'language')))
+CHAT_RESPONSES = _register(Counter(
+    'bolashak_chat_responses_total', 'Chat answers by agent and source (llm, faq, cache, coalesced, fallback)',
+    ('agent_type', 'response_source')))
+
+# LLM backend
+LLM_LATENCY = _register(Histogram(
+    'bolashak_llm_request_duration_seconds', 'Successful Mistral call latency (time to first token for streams)'))
+LLM_REQUESTS = _register(Counter(
+    'bolashak_llm_requests_total', 'HTTP requests sent to Mistral, including retries and hedges'))
+LLM_ERRORS = _register(Counter(
+    'bolashak_llm_errors_total', 'Failed Mistral HTTP requests'))
+LLM_REJECTED = _register(Counter(
+    'bolashak_llm_rejected_total', 'LLM calls answered by the fallback without a request',
+    ('reason',)))
+LLM_RETRIES = _register(Counter(
+    'bolashak_llm_retries_total', 'Retried Mistral calls'))
+LLM_BREAKER_OPEN = _register(Gauge(
+    'bolashak_llm_circuit_open', 'Workers whose LLM circuit breaker is not closed'))
+LLM_ACTIVE = _register(Gauge(
+    'bolashak_llm_active_calls', 'LLM calls holding a concurrency slot'))
+LLM_QUEUE_DEPTH = _register(Gauge(
+    'bolashak_llm_queue_depth', 'LLM calls waiting for a concurrency slot'))
+RATE_LIMITED = _register(Counter(
+    'bolashak_rate_limited_total', 'Chat requests rejected with 429 by the per-client rate limit'))
+
+# Retrieval and caches
+RETRIEVAL_SEARCHES = _register(Counter(
+    'bolashak_retrieval_searches_total', 'FAQ and knowledge base searches by result',
+    ('source', 'backend', 'result')))
+RESPONSE_CACHE_LOOKUPS = _register(Counter(
+    'bolashak_response_cache_lookups_total', 'Response cache lookups by result',
+    ('result',)))
+
+# Database and ingestion
+DB_POOL_CONNECTIONS = _register(Gauge(
+    'bolashak_db_pool_connections', 'Database pool connections by state',
+    ('state',)))
+QUERY_LOG_QUEUE_DEPTH = _register(Gauge(
+    'bolashak_query_log_queue_depth', 'Chat records waiting for the batched insert'))
+INGESTION_JOBS = _register(Counter(
+    'bolashak_ingestion_jobs_total', 'Knowledge base updates by source type and status',
+    ('source_type', 'status')))
+INGESTION_CHUNKS = _register(Counter(
+    'bolashak_ingestion_chunks_total', 'Knowledge base chunks written by source type',
+    ('source_type',)))
+
+
+def init_app(app):
+    """Record every Flask request; views that stream set g.metrics_deferred and record themselves"""
+    from flask import g, request
+
+    @app.before_request
+    def _start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        started = g.get('request_started')
+        if started is not None and not g.get('metrics_deferred'):
+            endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+            labels = g.get('metrics_labels') or {}
+            observe_request(endpoint, response.status_code, time.perf_counter() - started,
+                            labels.get('agent_type'), labels.get('language'))
+        return response
+
+
+def request_labels() -> Dict[str, object]:
+    """Agent type and language of the current Flask request, filled in by the view"""
+    from flask import g
+
+    if 'metrics_labels' not in g:
+        g.metrics_labels = {}
+    return g.metrics_labels
+
+
+def observe_request(endpoint: str, status: int, duration: float,
+                    agent_type: Optional[str] = None, language: Optional[str] = None):
+    """Count one HTTP request and its latency"""
+    registry.ensure_writer()
+    HTTP_REQUESTS.inc(endpoint=endpoint, agent_type=agent_type, language=language, status=status)
+    HTTP_LATENCY.observe(duration, endpoint=endpoint, agent_type=agent_type, language=language)
+
+
+def observe_chat(result: Dict[str, object]):
+    """Count one chat answer by agent and response source"""
+    CHAT_RESPONSES.inc(agent_type=result.get('agent_type'),
+                       response_source=result.get('response_source', 'llm'))
+
+
+def _collect_runtime():
+    """Mirror the counters and gauges the runtime modules already keep"""
+    from resilience import llm_policy, CLOSED
+    from response_cache import response_cache
+    import admission
+    import query_log
+
+    policy = llm_policy.stats()
+    LLM_RETRIES.set(policy['retries'])
+    LLM_REJECTED.set(policy['rejected_calls'], reason='circuit_open')
+    LLM_BREAKER_OPEN.set(0 if policy['breaker_state'] == CLOSED else 1)
+
+    slots = admission.llm_slots.stats()
+    LLM_ACTIVE.set(slots['active'])
+    LLM_QUEUE_DEPTH.set(slots['queue_depth'])
+    LLM_REJECTED.set(slots['shed'], reason='shed')
+    RATE_LIMITED.set(admission.rate_limiter.stats()['rate_limited'])
+
+    cache = response_cache.stats()
+    for result in ('hits', 'near_hits', 'history_hits', 'misses'):
+        RESPONSE_CACHE_LOOKUPS.set(cache[result], result=result)
+
+    QUERY_LOG_QUEUE_DEPTH.set(query_log.stats().get('queue_depth', 0))
+
+
+def _collect_llm_client():
+    import mistral_client
+
+    requests_sent = errors = 0
+    for client in (mistral_client._client, mistral_client._async_client):
+        if client is not None:
+            stats = client.stats()
+            requests_sent += stats['requests']
+            errors += stats['errors']
+    LLM_REQUESTS.set(requests_sent)
+    LLM_ERRORS.set(errors)
+
+
+def _collect_db_pool():
+    from app import db
+
+    pool = db.engine.pool
+    if hasattr(pool, 'checkedout'):
+        checked_out = pool.checkedout()
+        DB_POOL_CONNECTIONS.set(checked_out, state='checked_out')
+        DB_POOL_CONNECTIONS.set(max(pool.checkedin(), 0), state='idle')
+        DB_POOL_CONNECTIONS.set(max(pool.overflow(), 0), state='overflow')
+
+
+registry.add_collector(_collect_runtime)
+registry.add_collector(_collect_llm_client)
+registry.add_collector(_collect_db_pool)
+if registry.directory:
+    atexit.register(registry.write_snapshot)
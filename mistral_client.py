@@ -1,13 +1,35 @@
 # Импорт необходимых модулей
 import os
+import asyncio
 import logging
+import threading
+import time
 import requests
 import json
-from typing import Optional
+from requests.adapters import HTTPAdapter
+from typing import AsyncIterator, Dict, Generator, List, Optional, Tuple, Union
+
+from admission import AdmissionRejected, llm_slots
+from resilience import CircuitOpenError, llm_policy
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
+# Размер пула keep-alive соединений к API (на процесс)
+POOL_SIZE = int(os.environ.get("MISTRAL_POOL_SIZE", "10"))
+# Таймауты установки соединения и чтения ответа (секунды)
+CONNECT_TIMEOUT = float(os.environ.get("MISTRAL_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.environ.get("MISTRAL_READ_TIMEOUT", "30"))
+# Размер пула соединений асинхронного клиента (ASGI режим, все запросы воркера)
+ASYNC_POOL_SIZE = int(os.environ.get("MISTRAL_ASYNC_POOL_SIZE", "100"))
+
+def is_retriable(error: Exception) -> bool:
+    """Client errors (bad request, auth) will fail again; timeouts, 5xx and 429 may not"""
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None)
+    return status is None or status == 429 or status >= 500
+
+
 # Класс для взаимодействия с API Mistral AI
 class MistralClient:
     """Client for interacting with Mistral AI API"""
@@ -20,6 +42,22 @@ class MistralClient:
         # Используемая модель
         self.model = "mistral-small-latest"
 
+        # Долгоживущая сессия: TCP/TLS соединения переиспользуются между запросами
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+        self.session.mount(self.base_url, self.adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "Connection": "keep-alive"
+        })
+        self.timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+        # Счетчики запросов для статистики переиспользования соединений
+        self._stats_lock = threading.Lock()
+        self.request_count = 0
+        self.error_count = 0
+
         # Системные подсказки для разных языков
         self.system_prompts = {
             'ru': """Ты - помощник для абитуриентов Кызылординского университета "Болашак". 
@@ -35,52 +73,196 @@ class MistralClient:
 
     def get_response(self, user_message: str, context: str = "", language: str = "ru") -> str:
         """Get response from Mistral AI"""
-        try:
-            # Prepare the system prompt
-            system_prompt = self.system_prompts.get(language, self.system_prompts['ru'])
-
-            # Create the message with context
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Контекст из FAQ:\n{context}\n\nВопрос пользователя: {user_message}"}
-            ]
+        return self.generate(user_message, context, language)[0]
 
-            # Prepare the request
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }
+    def generate(self, user_message: str, context: str = "", language: str = "ru") -> Tuple[str, bool]:
+        """Get response from Mistral AI and whether it came from the model (False for fallbacks)"""
+        try:
+            data = self._build_request(user_message, context, language)
+            # Slot of the per-worker LLM concurrency limit (short bounded wait, else shed)
+            with llm_slots.slot():
+                # Circuit breaker, budgeted retries and optional hedging around the request
+                return llm_policy.call(lambda: self._complete(data), is_retriable), True
 
-            data = {
-                "model": self.model,
-                "messages": messages,
-                "max_tokens": 500,
-                "temperature": 0.7
-            }
+        except CircuitOpenError:
+            logger.warning("Mistral API circuit breaker is open, using fallback response")
+            return self._get_smart_fallback_response(user_message, context, language), False
+        except AdmissionRejected as e:
+            logger.warning(f"LLM call shed ({str(e)}), using fallback response")
+            return self._get_smart_fallback_response(user_message, context, language), False
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Request error to Mistral API: {str(e)}")
+            # Provide a more informative response in case of network issues
+            return self._get_smart_fallback_response(user_message, context, language), False
+        except Exception as e:
+            logger.error(f"Unexpected error in Mistral client: {str(e)}")
+            return self._get_fallback_response(language), False
 
-            # Make the request
-            response = requests.post(
+    def _complete(self, data: Dict) -> str:
+        """One chat completion request over a pooled keep-alive connection"""
+        with self._stats_lock:
+            self.request_count += 1
+        try:
+            response = self.session.post(
                 f"{self.base_url}/chat/completions",
-                headers=headers,
                 json=data,
-                timeout=30
+                timeout=self.timeout
             )
-
-            if response.status_code == 200:
-                result = response.json()
-                return result['choices'][0]['message']['content'].strip()
-            else:
+            if response.status_code != 200:
                 logger.error(f"Mistral API error: {response.status_code} - {response.text}")
-                return self._get_fallback_response(language)
+                response.raise_for_status()
+        except requests.exceptions.RequestException:
+            with self._stats_lock:
+                self.error_count += 1
+            raise
+        result = response.json()
+        return result['choices'][0]['message']['content'].strip()
+
+    def stream(self, user_message: str, context: str = "", language: str = "ru") -> Generator[str, None, Tuple[str, bool]]:
+        """Stream the completion piece by piece
+
+        Yields text pieces as the model produces them and returns the full text and
+        whether it came from the model. If the request fails before any text arrived,
+        the fallback answer is yielded instead. Failed connection attempts are retried
+        within the retry budget; the time to the first piece is checked against the SLO.
+        """
+        parts: List[str] = []
+        outcome_recorded = False
+        start = time.monotonic()
+        first_piece_latency = None
+        try:
+            data = self._build_request(user_message, context, language)
+            data["stream"] = True
+
+            # The slot is held until the stream is finished or abandoned
+            with llm_slots.slot():
+                llm_policy.before_call()
+                attempt = 0
+                while True:
+                    try:
+                        response = self._open_stream(data)
+                        break
+                    except requests.exceptions.RequestException as e:
+                        if not llm_policy.on_failure(attempt, is_retriable(e)):
+                            outcome_recorded = True
+                            raise
+                        attempt += 1
+                        time.sleep(llm_policy.backoff(attempt))
 
+                with response:
+                    # Server-sent events: "data: {json chunk}" lines, terminated by "data: [DONE]"
+                    for line in response.iter_lines():
+                        if not line.startswith(b"data:"):
+                            continue
+                        payload = line[5:].strip()
+                        if payload == b"[DONE]":
+                            break
+                        chunk = json.loads(payload)
+                        choices = chunk.get('choices') or [{}]
+                        piece = (choices[0].get('delta') or {}).get('content')
+                        if piece:
+                            if first_piece_latency is None:
+                                first_piece_latency = time.monotonic() - start
+                            parts.append(piece)
+                            yield piece
+
+                llm_policy.on_success(first_piece_latency or time.monotonic() - start)
+                outcome_recorded = True
+                return "".join(parts).strip(), bool(parts)
+
+        except CircuitOpenError:
+            outcome_recorded = True
+            logger.warning("Mistral API circuit breaker is open, using fallback response")
+            fallback = self._get_smart_fallback_response(user_message, context, language)
+            yield fallback
+            return fallback, False
+        except AdmissionRejected as e:
+            outcome_recorded = True
+            logger.warning(f"LLM call shed ({str(e)}), using fallback response")
+            fallback = self._get_smart_fallback_response(user_message, context, language)
+            yield fallback
+            return fallback, False
         except requests.exceptions.RequestException as e:
+            if not outcome_recorded:
+                # Broke off in the middle of the stream
+                llm_policy.breaker.record_failure()
+                outcome_recorded = True
             logger.error(f"Request error to Mistral API: {str(e)}")
-            # Provide a more informative response in case of network issues
-            return self._get_smart_fallback_response(user_message, context, language)
+            if parts:
+                # The user already sees part of the answer; keep it but do not treat it as complete
+                return "".join(parts).strip(), False
+            fallback = self._get_smart_fallback_response(user_message, context, language)
+            yield fallback
+            return fallback, False
         except Exception as e:
             logger.error(f"Unexpected error in Mistral client: {str(e)}")
-            return self._get_fallback_response(language)
-    
+            if parts:
+                return "".join(parts).strip(), False
+            fallback = self._get_fallback_response(language)
+            yield fallback
+            return fallback, False
+        finally:
+            if not outcome_recorded:
+                # The consumer went away (or an unexpected error): no verdict on the backend
+                llm_policy.cancel()
+
+    def _open_stream(self, data: Dict) -> requests.Response:
+        """Start a streaming completion; raises for a non-200 answer"""
+        with self._stats_lock:
+            self.request_count += 1
+        try:
+            response = self.session.post(
+                f"{self.base_url}/chat/completions",
+                json=data,
+                timeout=self.timeout,
+                stream=True
+            )
+            if response.status_code != 200:
+                logger.error(f"Mistral API error: {response.status_code} - {response.text}")
+                response.close()
+                response.raise_for_status()
+        except requests.exceptions.RequestException:
+            with self._stats_lock:
+                self.error_count += 1
+            raise
+        return response
+
+    def _build_request(self, user_message: str, context: str, language: str) -> Dict:
+        """Chat completion request body with the system prompt and retrieved context"""
+        # Prepare the system prompt
+        system_prompt = self.system_prompts.get(language, self.system_prompts['ru'])
+
+        # Create the message with context
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": f"Контекст из FAQ:\n{context}\n\nВопрос пользователя: {user_message}"}
+        ]
+
+        return {
+            "model": self.model,
+            "messages": messages,
+            "max_tokens": 500,
+            "temperature": 0.7
+        }
+
+    def stats(self) -> Dict[str, float]:
+        """Connection reuse counters of this process"""
+        # urllib3 counts every TCP connection each host pool had to open
+        pools = self.adapter.poolmanager.pools
+        connections = sum(pool.num_connections for pool in map(pools.get, pools.keys()) if pool)
+        with self._stats_lock:
+            requests_sent = self.request_count
+            errors = self.error_count
+        reused = max(requests_sent - connections, 0)
+        return {
+            'pool_size': POOL_SIZE,
+            'requests': requests_sent,
+            'connections_opened': connections,
+            'connections_reused': reused,
+            'reuse_rate': round(reused / requests_sent * 100, 1) if requests_sent else 0.0,
+            'errors': errors
+        }
+
     def _get_smart_fallback_response(self, user_message: str, context: str, language: str = "ru") -> str:
         """Get a smart fallback response based on the user message and context"""
         message_lower = user_message.lower()
@@ -121,4 +303,173 @@ class MistralClient:
             'ru': "Извините, я временно недоступен. Пожалуйста, обратитесь в приемную комиссию университета по телефону или электронной почте.",
             'kz': "Кешіріңіз, мен уақытша қолжетімсізбін. Университеттің қабылдау комиссиясына телефон немесе электрондық пошта арқылы хабарласыңыз."
         }
-        return fallback_responses.get(language, fallback_responses['ru'])
\ No newline at end of file
+        return fallback_responses.get(language, fallback_responses['ru'])
+
+
+_client: Optional[MistralClient] = None
+_client_lock = threading.Lock()
+
+
+def get_mistral_client() -> MistralClient:
+    """Shared per-process client, so its connection pool survives between messages"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = MistralClient()
+    return _client
+
+
+class AsyncMistralClient(MistralClient):
+    """Non-blocking client for the ASGI entry point, built on a pooled httpx.AsyncClient"""
+
+    def __init__(self):
+        super().__init__()
+        # Imported here: httpx is only required when running under ASGI
+        import httpx
+
+        self.http = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json"
+            },
+            limits=httpx.Limits(max_connections=ASYNC_POOL_SIZE, max_keepalive_connections=ASYNC_POOL_SIZE),
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)
+        )
+
+    async def stream(self, user_message: str, context: str = "",
+                     language: str = "ru") -> AsyncIterator[Union[str, Tuple[str, bool]]]:
+        """Async version of MistralClient.stream
+
+        Yields text pieces; the last item is the (full text, from model) tuple,
+        since async generators cannot return a value.
+        """
+        import httpx
+
+        parts: List[str] = []
+        outcome_recorded = False
+        start = time.monotonic()
+        first_piece_latency = None
+        try:
+            data = self._build_request(user_message, context, language)
+            data["stream"] = True
+
+            # The slot is held until the stream is finished or abandoned
+            async with llm_slots.aslot():
+                llm_policy.before_call()
+                attempt = 0
+                while True:
+                    try:
+                        response = await self._open_stream_async(data)
+                        break
+                    except httpx.HTTPError as e:
+                        if not llm_policy.on_failure(attempt, is_retriable(e)):
+                            outcome_recorded = True
+                            raise
+                        attempt += 1
+                        await asyncio.sleep(llm_policy.backoff(attempt))
+
+                try:
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        payload = line[5:].strip()
+                        if payload == "[DONE]":
+                            break
+                        chunk = json.loads(payload)
+                        choices = chunk.get('choices') or [{}]
+                        piece = (choices[0].get('delta') or {}).get('content')
+                        if piece:
+                            if first_piece_latency is None:
+                                first_piece_latency = time.monotonic() - start
+                            parts.append(piece)
+                            yield piece
+                finally:
+                    await response.aclose()
+
+                llm_policy.on_success(first_piece_latency or time.monotonic() - start)
+                outcome_recorded = True
+            yield "".join(parts).strip(), bool(parts)
+
+        except CircuitOpenError:
+            outcome_recorded = True
+            logger.warning("Mistral API circuit breaker is open, using fallback response")
+            fallback = self._get_smart_fallback_response(user_message, context, language)
+            yield fallback
+            yield fallback, False
+        except AdmissionRejected as e:
+            outcome_recorded = True
+            logger.warning(f"LLM call shed ({str(e)}), using fallback response")
+            fallback = self._get_smart_fallback_response(user_message, context, language)
+            yield fallback
+            yield fallback, False
+        except httpx.HTTPError as e:
+            if not outcome_recorded:
+                llm_policy.breaker.record_failure()
+                outcome_recorded = True
+            logger.error(f"Request error to Mistral API: {str(e)}")
+            if parts:
+                yield "".join(parts).strip(), False
+                return
+            fallback = self._get_smart_fallback_response(user_message, context, language)
+            yield fallback
+            yield fallback, False
+        except Exception as e:
+            logger.error(f"Unexpected error in Mistral client: {str(e)}")
+            if parts:
+                yield "".join(parts).strip(), False
+                return
+            fallback = self._get_fallback_response(language)
+            yield fallback
+            yield fallback, False
+        finally:
+            if not outcome_recorded:
+                llm_policy.cancel()
+
+    async def _open_stream_async(self, data: Dict):
+        """Start a streaming completion; raises httpx.HTTPStatusError for a non-200 answer"""
+        with self._stats_lock:
+            self.request_count += 1
+        try:
+            request = self.http.build_request("POST", "/chat/completions", json=data)
+            response = await self.http.send(request, stream=True)
+            if response.status_code != 200:
+                body = await response.aread()
+                await response.aclose()
+                logger.error(f"Mistral API error: {response.status_code} - {body.decode('utf-8', 'replace')}")
+                response.raise_for_status()
+        except Exception:
+            with self._stats_lock:
+                self.error_count += 1
+            raise
+        return response
+
+    def stats(self) -> Dict[str, float]:
+        with self._stats_lock:
+            return {
+                'pool_size': ASYNC_POOL_SIZE,
+                'requests': self.request_count,
+                'errors': self.error_count
+            }
+
+    async def aclose(self):
+        await self.http.aclose()
+
+
+_async_client: Optional[AsyncMistralClient] = None
+
+
+def get_async_mistral_client() -> AsyncMistralClient:
+    """Shared async client; only used from the event loop thread, so no lock is needed"""
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncMistralClient()
+    return _async_client
+
+
+async def close_async_mistral_client():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
@@ -56,27 +56,71 @@ class FAQ(db.Model):
 
 class UserQuery(db.Model):
     __tablename__ = 'user_queries'
+    __table_args__ = (
+        db.Index('ix_user_queries_created_at_id', 'created_at', 'id'),  # Keyset pagination in the admin
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_message = db.Column(db.Text, nullable=False)
     bot_response = db.Column(db.Text, nullable=False)
     language = db.Column(db.String(5), nullable=False, default='ru')
     response_time = db.Column(db.Float)  # Response time in seconds
+    first_token_time = db.Column(db.Float)  # Time to first streamed token in seconds (streaming endpoint only)
+    stage_timings = db.Column(db.JSON)  # Milliseconds per pipeline stage, e.g. {"route": 0.4, "kb": 12.1, "llm": 830.0}
     
     # Agent tracking fields
     agent_type = db.Column(db.String(50))  # Type of agent that handled the query
     agent_name = db.Column(db.String(100))  # Name of the agent
     agent_confidence = db.Column(db.Float)  # Confidence score of the selected agent
     context_used = db.Column(db.Boolean, default=False)  # Whether FAQ context was used
+    response_source = db.Column(db.String(20), default='llm')  # llm, faq (direct answer), cache, coalesced, fallback
+    question_hash = db.Column(db.String(40), index=True)  # Normalized question key for the response cache
     
     session_id = db.Column(db.String(100))
     ip_address = db.Column(db.String(45))
     user_agent = db.Column(db.String(500))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # Start of bot_response, filled only by queries that ask for it (admin list)
+    bot_response_preview = db.query_expression()
+    
     def __repr__(self):
         return f'<UserQuery {self.user_message[:30]}...>'
 
+class QueryRollup(db.Model):
+    """Hourly and daily aggregates of user_queries, updated with every logged batch"""
+    __tablename__ = 'query_rollups'
+    __table_args__ = (
+        db.UniqueConstraint('period', 'bucket_start', 'agent_type', 'agent_name', 'language', 'context_used',
+                            name='uq_query_rollups_key'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    period = db.Column(db.String(5), nullable=False)  # 'hour' or 'day'
+    bucket_start = db.Column(db.DateTime, nullable=False, index=True)
+    # Key columns use '' instead of NULL so that the unique key (and upserts on it) work
+    agent_type = db.Column(db.String(50), nullable=False, default='')
+    agent_name = db.Column(db.String(100), nullable=False, default='')
+    language = db.Column(db.String(5), nullable=False, default='')
+    context_used = db.Column(db.Boolean, nullable=False, default=False)
+    
+    query_count = db.Column(db.Integer, nullable=False, default=0)
+    response_time_sum = db.Column(db.Float, nullable=False, default=0.0)
+    response_time_count = db.Column(db.Integer, nullable=False, default=0)
+    confidence_sum = db.Column(db.Float, nullable=False, default=0.0)
+    confidence_count = db.Column(db.Integer, nullable=False, default=0)
+    confident_count = db.Column(db.Integer, nullable=False, default=0)  # agent_confidence >= 0.5
+    # Response time histogram (count per bucket, upper bounds in rollups.LATENCY_BUCKETS)
+    latency_le_0_5 = db.Column(db.Integer, nullable=False, default=0)
+    latency_le_1 = db.Column(db.Integer, nullable=False, default=0)
+    latency_le_2 = db.Column(db.Integer, nullable=False, default=0)
+    latency_le_5 = db.Column(db.Integer, nullable=False, default=0)
+    latency_le_10 = db.Column(db.Integer, nullable=False, default=0)
+    latency_gt_10 = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<QueryRollup {self.period} {self.bucket_start} {self.agent_type}>'
+
 class Document(db.Model):
     __tablename__ = 'documents'
     
@@ -87,12 +131,15 @@ class Document(db.Model):
     file_type = db.Column(db.String(50), nullable=False)  # pdf, doc, txt, etc.
     file_size = db.Column(db.Integer)  # Size in bytes
     content_text = db.Column(db.Text)  # Extracted text content
+    content_hash = db.Column(db.String(64))  # SHA-256 of content_text when its chunks were last synced
     is_processed = db.Column(db.Boolean, default=False)
     is_active = db.Column(db.Boolean, default=True)
     uploaded_by = db.Column(db.Integer, db.ForeignKey('admin_users.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    content_preview = db.query_expression()  # Start of content_text (admin list)
+    
     def __repr__(self):
         return f'<Document {self.title}>'
 
@@ -103,6 +150,7 @@ class WebSource(db.Model):
     title = db.Column(db.String(200), nullable=False)
     url = db.Column(db.String(500), nullable=False)
     content_text = db.Column(db.Text)  # Extracted text content
+    content_hash = db.Column(db.String(64))  # SHA-256 of content_text when its chunks were last synced
     last_scraped = db.Column(db.DateTime)
     is_active = db.Column(db.Boolean, default=True)
     scrape_frequency = db.Column(db.String(20), default='daily')  # daily, weekly, manual
@@ -110,24 +158,61 @@ class WebSource(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    content_preview = db.query_expression()  # Start of content_text (admin list)
+    
     def __repr__(self):
         return f'<WebSource {self.title}>'
 
 class KnowledgeBase(db.Model):
     __tablename__ = 'knowledge_base'
+    __table_args__ = (
+        db.Index('ix_knowledge_base_created_at_id', 'created_at', 'id'),  # Keyset pagination in the admin
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     source_type = db.Column(db.String(20), nullable=False)  # 'document', 'web', 'manual'
     source_id = db.Column(db.Integer)  # Foreign key to Document or WebSource
     content_chunk = db.Column(db.Text, nullable=False)
+    chunk_hash = db.Column(db.String(64))  # SHA-256 of content_chunk, matches unchanged chunks on re-ingest
+    language = db.Column(db.String(5))  # Detected chunk language (ru/kz)
+    search_tokens = db.Column(db.Text)  # Space-separated stems, computed at ingest time
     extra_data = db.Column(db.JSON)  # Additional metadata like page numbers, sections, etc.
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    content_preview = db.query_expression()  # Start of content_chunk (admin list)
+    
     def __repr__(self):
         return f'<KnowledgeBase {self.source_type}:{self.source_id}>'
 
+class IngestionJob(db.Model):
+    """Knowledge base update waiting for or run by the ingestion worker (ingestion_jobs.py)"""
+    __tablename__ = 'ingestion_jobs'
+    __table_args__ = (
+        db.Index('ix_ingestion_jobs_status_run_after', 'status', 'run_after'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    job_type = db.Column(db.String(20), nullable=False)  # 'document', 'web', 'embeddings' or 'rollups'
+    source_id = db.Column(db.Integer, nullable=False)  # Document or WebSource id (0 for 'embeddings' and 'rollups')
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, succeeded, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)  # Not claimed before (retry backoff)
+    progress_current = db.Column(db.Integer, nullable=False, default=0)  # Pages extracted so far
+    progress_total = db.Column(db.Integer)
+    last_error = db.Column(db.Text)
+    locked_by = db.Column(db.String(100))  # Worker running the job
+    heartbeat_at = db.Column(db.DateTime)  # Refreshed while running; stale jobs are requeued
+    created_by = db.Column(db.Integer, db.ForeignKey('admin_users.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    
+    def __repr__(self):
+        return f'<IngestionJob {self.job_type}:{self.source_id} {self.status}>'
+
 class AdminUser(db.Model):
     __tablename__ = 'admin_users'
     
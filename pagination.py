@@ -0,0 +1,83 @@
+"""Keyset (cursor) pagination for the admin list views
+
+Rows are shown newest first by (created_at, id). A page is addressed by the
+key of the row next to it instead of an OFFSET, so a deep page of the query
+log is the same index range scan as the first one, and no COUNT(*) is run.
+"""
+from datetime import datetime
+from typing import Any, List, Optional, Tuple
+
+from sqlalchemy import tuple_
+
+CURSOR_TIME_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+class KeysetPage:
+    """One page of rows plus the cursors of its neighbours (None = no such page)"""
+
+    def __init__(self, items: List[Any], per_page: int, next_cursor: Optional[str] = None,
+                 prev_cursor: Optional[str] = None, is_first: bool = True):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.is_first = is_first
+
+    @property
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self) -> bool:
+        return self.prev_cursor is not None
+
+
+def encode_cursor(row) -> str:
+    return f"{row.created_at.strftime(CURSOR_TIME_FORMAT)}-{row.id}"
+
+
+def decode_cursor(value: Optional[str]) -> Optional[Tuple[datetime, int]]:
+    """(created_at, id) of a cursor; None for a missing or malformed one"""
+    if not value:
+        return None
+    try:
+        moment, row_id = value.split('-', 1)
+        return datetime.strptime(moment, CURSOR_TIME_FORMAT), int(row_id)
+    except ValueError:
+        return None
+
+
+def paginate(query, model, per_page: int = 20, after: Optional[str] = None,
+             before: Optional[str] = None) -> KeysetPage:
+    """Page of `query` after the `after` cursor (older rows) or before `before` (newer rows)
+
+    `model` must have created_at and id columns; an index on (created_at, id)
+    makes every page an index range scan.
+    """
+    key = tuple_(model.created_at, model.id)
+    newer_than = decode_cursor(before)
+    if newer_than is not None:
+        # Walk back towards the newest rows, then show them newest first again
+        rows = query.filter(key > tuple_(*newer_than)).order_by(
+            model.created_at.asc(), model.id.asc()
+        ).limit(per_page + 1).all()
+        if rows:
+            more_newer = len(rows) > per_page
+            rows = rows[:per_page]
+            rows.reverse()
+            return KeysetPage(rows, per_page,
+                              next_cursor=encode_cursor(rows[-1]),
+                              prev_cursor=encode_cursor(rows[0]) if more_newer else None,
+                              is_first=not more_newer)
+        after = None
+
+    older_than = decode_cursor(after)
+    if older_than is not None:
+        query = query.filter(key < tuple_(*older_than))
+    rows = query.order_by(model.created_at.desc(), model.id.desc()).limit(per_page + 1).all()
+    more_older = len(rows) > per_page
+    rows = rows[:per_page]
+    return KeysetPage(rows, per_page,
+                      next_cursor=encode_cursor(rows[-1]) if more_older else None,
+                      prev_cursor=encode_cursor(rows[0]) if older_than is not None and rows else None,
+                      is_first=older_than is None)
@@ -0,0 +1,184 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, List
+
+logger = logging.getLogger(__name__)
+
+# Chat records are queued and inserted in batches by a background thread (false: insert inline)
+WRITE_BEHIND = os.environ.get("QUERY_LOG_WRITE_BEHIND", "true").lower() in ("1", "true", "yes")
+# A batch is written when it has this many records or its oldest record waited this long
+BATCH_SIZE = int(os.environ.get("QUERY_LOG_BATCH_SIZE", "100"))
+FLUSH_INTERVAL = float(os.environ.get("QUERY_LOG_FLUSH_SECONDS", "1"))
+# Records waiting for the flusher; when full, the chat request writes its record itself
+QUEUE_SIZE = int(os.environ.get("QUERY_LOG_QUEUE_SIZE", "5000"))
+
+
+def insert_rows(rows: List[Dict[str, Any]]):
+    """One multi-row INSERT (executemany) into user_queries plus the matching
+    rollup increments, in one transaction; needs an app context"""
+    from sqlalchemy import insert
+    from models import UserQuery
+    from app import db
+    from stage_timing import StageTimings
+    import rollups
+
+    for row in rows:
+        # Converted only now, so the 'db' stage that handed the row over is included
+        if isinstance(row.get('stage_timings'), StageTimings):
+            row['stage_timings'] = row['stage_timings'].as_ms()
+    try:
+        db.session.execute(insert(UserQuery), rows)
+        rollups.record(rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+class QueryLogWriter:
+    """Write-behind buffer of UserQuery rows
+
+    write() only puts the row in a bounded queue; a daemon thread drains it
+    and inserts the rows in batches. Nothing is dropped: a full queue makes
+    the caller insert synchronously, a failed batch is retried row by row,
+    and close() (at exit or ASGI shutdown) writes whatever is still queued.
+    """
+
+    def __init__(self, batch_size: int = BATCH_SIZE, flush_interval: float = FLUSH_INTERVAL,
+                 queue_size: int = QUEUE_SIZE):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: 'queue.Queue[Dict[str, Any]]' = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._state_lock = threading.Lock()
+        self._closed = False
+        self.queued = 0
+        self.written = 0
+        self.batches = 0
+        self.sync_writes = 0
+        self.failed = 0
+
+    def write(self, row: Dict[str, Any]):
+        """Queue a row for the flusher, or insert it now if the queue is full or closed"""
+        with self._state_lock:
+            if not self._closed:
+                self._ensure_started()
+                try:
+                    self._queue.put_nowait(row)
+                    self.queued += 1
+                    return
+                except queue.Full:
+                    logger.warning("Query log queue is full, writing synchronously")
+        self.sync_writes += 1
+        insert_rows([row])
+
+    def _ensure_started(self):
+        # Started lazily: gunicorn forks workers after the app module was imported
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='query-log-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        from app import app
+
+        with app.app_context():
+            while not self._closed:
+                batch = self._next_batch()
+                if batch:
+                    self._flush(batch)
+
+    def _next_batch(self) -> List[Dict[str, Any]]:
+        """Block for the first row, then collect until the batch is full or the interval passed"""
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch: List[Dict[str, Any]]):
+        try:
+            insert_rows(batch)
+            self.batches += 1
+            self.written += len(batch)
+        except Exception as e:
+            logger.error(f"Query log batch of {len(batch)} failed, retrying row by row: {str(e)}")
+            # One bad row must not take the whole batch down with it
+            for row in batch:
+                try:
+                    insert_rows([row])
+                    self.written += 1
+                except Exception as row_error:
+                    self.failed += 1
+                    logger.error(f"Query log row could not be written: {str(row_error)}")
+
+    def drain(self):
+        """Write every queued row now (needs an app context)"""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) >= self.batch_size:
+                self._flush(batch)
+                batch = []
+        if batch:
+            self._flush(batch)
+
+    def close(self, timeout: float = 5.0):
+        """Stop the flusher and write the remaining rows; later writes go inline"""
+        with self._state_lock:
+            if self._closed:
+                return
+            self._closed = True
+        if self._thread is not None:
+            self._thread.join(timeout)
+        elif self._queue.empty():
+            return
+        from app import app
+
+        with app.app_context():
+            self.drain()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'write_behind': True,
+            'queue_depth': self._queue.qsize(),
+            'enqueued': self.queued,
+            'written': self.written,
+            'batches': self.batches,
+            'sync_writes': self.sync_writes,
+            'failed': self.failed,
+        }
+
+
+def write(row: Dict[str, Any]):
+    """Store one UserQuery row (dict of column values) through the configured path"""
+    if query_log is None:
+        insert_rows([row])
+    else:
+        query_log.write(row)
+
+
+def stats() -> Dict[str, Any]:
+    if query_log is None:
+        return {'write_behind': False}
+    return query_log.stats()
+
+
+query_log = QueryLogWriter() if WRITE_BEHIND else None
+if query_log is not None:
+    atexit.register(query_log.close)
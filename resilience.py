@@ -0,0 +1,259 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Optional, TypeVar
+
+from metrics import LLM_LATENCY
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Consecutive failures (errors or SLO breaches) that open the breaker
+FAILURE_THRESHOLD = int(os.environ.get("MISTRAL_BREAKER_FAILURES", "5"))
+# Seconds the breaker stays open before a single probe request is let through
+RESET_TIMEOUT = float(os.environ.get("MISTRAL_BREAKER_RESET_SECONDS", "30"))
+# A successful call slower than this counts as a failure for the breaker
+LATENCY_SLO = float(os.environ.get("MISTRAL_LATENCY_SLO_SECONDS", "10"))
+# Extra attempts per call, further limited by the retry budget
+MAX_RETRIES = int(os.environ.get("MISTRAL_MAX_RETRIES", "1"))
+# Retries may add at most this fraction of traffic on top of the regular requests
+RETRY_BUDGET_RATIO = float(os.environ.get("MISTRAL_RETRY_BUDGET_RATIO", "0.1"))
+# Send a second request when the first has not answered by the recent p95 latency
+HEDGING_ENABLED = os.environ.get("MISTRAL_HEDGING", "false").lower() in ("1", "true", "yes")
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a backend that is known to be failing"""
+
+
+class CircuitBreaker:
+    """Closed -> open after consecutive failures -> half-open probe after a timeout"""
+
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD, reset_timeout: float = RESET_TIMEOUT,
+                 latency_slo: float = LATENCY_SLO):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.latency_slo = latency_slo
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self.rejected = 0
+        self.slo_breaches = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self, latency: float):
+        with self._lock:
+            if latency > self.latency_slo:
+                self.slo_breaches += 1
+                self._failure()
+                return
+            if self.state != CLOSED:
+                logger.info("Circuit breaker closed")
+            self.state = CLOSED
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failure()
+
+    def release_probe(self):
+        with self._lock:
+            self._probe_in_flight = False
+
+    def _failure(self):
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != OPEN:
+                self.trips += 1
+                logger.warning(f"Circuit breaker opened after {self.consecutive_failures} failures")
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+
+class RetryBudget:
+    """Token bucket filled by regular requests and drained by retries
+
+    Every request deposits `ratio` tokens and a retry costs one, so in a
+    sustained outage retries add at most `ratio` extra load instead of
+    multiplying it. A small reserve lets an idle process retry at all.
+    """
+
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, reserve: float = 3.0, capacity: float = 10.0):
+        self.ratio = ratio
+        self.capacity = max(capacity, reserve)
+        self.tokens = reserve
+        self.exhausted = 0
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        with self._lock:
+            self.tokens = min(self.tokens + self.ratio, self.capacity)
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return True
+            self.exhausted += 1
+            return False
+
+
+class LatencyTracker:
+    """Recent call latencies for percentile estimates"""
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, latency: float):
+        with self._lock:
+            self._samples.append(latency)
+
+    def percentile(self, percent: float) -> Optional[float]:
+        """None until enough samples were collected"""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(int(len(ordered) * percent / 100), len(ordered) - 1)]
+
+
+class ResiliencePolicy:
+    """Circuit breaker, budgeted retries and optional hedging around a backend call"""
+
+    def __init__(self, breaker: CircuitBreaker, budget: RetryBudget, max_retries: int = MAX_RETRIES,
+                 hedging: bool = HEDGING_ENABLED, hedge_workers: int = 20):
+        self.breaker = breaker
+        self.budget = budget
+        self.latency = LatencyTracker()
+        self.max_retries = max_retries
+        self.hedging = hedging
+        self._hedge_executor = ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix='llm-hedge') if hedging else None
+        self.calls = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Count the call and refuse it while the breaker is open"""
+        if not self.breaker.allow_request():
+            raise CircuitOpenError("LLM circuit breaker is open")
+        with self._lock:
+            self.calls += 1
+        self.budget.record_request()
+
+    def on_success(self, latency: float):
+        self.latency.record(latency)
+        LLM_LATENCY.observe(latency)
+        self.breaker.record_success(latency)
+
+    def on_failure(self, attempt: int, retriable: bool = True) -> bool:
+        """Record a failed attempt; True if the caller may try again"""
+        self.breaker.record_failure()
+        if not retriable or attempt >= self.max_retries:
+            return False
+        if not self.breaker.allow_request() or not self.budget.try_spend():
+            return False
+        with self._lock:
+            self.retries += 1
+        return True
+
+    def backoff(self, attempt: int) -> float:
+        """Short jittered pause before a retry, so retries of many workers do not arrive together"""
+        return random.uniform(0.05, 0.2) * attempt
+
+    def cancel(self):
+        """The call was abandoned without an outcome (e.g. the client went away)"""
+        self.breaker.release_probe()
+
+    def call(self, func: Callable[[], T], is_retriable: Callable[[Exception], bool] = lambda e: True) -> T:
+        """Run func under the policy; raises CircuitOpenError or the last error of func"""
+        self.before_call()
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                result = self._hedged(func) if self._hedge_executor else func()
+            except Exception as e:
+                if self.on_failure(attempt, is_retriable(e)):
+                    attempt += 1
+                    logger.warning(f"Retrying LLM call after error: {str(e)}")
+                    time.sleep(self.backoff(attempt))
+                    continue
+                raise
+            self.on_success(time.monotonic() - start)
+            return result
+
+    def _hedged(self, func: Callable[[], T]) -> T:
+        """Start a duplicate call if the first one is slower than the recent p95"""
+        delay = self.latency.percentile(95)
+        primary = self._hedge_executor.submit(func)
+        if delay is None:
+            return primary.result()
+
+        done, _ = wait([primary], timeout=delay)
+        if done or not self.budget.try_spend():
+            return primary.result()
+
+        with self._lock:
+            self.hedges += 1
+        hedge = self._hedge_executor.submit(func)
+        done, _ = wait([primary, hedge], return_when=FIRST_COMPLETED)
+        winner = done.pop()
+        other = hedge if winner is primary else primary
+        if winner.exception() is not None:
+            # The faster one failed; the answer now depends on the other
+            winner = other
+        if winner is hedge:
+            with self._lock:
+                self.hedge_wins += 1
+        return winner.result()
+
+    def stats(self) -> Dict[str, float]:
+        p95 = self.latency.percentile(95)
+        with self._lock:
+            return {
+                'breaker_state': self.breaker.state,
+                'breaker_trips': self.breaker.trips,
+                'consecutive_failures': self.breaker.consecutive_failures,
+                'rejected_calls': self.breaker.rejected,
+                'slo_breaches': self.breaker.slo_breaches,
+                'calls': self.calls,
+                'retries': self.retries,
+                'retry_budget_exhausted': self.budget.exhausted,
+                'hedges': self.hedges,
+                'hedge_wins': self.hedge_wins,
+                'latency_p95': round(p95, 3) if p95 is not None else None,
+            }
+
+
+# Shared by the sync and async Mistral clients of this process
+llm_policy = ResiliencePolicy(CircuitBreaker(), RetryBudget())
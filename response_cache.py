@@ -0,0 +1,185 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, FrozenSet, Optional, Tuple
+
+import search_index
+from text_processing import normalize_text, question_similarity, question_terms
+
+logger = logging.getLogger(__name__)
+
+MAX_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "2000"))
+TTL_SECONDS = float(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", "86400"))
+# Jaccard similarity of stems for a near-duplicate hit; 0 disables fuzzy matching.
+# Questions with different question words or negation never match (see question_similarity)
+SIMILARITY_THRESHOLD = float(os.environ.get("RESPONSE_CACHE_SIMILARITY", "0.9"))
+
+
+def question_hash(message: str, language: str, agent_type: str) -> str:
+    """Stable key of a normalized question, stored on UserQuery for history lookups"""
+    key = f"{language}|{agent_type}|{normalize_text(message)}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class _Entry:
+    __slots__ = ('response', 'terms', 'expires')
+
+    def __init__(self, response: str, terms: FrozenSet[str], expires: float):
+        self.response = response
+        self.terms = terms
+        self.expires = expires
+
+
+class ResponseCache:
+    """LRU/TTL cache of LLM answers keyed on (normalized question, language, agent type)
+
+    Misses fall through to recent UserQuery rows with the same question hash, so a
+    restarted worker (or a different one) reuses answers already given.
+    """
+
+    def __init__(self, max_size: int = MAX_SIZE, ttl: float = TTL_SECONDS,
+                 similarity: float = SIMILARITY_THRESHOLD):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity = similarity
+        self._entries: 'OrderedDict[str, _Entry]' = OrderedDict()
+        # (language, agent_type) -> keys, scanned for near-duplicates
+        self._buckets: Dict[Tuple[str, str], set] = {}
+        self._lock = threading.Lock()
+        # Answers logged before this moment may be based on outdated content
+        self._valid_since = datetime.min
+        self.hits = 0
+        self.near_hits = 0
+        self.history_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, message: str, language: str, agent_type: str) -> Optional[str]:
+        """Cached answer for the question, or None"""
+        # Also notices FAQ/KB changes made by other workers and clears us via the callback
+        search_index.get_content_version()
+
+        key = question_hash(message, language, agent_type)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.response
+
+            if self.similarity > 0:
+                response = self._find_similar(message, language, agent_type, now)
+                if response is not None:
+                    self.near_hits += 1
+                    return response
+
+        response = self._find_in_history(key)
+        with self._lock:
+            if response is None:
+                self.misses += 1
+                return None
+            self.history_hits += 1
+            self._store(key, message, language, agent_type, response)
+        return response
+
+    def put(self, message: str, language: str, agent_type: str, response: str):
+        """Remember an answer produced by the LLM"""
+        key = question_hash(message, language, agent_type)
+        with self._lock:
+            self._store(key, message, language, agent_type, response)
+
+    def clear(self):
+        """Drop everything; called when FAQ or knowledge base content changes"""
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+            self._valid_since = datetime.utcnow()
+        logger.info("Response cache invalidated")
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.near_hits + self.history_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'near_hits': self.near_hits,
+                'history_hits': self.history_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round((lookups - self.misses) / lookups * 100, 1) if lookups else 0.0,
+            }
+
+    def _store(self, key: str, message: str, language: str, agent_type: str, response: str):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+        self._entries[key] = _Entry(
+            response, frozenset(question_terms(message, language)), time.monotonic() + self.ttl
+        )
+        self._buckets.setdefault((language, agent_type), set()).add(key)
+
+        while len(self._entries) > self.max_size:
+            old_key, _ = self._entries.popitem(last=False)
+            self._forget(old_key)
+            self.evictions += 1
+
+    def _forget(self, key: str):
+        for bucket in self._buckets.values():
+            bucket.discard(key)
+
+    def _find_similar(self, message: str, language: str, agent_type: str, now: float) -> Optional[str]:
+        terms = frozenset(question_terms(message, language))
+        if not terms:
+            return None
+
+        best_key, best_score = None, 0.0
+        expired = []
+        for key in self._buckets.get((language, agent_type), ()):
+            entry = self._entries[key]
+            if entry.expires <= now:
+                expired.append(key)
+                continue
+            score = question_similarity(terms, entry.terms)
+            if score > best_score:
+                best_key, best_score = key, score
+
+        for key in expired:
+            del self._entries[key]
+            self._forget(key)
+
+        if best_key is not None and best_score >= self.similarity:
+            self._entries.move_to_end(best_key)
+            return self._entries[best_key].response
+        return None
+
+    def _find_in_history(self, key: str) -> Optional[str]:
+        """Most recent LLM answer logged for the same question within the TTL"""
+        try:
+            from models import UserQuery
+
+            since = max(datetime.utcnow() - timedelta(seconds=self.ttl), self._content_changed_at())
+            row = UserQuery.query.with_entities(UserQuery.bot_response).filter(
+                UserQuery.question_hash == key,
+                UserQuery.response_source == 'llm',
+                UserQuery.created_at >= since
+            ).order_by(UserQuery.created_at.desc()).first()
+            return row[0] if row else None
+        except Exception as e:
+            logger.warning(f"Response history lookup failed: {str(e)}")
+            return None
+
+    def _content_changed_at(self) -> datetime:
+        """Latest FAQ/KB modification time known to this worker"""
+        _, faq_updated, _, kb_updated = search_index.get_content_version()
+        candidates = [self._valid_since] + [value for value in (faq_updated, kb_updated)
+                                            if isinstance(value, datetime)]
+        return max(candidates)
+
+
+response_cache = ResponseCache()
+search_index.on_invalidate(response_cache.clear)
@@ -0,0 +1,167 @@
+"""Hourly and daily rollups of user_queries for the admin analytics
+
+Every batch written by the query log adds its counts to the matching
+QueryRollup rows in the same transaction (an upsert that increments the
+counters), so the analytics endpoints read O(days x agents) rows instead
+of scanning the whole query log. Queries logged before the rollups
+existed are aggregated by a one-off 'rollups' ingestion job, queued by the
+admin dashboard when it finds them missing (see backfill_pending), or by
+the catch-up job:
+
+    python rollups.py [days]
+"""
+import logging
+import sys
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+PERIODS = ('hour', 'day')
+# Counted as a successful (confident) answer in the summary
+CONFIDENT_THRESHOLD = 0.5
+# Upper bound in seconds -> histogram column
+LATENCY_BUCKETS = (
+    (0.5, 'latency_le_0_5'),
+    (1.0, 'latency_le_1'),
+    (2.0, 'latency_le_2'),
+    (5.0, 'latency_le_5'),
+    (10.0, 'latency_le_10'),
+    (float('inf'), 'latency_gt_10'),
+)
+KEY_COLUMNS = ('period', 'bucket_start', 'agent_type', 'agent_name', 'language', 'context_used')
+SUM_COLUMNS = (
+    'query_count', 'response_time_sum', 'response_time_count',
+    'confidence_sum', 'confidence_count', 'confident_count',
+) + tuple(column for _, column in LATENCY_BUCKETS)
+
+RollupKey = Tuple[str, datetime, str, str, str, bool]
+
+
+def bucket_start(moment: datetime, period: str) -> datetime:
+    if period == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def aggregate(rows: Iterable[Dict[str, Any]],
+              totals: Optional[Dict[RollupKey, Dict[str, float]]] = None) -> Dict[RollupKey, Dict[str, float]]:
+    """Add user_queries rows (dicts of column values) to per-bucket totals"""
+    totals = {} if totals is None else totals
+    for row in rows:
+        created_at = row.get('created_at') or datetime.utcnow()
+        response_time = row.get('response_time')
+        confidence = row.get('agent_confidence')
+        for period in PERIODS:
+            key = (period, bucket_start(created_at, period), row.get('agent_type') or '',
+                   row.get('agent_name') or '', row.get('language') or '', bool(row.get('context_used')))
+            counts = totals.get(key)
+            if counts is None:
+                counts = totals[key] = dict.fromkeys(SUM_COLUMNS, 0)
+            counts['query_count'] += 1
+            if response_time is not None:
+                counts['response_time_sum'] += response_time
+                counts['response_time_count'] += 1
+                for bound, column in LATENCY_BUCKETS:
+                    if response_time <= bound:
+                        counts[column] += 1
+                        break
+            if confidence is not None:
+                counts['confidence_sum'] += confidence
+                counts['confidence_count'] += 1
+                if confidence >= CONFIDENT_THRESHOLD:
+                    counts['confident_count'] += 1
+    return totals
+
+
+def apply(totals: Dict[RollupKey, Dict[str, float]]):
+    """Increment the rollup rows by the totals in the current session (the caller commits)"""
+    from app import db
+    from models import QueryRollup
+
+    if not totals:
+        return
+    params = [dict(zip(KEY_COLUMNS, key), **counts) for key, counts in totals.items()]
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        table = QueryRollup.__table__
+        statement = insert(table)
+        # Concurrent workers add to the same rows; the increment happens inside the database
+        statement = statement.on_conflict_do_update(
+            index_elements=list(KEY_COLUMNS),
+            set_={column: table.c[column] + statement.excluded[column] for column in SUM_COLUMNS}
+        )
+        db.session.execute(statement, params)
+        return
+
+    # Other databases: read-modify-write through the ORM
+    for values in params:
+        rollup = QueryRollup.query.filter_by(**{column: values[column] for column in KEY_COLUMNS}).first()
+        if rollup is None:
+            db.session.add(QueryRollup(**values))
+        else:
+            for column in SUM_COLUMNS:
+                setattr(rollup, column, getattr(rollup, column) + values[column])
+
+
+def record(rows: Iterable[Dict[str, Any]]):
+    """Add freshly logged queries to the rollups (same transaction as their insert)"""
+    apply(aggregate(rows))
+
+
+def rebuild(days: Optional[int] = None, batch_size: int = 10000) -> int:
+    """Recompute the rollups from user_queries (all of it, or the last `days` days)
+
+    Returns the number of queries aggregated. Queries logged while the
+    rebuild runs may be counted twice, so run it when traffic is low.
+    """
+    from app import db
+    from models import QueryRollup, UserQuery
+
+    since = bucket_start(datetime.utcnow() - timedelta(days=days), 'day') if days else None
+    rollups = QueryRollup.query
+    if since is not None:
+        rollups = rollups.filter(QueryRollup.bucket_start >= since)
+    rollups.delete(synchronize_session=False)
+
+    columns = [UserQuery.created_at, UserQuery.agent_type, UserQuery.agent_name, UserQuery.language,
+               UserQuery.context_used, UserQuery.response_time, UserQuery.agent_confidence]
+    query = db.session.query(*columns)
+    if since is not None:
+        query = query.filter(UserQuery.created_at >= since)
+
+    totals: Dict[RollupKey, Dict[str, float]] = {}
+    count = 0
+    # Only the small columns are streamed; the totals stay O(hours x agents)
+    for row in query.yield_per(batch_size):
+        aggregate([row._asdict()], totals)
+        count += 1
+    apply(totals)
+    db.session.commit()
+    logger.info(f"Rebuilt query rollups from {count} queries")
+    return count
+
+
+def backfill_pending() -> bool:
+    """Whether user_queries has queries older than the rollups (e.g. logged before an upgrade)"""
+    from sqlalchemy import func
+    from app import db
+    from models import QueryRollup, UserQuery
+
+    first_query = db.session.query(func.min(UserQuery.created_at)).scalar()
+    if first_query is None:
+        return False
+    first_bucket = db.session.query(func.min(QueryRollup.bucket_start)).filter(
+        QueryRollup.period == 'day').scalar()
+    return first_bucket is None or first_query < first_bucket
+
+
+if __name__ == '__main__':
+    from app import app
+
+    with app.app_context():
+        rebuild(int(sys.argv[1]) if len(sys.argv) > 1 else None)
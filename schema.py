@@ -0,0 +1,92 @@
+"""Idempotent schema upgrades for databases created by an older version of the models
+
+db.create_all() only creates missing tables. Columns and indexes that were
+added to existing tables later are added here at startup (the same way
+fulltext_search.ensure_fulltext_schema works), and knowledge base chunks
+stored before chunk_hash/search_tokens existed get them backfilled.
+Every step is safe to run again and from several workers at once.
+"""
+import logging
+
+from sqlalchemy import inspect, select, text, update
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.schema import CreateIndex
+
+from app import db
+
+logger = logging.getLogger(__name__)
+
+# Chunks backfilled per UPDATE
+BACKFILL_BATCH_SIZE = 500
+
+
+def _add_missing_columns():
+    engine = db.engine
+    dialect = engine.dialect.name
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            # Always nullable: existing rows have no value (the model default applies to new rows)
+            column_type = column.type.compile(dialect=engine.dialect)
+            if_not_exists = 'IF NOT EXISTS ' if dialect == 'postgresql' else ''
+            statement = f'ALTER TABLE {table.name} ADD COLUMN {if_not_exists}{column.name} {column_type}'
+            try:
+                with engine.begin() as connection:
+                    connection.execute(text(statement))
+                logger.info(f"Added column {table.name}.{column.name}")
+            except (OperationalError, ProgrammingError) as e:
+                # SQLite has no IF NOT EXISTS: another worker may have added it first
+                if 'duplicate column' not in str(e).lower():
+                    raise
+
+
+def _create_missing_indexes():
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                connection.execute(CreateIndex(index, if_not_exists=True))
+
+
+def backfill_knowledge_base(batch_size: int = BACKFILL_BATCH_SIZE) -> int:
+    """Fill chunk_hash, language and search_tokens of chunks stored without them"""
+    from document_processor import content_hash
+    from models import KnowledgeBase
+    from text_processing import chunk_terms
+
+    missing = (KnowledgeBase.chunk_hash.is_(None)) | (KnowledgeBase.search_tokens.is_(None))
+    total = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(KnowledgeBase.id, KnowledgeBase.content_chunk)
+            .where(missing, KnowledgeBase.id > last_id)
+            .order_by(KnowledgeBase.id).limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        updates = []
+        for row in rows:
+            language, search_tokens = chunk_terms(row.content_chunk)
+            updates.append({'id': row.id, 'chunk_hash': content_hash(row.content_chunk),
+                            'language': language, 'search_tokens': search_tokens})
+        # ORM bulk UPDATE by primary key
+        db.session.execute(update(KnowledgeBase), updates)
+        db.session.commit()
+        total += len(rows)
+        last_id = rows[-1].id
+    if total:
+        logger.info(f"Backfilled search terms of {total} knowledge base chunks")
+    return total
+
+
+def ensure_schema():
+    """Bring an existing database up to the current models (run after db.create_all())"""
+    _add_missing_columns()
+    _create_missing_indexes()
+    backfill_knowledge_base()
@@ -0,0 +1,214 @@
+import heapq
+import logging
+import math
+import os
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from text_processing import LANGUAGES, analyze, chunk_terms, query_terms
+
+logger = logging.getLogger(__name__)
+
+# How often (seconds) a worker re-checks the FAQ/KB tables for changes
+REFRESH_INTERVAL = float(os.environ.get("SEARCH_INDEX_REFRESH_SECONDS", "30"))
+
+
+class BM25Index:
+    """Inverted index with Okapi BM25 scoring"""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_ids: List[int] = []
+        self.doc_lengths: List[int] = []
+        # term -> [(internal doc number, term frequency), ...]
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        self.idf: Dict[str, float] = {}
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def add(self, doc_id: int, tokens: Iterable[str]):
+        """Add a document to the index (call finalize() when done)"""
+        doc_number = len(self.doc_ids)
+        counts = Counter(tokens)
+        self.doc_ids.append(doc_id)
+        self.doc_lengths.append(sum(counts.values()))
+        for term, tf in counts.items():
+            self.postings.setdefault(term, []).append((doc_number, tf))
+
+    def finalize(self):
+        """Precompute IDF and fold document length normalisation into postings"""
+        total_docs = len(self.doc_ids)
+        if not total_docs:
+            return
+        avg_length = (sum(self.doc_lengths) / total_docs) or 1.0
+        norms = [self.k1 * (1 - self.b + self.b * length / avg_length)
+                 for length in self.doc_lengths]
+
+        for term, posting in self.postings.items():
+            df = len(posting)
+            self.idf[term] = math.log(1 + (total_docs - df + 0.5) / (df + 0.5))
+            # Store the ready-to-sum BM25 term weight instead of raw tf
+            self.postings[term] = [
+                (doc_number, tf * (self.k1 + 1) / (tf + norms[doc_number]))
+                for doc_number, tf in posting
+            ]
+
+    def search(self, query_tokens: Iterable[str], limit: int = 3) -> List[Tuple[int, float]]:
+        """Return [(doc_id, score), ...] ranked by BM25 score"""
+        scores: Dict[int, float] = {}
+        for term in set(query_tokens):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = self.idf[term]
+            for doc_number, weight in posting:
+                scores[doc_number] = scores.get(doc_number, 0.0) + idf * weight
+
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        return [(self.doc_ids[doc_number], score) for doc_number, score in best]
+
+
+class KnowledgeIndex:
+    """BM25 indexes over active FAQs and knowledge base chunks, split by language"""
+
+    def __init__(self):
+        self.faq: Dict[str, BM25Index] = {lang: BM25Index() for lang in LANGUAGES}
+        self.kb: Dict[str, BM25Index] = {lang: BM25Index() for lang in LANGUAGES}
+
+    @classmethod
+    def build(cls) -> 'KnowledgeIndex':
+        """Build the index from the current database contents"""
+        from app import db
+        from models import FAQ, KnowledgeBase
+        from sqlalchemy import case
+
+        index = cls()
+
+        faq_rows = db.session.query(
+            FAQ.id, FAQ.question_ru, FAQ.answer_ru, FAQ.question_kz, FAQ.answer_kz
+        ).filter(FAQ.is_active == True).all()
+        for faq_id, question_ru, answer_ru, question_kz, answer_kz in faq_rows:
+            # Questions are counted twice so that they outweigh long answers
+            question_tokens = analyze(question_ru, 'ru')
+            index.faq['ru'].add(faq_id, question_tokens * 2 + analyze(answer_ru, 'ru'))
+            question_tokens = analyze(question_kz, 'kz')
+            index.faq['kz'].add(faq_id, question_tokens * 2 + analyze(answer_kz, 'kz'))
+
+        # Chunk tokens are precomputed at ingest; only legacy rows need their text loaded
+        kb_rows = db.session.query(
+            KnowledgeBase.id,
+            KnowledgeBase.language,
+            KnowledgeBase.search_tokens,
+            case((KnowledgeBase.search_tokens.is_(None), KnowledgeBase.content_chunk), else_=None),
+        ).filter(KnowledgeBase.is_active == True).yield_per(500)
+        for kb_id, language, search_tokens, content_chunk in kb_rows:
+            if search_tokens is None:
+                language, search_tokens = chunk_terms(content_chunk)
+            index.kb[language if language in LANGUAGES else 'ru'].add(kb_id, search_tokens.split())
+
+        for lang in LANGUAGES:
+            index.faq[lang].finalize()
+            index.kb[lang].finalize()
+
+        logger.info(
+            f"Search index built: {len(faq_rows)} FAQs, "
+            f"{sum(len(index.kb[lang]) for lang in LANGUAGES)} knowledge base chunks"
+        )
+        return index
+
+    def search_faqs(self, query: str, language: str = 'ru', limit: int = 3) -> List[Tuple[int, float]]:
+        """Rank FAQ ids for the query in the given language"""
+        language = language if language in LANGUAGES else 'ru'
+        return self.faq[language].search(query_terms(query, language), limit)
+
+    def search_knowledge_base(self, query: str, language: str = 'ru', limit: int = 3) -> List[Tuple[int, float]]:
+        """Rank knowledge base ids, topping up from the other language if needed"""
+        language = language if language in LANGUAGES else 'ru'
+        results = self.kb[language].search(query_terms(query, language), limit)
+        if len(results) < limit:
+            for other in LANGUAGES:
+                if other != language:
+                    results.extend(self.kb[other].search(query_terms(query, other), limit - len(results)))
+        return results
+
+
+def get_content_signature() -> Tuple:
+    """Cheap fingerprint of FAQ and knowledge base contents"""
+    from app import db
+    from models import FAQ, KnowledgeBase
+    from sqlalchemy import func
+
+    faq_state = db.session.query(func.count(FAQ.id), func.max(FAQ.updated_at)).one()
+    kb_state = db.session.query(func.count(KnowledgeBase.id), func.max(KnowledgeBase.updated_at)).one()
+    return tuple(faq_state) + tuple(kb_state)
+
+
+_content_signature: Optional[Tuple] = None
+_content_checked = 0.0
+_signature_lock = threading.Lock()
+# Caches derived from FAQ/KB content that must be dropped when it changes
+_invalidation_callbacks: List[Callable[[], None]] = []
+
+
+def get_content_version() -> Tuple:
+    """Content fingerprint, re-read from the database at most every REFRESH_INTERVAL
+
+    When another worker (or this one) has changed FAQs or the knowledge base,
+    the registered invalidation callbacks run once the change is noticed.
+    """
+    global _content_signature, _content_checked
+
+    now = time.monotonic()
+    if _content_signature is not None and now - _content_checked < REFRESH_INTERVAL:
+        return _content_signature
+
+    with _signature_lock:
+        if _content_signature is not None and now - _content_checked < REFRESH_INTERVAL:
+            return _content_signature
+        signature = get_content_signature()
+        changed = _content_signature is not None and signature != _content_signature
+        _content_signature = signature
+        _content_checked = time.monotonic()
+
+    if changed:
+        for callback in _invalidation_callbacks:
+            callback()
+    return signature
+
+
+def on_invalidate(callback: Callable[[], None]):
+    """Register a callback to run whenever FAQ/KB content is known to have changed"""
+    _invalidation_callbacks.append(callback)
+
+
+def invalidate():
+    """Content was changed by this process: re-check the database on the next lookup"""
+    global _content_checked
+    with _signature_lock:
+        _content_checked = 0.0
+    for callback in _invalidation_callbacks:
+        callback()
+
+
+_index: Optional[KnowledgeIndex] = None
+_index_signature: Optional[Tuple] = None
+_lock = threading.Lock()
+
+
+def get_index() -> KnowledgeIndex:
+    """Return the process-wide index, rebuilding it when the data has changed"""
+    global _index, _index_signature
+
+    signature = get_content_version()
+    if _index is not None and signature == _index_signature:
+        return _index
+
+    with _lock:
+        if _index is None or signature != _index_signature:
+            _index = KnowledgeIndex.build()
+            _index_signature = signature
+        return _index
@@ -0,0 +1,291 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: cross-worker coalescing is not available
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# How long a duplicate request waits for the in-flight one before answering on its own
+WAIT_TIMEOUT = float(os.environ.get("SINGLE_FLIGHT_TIMEOUT", "35"))
+# Directory of per-question lock files shared by the workers of one host (empty disables)
+LOCK_DIR = os.environ.get("SINGLE_FLIGHT_LOCK_DIR", "")
+# Lock and result files older than this are removed
+FILE_MAX_AGE = 600
+_POLL_INTERVAL = 0.05
+
+
+class _Call:
+    __slots__ = ('event', 'result', 'waiters')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result: Optional[Dict[str, Any]] = None
+        self.waiters = 0
+
+
+class Flight:
+    """Membership of one request in a coalesced call
+
+    The leader computes the answer and must call complete(); followers find
+    the leader's answer in result (None if the leader failed or timed out,
+    in which case they answer on their own).
+    """
+
+    def __init__(self, owner: 'SingleFlight', key: str, call: _Call, leader: bool,
+                 result: Optional[Dict[str, Any]] = None, file_lock: Optional['_FileLock'] = None):
+        self._owner = owner
+        self._key = key
+        self._call = call
+        self._file_lock = file_lock
+        self.leader = leader
+        self.result = result
+
+    def complete(self, result: Optional[Dict[str, Any]]):
+        """Publish the leader's result (None on failure) and release the waiters"""
+        if not self.leader:
+            return
+        self.leader = False
+        if self._file_lock is not None:
+            if result is not None:
+                self._owner.lock_table.write_result(self._key, result)
+            self._file_lock.release()
+        self._owner._finish(self._key, self._call, result)
+
+
+class AsyncFlight(Flight):
+    """Flight of the event-loop variant; the waiters await an asyncio future"""
+
+    def __init__(self, owner: 'SingleFlight', key: str, future: asyncio.Future, leader: bool,
+                 result: Optional[Dict[str, Any]] = None):
+        super().__init__(owner, key, None, leader, result)
+        self._future = future
+
+    def complete(self, result: Optional[Dict[str, Any]]):
+        if not self.leader:
+            return
+        self.leader = False
+        if self._owner._async_calls.get(self._key) is self._future:
+            del self._owner._async_calls[self._key]
+        if not self._future.done():
+            self._future.set_result(result)
+
+
+class SingleFlight:
+    """Coalesces concurrent identical requests onto one computation
+
+    Within a process, threads asking the same key wait on the first one.
+    With a lock directory, the first worker to lock the key's file computes
+    the answer and leaves it next to the lock for the workers queued behind it.
+    """
+
+    def __init__(self, lock_dir: str = LOCK_DIR, timeout: float = WAIT_TIMEOUT):
+        self.timeout = timeout
+        self.lock_table = LockTable(lock_dir) if lock_dir and fcntl is not None else None
+        self._calls: Dict[str, _Call] = {}
+        self._async_calls: Dict[str, asyncio.Future] = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+        self.cross_worker = 0
+        self.timeouts = 0
+
+    def join(self, key: str) -> Flight:
+        """Become the leader for key, or wait for the current leader's result"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                call.waiters += 1
+
+        if not leader:
+            finished = call.event.wait(self.timeout)
+            with self._lock:
+                if not finished:
+                    self.timeouts += 1
+                if call.result is not None:
+                    self.coalesced += 1
+            return Flight(self, key, call, False, call.result)
+
+        file_lock = None
+        if self.lock_table is not None:
+            file_lock = self.lock_table.acquire(key, self.timeout)
+            if file_lock is not None and file_lock.waited:
+                # Another worker held the lock: its answer is probably waiting for us
+                shared = self.lock_table.read_result(key, newer_than=file_lock.wait_started)
+                if shared is not None:
+                    file_lock.release()
+                    with self._lock:
+                        self.cross_worker += 1
+                    self._finish(key, call, shared)
+                    return Flight(self, key, call, False, shared)
+
+        with self._lock:
+            self.leaders += 1
+        return Flight(self, key, call, True, file_lock=file_lock)
+
+    async def join_async(self, key: str) -> 'AsyncFlight':
+        """Event-loop variant of join() for the ASGI pipeline (coalesces within the process only)"""
+        future = self._async_calls.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._async_calls[key] = future
+            with self._lock:
+                self.leaders += 1
+            return AsyncFlight(self, key, future, True)
+
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            result = None
+        if result is not None:
+            with self._lock:
+                self.coalesced += 1
+        return AsyncFlight(self, key, future, False, result)
+
+    def _finish(self, key: str, call: _Call, result: Optional[Dict[str, Any]]):
+        call.result = result
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        call.event.set()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            in_flight = len(self._calls) + len(self._async_calls)
+            return {
+                'in_flight': in_flight,
+                'leaders': self.leaders,
+                'coalesced': self.coalesced,
+                'cross_worker': self.cross_worker,
+                'timeouts': self.timeouts,
+                'lock_table': bool(self.lock_table),
+            }
+
+
+class _FileLock:
+    def __init__(self, fd: int, waited: bool, wait_started: float):
+        self.fd = fd
+        self.waited = waited
+        self.wait_started = wait_started
+
+    def release(self):
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self.fd)
+
+
+class LockTable:
+    """Per-key flock files plus the JSON result of the last holder"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._writes = 0
+
+    def acquire(self, key: str, timeout: float) -> Optional[_FileLock]:
+        """Lock the key's file, polling while another worker holds it; None on timeout"""
+        started = time.time()
+        path = self._path(key, 'lock')
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        waited = False
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if self._is_current(fd, path):
+                    return _FileLock(fd, waited, started)
+                # cleanup() unlinked the file we opened: lock the one at the path now
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+                continue
+            except BlockingIOError:
+                waited = True
+            if time.time() - started >= timeout:
+                os.close(fd)
+                return None
+            time.sleep(_POLL_INTERVAL)
+
+    @staticmethod
+    def _is_current(fd: int, path: str) -> bool:
+        try:
+            return os.path.samestat(os.fstat(fd), os.stat(path))
+        except FileNotFoundError:
+            return False
+
+    def write_result(self, key: str, result: Dict[str, Any]):
+        path = self._path(key, 'json')
+        try:
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(result, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Could not share coalesced result: {str(e)}")
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self.cleanup()
+
+    def read_result(self, key: str, newer_than: float) -> Optional[Dict[str, Any]]:
+        """Result written after newer_than (i.e. by the holder we waited for)"""
+        path = self._path(key, 'json')
+        try:
+            if os.path.getmtime(path) < newer_than:
+                return None
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def cleanup(self):
+        """Remove old result files and old lock files that nobody holds"""
+        cutoff = time.time() - FILE_MAX_AGE
+        try:
+            for entry in os.scandir(self.directory):
+                if not entry.is_file() or entry.stat().st_mtime >= cutoff:
+                    continue
+                if entry.name.endswith('.lock'):
+                    self._unlink_lock(entry.path)
+                else:
+                    os.unlink(entry.path)
+        except OSError as e:
+            logger.warning(f"Single-flight lock table cleanup failed: {str(e)}")
+
+    @staticmethod
+    def _unlink_lock(path: str):
+        # A held lock is skipped; holders that opened the file before the
+        # unlink see that it is gone in acquire() and lock the new one
+        try:
+            fd = os.open(path, os.O_RDWR)
+        except FileNotFoundError:
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return
+        try:
+            if LockTable._is_current(fd, path):
+                os.unlink(path)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _path(self, key: str, extension: str) -> str:
+        return os.path.join(self.directory, f"{key}.{extension}")
+
+
+single_flight = SingleFlight()
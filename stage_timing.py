@@ -0,0 +1,109 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from typing import Dict, List, Optional
+
+# Stages of a chat request in pipeline order (also the column order of the admin table);
+# 'db' is the hand-off of the chat record to the query log (only the enqueue with write-behind)
+STAGES = ('route', 'cache', 'coalesce', 'faq', 'kb', 'llm', 'db')
+
+
+class StageTimings:
+    """Wall time spent in each stage of one chat request, in seconds
+
+    A stage entered several times (e.g. FAQ search for the direct answer and
+    again for the prompt context) accumulates. The object itself can be
+    stored as UserQuery.stage_timings: the query log converts it with
+    as_ms() when it inserts the row, after the 'db' stage that wrote it.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        # Stages being timed right now -> their start
+        self.running: Dict[str, float] = {}
+        # Restores the previous value of the context variable in finish()
+        self.token: Optional[Token] = None
+
+    def add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def begin(self, name: str) -> float:
+        started = self.running[name] = time.perf_counter()
+        return started
+
+    def end(self, name: str, started: float):
+        self.running.pop(name, None)
+        self.add(name, time.perf_counter() - started)
+
+    def total(self) -> float:
+        return time.perf_counter() - self.started
+
+    def as_ms(self) -> Dict[str, float]:
+        """Compact record stored on UserQuery.stage_timings (running stages count up to now)"""
+        stages = dict(self.stages)
+        now = time.perf_counter()
+        for name, started in list(self.running.items()):
+            stages[name] = stages.get(name, 0.0) + now - started
+        return {name: round(seconds * 1000, 1) for name, seconds in stages.items()}
+
+    def server_timing(self) -> str:
+        """Server-Timing header value, e.g. "route;dur=0.4, llm;dur=812.0, total;dur=830.2" """
+        entries = [f"{name};dur={ms}" for name, ms in self.as_ms().items()]
+        entries.append(f"total;dur={round(self.total() * 1000, 1)}")
+        return ", ".join(entries)
+
+
+# Timings of the chat request handled in the current context; asyncio.to_thread
+# copies the context, so stages run in the thread pool are recorded as well
+_current: ContextVar[Optional[StageTimings]] = ContextVar('stage_timings', default=None)
+
+
+def start() -> StageTimings:
+    """Begin timing a chat request in the current context; pair with finish()"""
+    timings = StageTimings()
+    timings.token = _current.set(timings)
+    return timings
+
+
+def finish(timings: Optional[StageTimings] = None):
+    """Stop recording into timings (default: the current ones)
+
+    Threads of the WSGI server and of asyncio.to_thread are reused, so the
+    next request in the same context must not find this one's timings.
+    """
+    timings = timings if timings is not None else _current.get()
+    if timings is None or timings.token is None:
+        return
+    try:
+        _current.reset(timings.token)
+        timings.token = None
+    except ValueError:
+        # Started in another context (e.g. a copy made for a thread); that one resets it
+        if _current.get() is timings:
+            _current.set(None)
+
+
+def current() -> Optional[StageTimings]:
+    return _current.get()
+
+
+@contextmanager
+def stage(name: str):
+    """Time the enclosed block as stage `name` of the current request (no-op outside one)"""
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    started = timings.begin(name)
+    try:
+        yield
+    finally:
+        timings.end(name, started)
+
+
+def percentile(values: List[float], percent: float) -> Optional[float]:
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return None
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
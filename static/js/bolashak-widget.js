@@ -1321,6 +1321,38 @@
                             this.unreadCount++;
                             this.updateUnreadBadge();
                         }
+                        return message;
+                    }
+
+                    // Replace the text of an existing bot message (used while a response streams in)
+                    updateMessage(message, text) {
+                        const content = message.querySelector('.message-content');
+                        content.innerHTML = `<strong>QabyldauBot:</strong> ${this.escapeHtml(text)}`;
+                        this.scrollToBottom();
+                    }
+
+                    // Read a Server-Sent Events response body, calling onEvent(name, data) per event
+                    async readEventStream(response, onEvent) {
+                        const reader = response.body.getReader();
+                        const decoder = new TextDecoder();
+                        let buffer = '';
+                        while (true) {
+                            const { value, done } = await reader.read();
+                            if (done) break;
+                            buffer += decoder.decode(value, { stream: true });
+                            let boundary;
+                            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                                const rawEvent = buffer.slice(0, boundary);
+                                buffer = buffer.slice(boundary + 2);
+                                let eventName = 'message';
+                                let data = '';
+                                rawEvent.split('\n').forEach(line => {
+                                    if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                                    else if (line.startsWith('data:')) data += line.slice(5).trim();
+                                });
+                                if (data) onEvent(eventName, JSON.parse(data));
+                            }
+                        }
                     }
 
                     escapeHtml(text) {
@@ -1437,7 +1469,7 @@
                         this.suggestRelevantReplies(text);
                         try {
                             this.showTyping();
-                            const response = await fetch(`${WIDGET_CONFIG.apiEndpoint}/api/chat`, {
+                            const response = await fetch(`${WIDGET_CONFIG.apiEndpoint}/api/chat/stream`, {
                                 method: 'POST',
                                 headers: { 'Content-Type': 'application/json', },
                                 body: JSON.stringify({ message: text, language: this.language })
@@ -1450,9 +1482,30 @@
                                 this.showErrorAlert('Ошибка сети', errText);
                                 return;
                             }
-                            const data = await response.json();
+                            // Render tokens as they arrive; metadata comes with the final "done" event
+                            let botMessage = null;
+                            let botText = '';
+                            let data = {};
+                            await this.readEventStream(response, (eventName, eventData) => {
+                                if (eventName === 'token') {
+                                    botText += eventData.text;
+                                    if (!botMessage) {
+                                        this.hideTyping();
+                                        botMessage = this.addMessage('bot', botText, false);
+                                    } else {
+                                        this.updateMessage(botMessage, botText);
+                                    }
+                                } else if (eventName === 'done') {
+                                    data = eventData;
+                                } else if (eventName === 'error') {
+                                    this.hideTyping();
+                                    botMessage = this.addMessage('bot', eventData.error);
+                                }
+                            });
                             this.hideTyping();
-                            this.addMessage('bot', data.response || 'Извините, произошла ошибка. Попробуйте позже.', false);
+                            if (!botMessage) {
+                                this.addMessage('bot', 'Извините, произошла ошибка. Попробуйте позже.', false);
+                            }
                             if (data.quickReplies && data.quickReplies.length > 0) {
                                 QUICK_REPLIES_DATA.results = data.quickReplies.map(text => ({
                                     text,
@@ -29,6 +29,31 @@ document.addEventListener('DOMContentLoaded', async () => {
     msg.textContent = text;
     messagesContainer.appendChild(msg);
     messagesContainer.scrollTop = messagesContainer.scrollHeight;
+    return msg;
+  }
+
+  // Чтение ответа в формате Server-Sent Events из fetch-потока
+  async function readEventStream(resp, onEvent) {
+    const reader = resp.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      let boundary;
+      while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+        const rawEvent = buffer.slice(0, boundary);
+        buffer = buffer.slice(boundary + 2);
+        let eventName = 'message';
+        let data = '';
+        rawEvent.split('\n').forEach(line => {
+          if (line.startsWith('event:')) eventName = line.slice(6).trim();
+          else if (line.startsWith('data:')) data += line.slice(5).trim();
+        });
+        if (data) onEvent(eventName, JSON.parse(data));
+      }
+    }
   }
 
   async function sendMessage() {
@@ -40,17 +65,27 @@ document.addEventListener('DOMContentLoaded', async () => {
     try {
       const payload = { message };
       if (agentSelect && agentSelect.value) payload.agent_type = agentSelect.value;
-      const resp = await fetch('/api/chat', {
+      const resp = await fetch('/api/chat/stream', {
         method: 'POST',
         headers: {'Content-Type': 'application/json'},
         body: JSON.stringify(payload)
       });
-      const data = await resp.json();
-      if (data.response) {
-        addMessage(data.response, 'bot');
-      } else if (data.error) {
-        addMessage('Ошибка: ' + data.error, 'bot');
+      if (!resp.ok) {
+        const data = await resp.json();
+        addMessage('Ошибка: ' + (data.error || resp.status), 'bot');
+        return;
       }
+      // Ответ дописывается в сообщение по мере поступления токенов
+      let botMessage = null;
+      await readEventStream(resp, (eventName, data) => {
+        if (eventName === 'token') {
+          if (!botMessage) botMessage = addMessage('', 'bot');
+          botMessage.textContent += data.text;
+          messagesContainer.scrollTop = messagesContainer.scrollHeight;
+        } else if (eventName === 'error') {
+          addMessage('Ошибка: ' + data.error, 'bot');
+        }
+      });
     } catch (err) {
       addMessage('Ошибка соединения с сервером', 'bot');
     } finally {
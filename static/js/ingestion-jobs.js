@@ -0,0 +1,46 @@
+// Status badges of knowledge base ingestion jobs; queued and running jobs are polled until they finish
+(function () {
+    const POLL_INTERVAL = 3000;
+
+    function label(job) {
+        switch (job.status) {
+            case 'queued':
+                return job.attempts > 0 ? `Повтор (попытка ${job.attempts + 1} из ${job.max_attempts})` : 'В очереди';
+            case 'running':
+                return job.progress_total ? `Обработка: ${job.progress_current} из ${job.progress_total}` : 'Обработка...';
+            case 'succeeded':
+                return 'Добавлен в базу знаний';
+            default:
+                return 'Ошибка обработки';
+        }
+    }
+
+    function render(badge, job) {
+        const classes = {queued: 'bg-secondary', running: 'bg-primary', succeeded: 'bg-success', failed: 'bg-danger'};
+        badge.className = `badge ingestion-job ${classes[job.status] || 'bg-secondary'}`;
+        badge.textContent = label(job);
+        badge.title = job.last_error || '';
+    }
+
+    function track(badge) {
+        let job = JSON.parse(badge.dataset.job);
+        render(badge, job);
+        if (job.status !== 'queued' && job.status !== 'running') {
+            return;
+        }
+        const timer = setInterval(async () => {
+            try {
+                const response = await fetch(`/admin/api/ingestion/jobs/${job.id}`);
+                job = await response.json();
+                render(badge, job);
+                if (job.status === 'succeeded' || job.status === 'failed') {
+                    clearInterval(timer);
+                }
+            } catch (error) {
+                console.error('Error polling ingestion job:', error);
+            }
+        }, POLL_INTERVAL);
+    }
+
+    document.querySelectorAll('.ingestion-job').forEach(track);
+})();
@@ -0,0 +1,53 @@
+import random
+
+import pytest
+
+from document_processor import iter_chunks
+
+
+def original_chunks(text, chunk_size=1000, overlap=100):
+    """The in-memory chunker iter_chunks must stay identical to (chunk hashes depend on it)"""
+    if not text or len(text) <= chunk_size:
+        return [text] if text else []
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = start + chunk_size
+        if end >= len(text):
+            chunks.append(text[start:])
+            break
+        chunk = text[start:end]
+        break_point = max(chunk.rfind('.'), chunk.rfind('\n'))
+        if break_point > start + chunk_size // 2:
+            chunks.append(text[start:start + break_point + 1])
+            start = start + break_point + 1 - overlap
+        else:
+            chunks.append(chunk)
+            start = end - overlap
+    return [chunk.strip() for chunk in chunks if chunk.strip()]
+
+
+def split(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def test_first_chunk_ends_at_a_sentence():
+    text = 'a' * 700 + '. ' + 'b' * 600
+    chunks = list(iter_chunks([text]))
+    assert chunks[0] == 'a' * 700 + '.'
+    assert chunks[1].startswith('a' * 99 + '.')
+
+
+def test_short_text_is_one_unstripped_chunk():
+    assert list(iter_chunks(['  short text \n'])) == ['  short text \n']
+    assert list(iter_chunks([])) == []
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_boundaries_match_the_original_chunker_for_any_piece_size(seed):
+    rng = random.Random(seed)
+    text = ''.join(rng.choice('abc .\n') for _ in range(rng.randint(0, 5000)))
+    for chunk_size, overlap in ((1000, 100), (200, 50)):
+        expected = original_chunks(text, chunk_size, overlap)
+        for piece_size in (1, 7, 999, 1000, 4096):
+            assert list(iter_chunks(split(text, piece_size), chunk_size, overlap)) == expected
@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+
+import ingestion_jobs
+from ingestion_jobs import claim, enqueue, requeue_stale
+
+
+def add_job(db, **values):
+    from models import IngestionJob
+
+    job = IngestionJob(job_type=values.pop('job_type', 'document'), source_id=values.pop('source_id', 1),
+                       **values)
+    db.session.add(job)
+    db.session.commit()
+    return job.id
+
+
+def get_job(db, job_id):
+    from models import IngestionJob
+
+    db.session.expire_all()
+    return db.session.get(IngestionJob, job_id)
+
+
+def test_claim_takes_the_job_due_first(db):
+    now = datetime.utcnow()
+    later = add_job(db, source_id=1, run_after=now - timedelta(seconds=10))
+    earlier = add_job(db, source_id=2, run_after=now - timedelta(seconds=60))
+
+    assert claim('worker-a') == earlier
+    job = get_job(db, earlier)
+    assert (job.status, job.locked_by, job.attempts) == ('running', 'worker-a', 1)
+    assert claim('worker-b') == later
+
+
+def test_claim_skips_jobs_waiting_for_a_retry_and_taken_jobs(db):
+    add_job(db, run_after=datetime.utcnow() + timedelta(minutes=5))
+    add_job(db, source_id=2, status='running', locked_by='worker-a')
+    add_job(db, source_id=3, status='failed')
+
+    assert claim('worker-b') is None
+
+
+def test_requeue_stale_only_touches_jobs_without_recent_heartbeats(db):
+    now = datetime.utcnow()
+    stale = add_job(db, status='running', locked_by='dead',
+                    heartbeat_at=now - timedelta(seconds=ingestion_jobs.STALE_AFTER + 60))
+    alive = add_job(db, source_id=2, status='running', locked_by='alive', heartbeat_at=now)
+
+    assert requeue_stale() == 1
+    job = get_job(db, stale)
+    assert (job.status, job.locked_by) == ('queued', None)
+    assert job.last_error == 'Worker stopped responding'
+    assert get_job(db, alive).status == 'running'
+    # The requeued job is due again
+    assert claim('worker-b') == stale
+
+
+def test_enqueue_reuses_an_active_job_for_the_same_source(db):
+    first = enqueue('web', 7)
+    assert enqueue('web', 7).id == first.id
+    assert enqueue('web', 8).id != first.id
+
+
+def test_running_embeddings_rebuild_is_not_reused(db):
+    running = enqueue('embeddings', 0)
+    running.status = 'running'
+    db.session.commit()
+
+    assert enqueue('embeddings', 0).id != running.id
@@ -0,0 +1,66 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from pagination import decode_cursor, encode_cursor, paginate
+
+
+@pytest.fixture
+def queries(db):
+    from models import UserQuery
+
+    base = datetime(2026, 1, 1, 12, 0, 0)
+    # Pairs of rows share a timestamp: the id breaks the tie
+    rows = [UserQuery(user_message=f'q{i}', bot_response='a', created_at=base + timedelta(seconds=i // 2))
+            for i in range(25)]
+    db.session.add_all(rows)
+    db.session.commit()
+    return sorted(rows, key=lambda row: (row.created_at, row.id), reverse=True)
+
+
+def page(after=None, before=None):
+    from models import UserQuery
+
+    return paginate(UserQuery.query, UserQuery, per_page=10, after=after, before=before)
+
+
+def ids(rows):
+    return [row.id for row in rows]
+
+
+def test_cursor_round_trip(queries):
+    row = queries[3]
+    assert decode_cursor(encode_cursor(row)) == (row.created_at, row.id)
+
+
+@pytest.mark.parametrize('value', [None, '', 'garbage', '2026-x', '20260101-abc'])
+def test_malformed_cursor_is_ignored(value):
+    assert decode_cursor(value) is None
+
+
+def test_walking_forward_visits_every_row_once_newest_first(queries):
+    first = page()
+    second = page(after=first.next_cursor)
+    third = page(after=second.next_cursor)
+
+    assert first.is_first and not first.has_prev
+    assert ids(first.items + second.items + third.items) == ids(queries)
+    assert not third.has_next
+    assert len(third.items) == 5
+
+
+def test_walking_back_returns_the_same_pages(queries):
+    first = page()
+    second = page(after=first.next_cursor)
+    third = page(after=second.next_cursor)
+
+    back_to_second = page(before=third.prev_cursor)
+    back_to_first = page(before=back_to_second.prev_cursor)
+
+    assert ids(back_to_second.items) == ids(second.items)
+    assert ids(back_to_first.items) == ids(first.items)
+    assert back_to_first.is_first and not back_to_first.has_prev
+
+
+def test_before_the_newest_row_falls_back_to_the_first_page(queries):
+    assert ids(page(before=encode_cursor(queries[0])).items) == ids(queries[:10])
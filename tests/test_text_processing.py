@@ -0,0 +1,30 @@
+from text_processing import question_similarity, question_terms
+
+
+def similarity(first, second, language='ru'):
+    return question_similarity(question_terms(first, language), question_terms(second, language))
+
+
+def test_same_question_in_other_word_order_matches():
+    assert similarity('Какие документы нужны для поступления?',
+                      'Для поступления какие документы нужны?') == 1.0
+
+
+def test_different_question_words_never_match():
+    assert similarity('Где проходит вступительный экзамен?', 'Когда проходит вступительный экзамен?') == 0.0
+
+
+def test_negation_never_matches_the_affirmative():
+    assert similarity('Нужны ли справки для поступления?', 'Не нужны ли справки для поступления?') == 0.0
+
+
+def test_word_forms_share_stems():
+    assert similarity('Где находится общежитие?', 'Где находится общежития?') == 1.0
+
+
+def test_kazakh_question_words_are_kept():
+    assert similarity('Жатақхана қайда?', 'Жатақхана қашан?', 'kz') == 0.0
+
+
+def test_empty_question_has_no_similarity():
+    assert question_similarity((), question_terms('Где общежитие?')) == 0.0
@@ -0,0 +1,155 @@
+import re
+from functools import lru_cache
+from typing import Iterable, List, Tuple
+
+LANGUAGES = ('ru', 'kz')
+
+# Anything that is not a letter or digit separates words
+_SEPARATOR_RE = re.compile(r'[\W_]+', re.UNICODE)
+_CYRILLIC_RE = re.compile(r'[а-яәғқңөұүһі]')
+# Letters that only occur in Kazakh Cyrillic
+KAZAKH_LETTERS = frozenset('әғқңөұүһі')
+
+RU_STOPWORDS = frozenset("""
+    а без более бы был была были было быть в вам вас весь во вот все всего всех вы где да даже
+    для до его ее ей если есть еще же за здесь и из или им их к как какая какие какой когда
+    кто ли либо между меня мне много может можно мой мы на над надо нам нас не него нее нет
+    ни них но ну о об он она они оно от очень по под при про с со так также там то тоже
+    только том тот у уже чем что чтобы эта эти это этот я
+""".split())
+
+KZ_STOPWORDS = frozenset("""
+    ал бар бен бір бірақ біз бұл да де және еді екен ең жоқ қай қайда қалай қандай қашан
+    қанша ма ме мен менің не неге немесе ол олар осы пен сен сіз сол та те туралы үшін
+    ғана ғой
+""".split())
+
+# Stopwords that still matter when two questions are compared as a whole: the question
+# word and negation tell "когда подать" from "где подать" and "нужны" from "не нужны"
+RU_QUESTION_WORDS = frozenset("""
+    где когда как какая какие какой кто что чем зачем почему сколько куда откуда можно надо
+    не нет ни без ли
+""".split())
+
+KZ_QUESTION_WORDS = frozenset("""
+    қай қайда қалай қандай қашан қанша не неге жоқ емес ма ме ғана
+""".split())
+
+_QUESTION_WORDS = RU_QUESTION_WORDS | KZ_QUESTION_WORDS
+
+# Endings are tried longest first; a stem must keep at least MIN_STEM letters
+RU_ENDINGS = tuple(sorted(set("""
+    ениями ениях ением ение ения ению ений ание ания анию аний ость ости остью остей
+    иями ями ами ией ием иях ях ах ия ию ии ие ий ого его ому ему ыми ими ая яя ое ее ые
+    ый ой ей ую юю ых их ым им ом ем ов ев ам ям ить ать ять еть уть ешь ишь ете ите ет
+    ит ут ют ят ла ли ло ть а я о е ы и у ю ь й
+""".split()), key=len, reverse=True))
+RU_REFLEXIVE = ('ся', 'сь')
+
+KZ_SUFFIXES = tuple(sorted(set("""
+    лар лер дар дер тар тер ымыз іміз ыңыз іңіз ым ім ың ің сы сі ның нің дың дің тың тің
+    ға ге қа ке на не ны ні ды ді ты ті нда нде да де та те дан ден тан тен нан нен мен
+    бен пен ша ше ы і а е н
+""".split()), key=len, reverse=True))
+# Kazakh words can carry several suffixes (plural + possessive + case)
+KZ_MAX_SUFFIXES = 3
+
+MIN_STEM = {'ru': 4, 'kz': 4}
+
+
+@lru_cache(maxsize=4096)
+def normalize_text(text: str) -> str:
+    """Lowercase, fold ё, strip punctuation and collapse whitespace"""
+    if not text:
+        return ''
+    text = text.lower().replace('ё', 'е')
+    words = _SEPARATOR_RE.split(text)
+    # Latin "i" is often typed instead of Kazakh "і" inside Cyrillic words
+    words = [word.replace('i', 'і') if 'i' in word and _CYRILLIC_RE.search(word) else word
+             for word in words]
+    return ' '.join(word for word in words if word)
+
+
+def detect_language(text: str) -> str:
+    """Guess whether a piece of text is Kazakh or Russian"""
+    if any(char in KAZAKH_LETTERS for char in text.lower()):
+        return 'kz'
+    return 'ru'
+
+
+def tokenize(text: str, language: str = 'ru') -> List[str]:
+    """Normalized words without stopwords and single characters"""
+    stopwords = KZ_STOPWORDS if language == 'kz' else RU_STOPWORDS
+    return [word for word in normalize_text(text).split()
+            if len(word) > 1 and word not in stopwords]
+
+
+@lru_cache(maxsize=65536)
+def stem(word: str, language: str = 'ru') -> str:
+    """Light suffix-stripping stemmer for Russian and Kazakh"""
+    min_stem = MIN_STEM.get(language, 4)
+    if language == 'kz':
+        for _ in range(KZ_MAX_SUFFIXES):
+            for suffix in KZ_SUFFIXES:
+                if word.endswith(suffix) and len(word) - len(suffix) >= min_stem:
+                    word = word[:-len(suffix)]
+                    break
+            else:
+                break
+        return word
+
+    for suffix in RU_REFLEXIVE:
+        if word.endswith(suffix) and len(word) - len(suffix) >= min_stem:
+            word = word[:-len(suffix)]
+            break
+    for ending in RU_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= min_stem:
+            return word[:-len(ending)]
+    return word
+
+
+def analyze(text: str, language: str = 'ru') -> List[str]:
+    """Full pipeline: normalize, drop stopwords, stem"""
+    return [stem(word, language) for word in tokenize(text, language)]
+
+
+@lru_cache(maxsize=4096)
+def query_terms(text: str, language: str = 'ru') -> Tuple[str, ...]:
+    """Cached stems of a short user message"""
+    return tuple(analyze(text, language))
+
+
+def chunk_terms(text: str) -> Tuple[str, str]:
+    """Language and space-separated stems of a chunk, stored alongside it at ingest time"""
+    language = detect_language(text)
+    return language, ' '.join(analyze(text, language))
+
+
+@lru_cache(maxsize=4096)
+def question_terms(text: str, language: str = 'ru') -> Tuple[str, ...]:
+    """Stems of a question that keep its question words and negation
+
+    Used where two questions must mean the same thing (direct FAQ answers,
+    the response cache), not just share a topic as in retrieval.
+    """
+    if language == 'kz':
+        keep, stopwords = KZ_QUESTION_WORDS, KZ_STOPWORDS
+    else:
+        keep, stopwords = RU_QUESTION_WORDS, RU_STOPWORDS
+    terms = []
+    for word in normalize_text(text).split():
+        if word in keep:
+            terms.append(word)
+        elif len(word) > 1 and word not in stopwords:
+            terms.append(stem(word, language))
+    return tuple(terms)
+
+
+def question_similarity(terms: Iterable[str], other_terms: Iterable[str]) -> float:
+    """Jaccard similarity of two questions' terms, 0 unless their question words and negation agree"""
+    terms, other_terms = set(terms), set(other_terms)
+    if not terms or not other_terms:
+        return 0.0
+    if terms & _QUESTION_WORDS != other_terms & _QUESTION_WORDS:
+        return 0.0
+    return len(terms & other_terms) / len(terms | other_terms)
@@ -1,47 +1,29 @@
+import asyncio
 import logging
+from flask import current_app
 from models import FAQ, KnowledgeBase
-from sqlalchemy import or_
-from typing import List
+from typing import List, Optional, Tuple
+import search_index
+from metrics import RETRIEVAL_SEARCHES
+from stage_timing import stage
+from text_processing import question_similarity, question_terms
 
 logger = logging.getLogger(__name__)
 
 def get_relevant_context(user_message: str, language: str = "ru", limit: int = 3) -> str:
     """Get relevant context from FAQ database and knowledge base based on user message"""
     try:
-        user_message_lower = user_message.lower()
-        context_parts = []
-        
-        # First, search FAQ database
-        question_field = FAQ.question_ru if language == 'ru' else FAQ.question_kz
-        answer_field = FAQ.answer_ru if language == 'ru' else FAQ.answer_kz
-        
-        # Search for relevant FAQs using simple text matching
-        keywords = [word for word in user_message_lower.split() if len(word) > 2]
-        
-        if keywords:
-            # Build search conditions
-            search_conditions = []
-            for word in keywords[:3]:  # Limit to first 3 keywords
-                search_conditions.append(question_field.ilike(f'%{word}%'))
-            
-            relevant_faqs = FAQ.query.filter(
-                FAQ.is_active == True,
-                or_(*search_conditions)
-            ).limit(limit).all()
-            
-            # Format FAQ context
-            for faq in relevant_faqs:
-                if language == 'ru':
-                    context_parts.append(f"FAQ - В: {faq.question_ru}\nО: {faq.answer_ru}")
-                else:
-                    context_parts.append(f"FAQ - С: {faq.question_kz}\nЖ: {faq.answer_kz}")
+        from context_builder import assemble_context
         
-        # Then, search knowledge base
-        kb_context = get_knowledge_base_context(user_message, language, limit)
-        if kb_context:
-            context_parts.extend(kb_context)
+        with stage('faq'):
+            relevant_faqs = search_faqs(user_message, language, limit)
+        # Extra candidates: neighbouring chunks get merged and duplicates dropped,
+        # the token budget decides how much of them reaches the prompt
+        with stage('kb'):
+            relevant_entries = search_knowledge_base(user_message, language, limit * 2)
         
-        return "\n\n".join(context_parts) if context_parts else ""
+        token_budget = current_app.config.get("CONTEXT_TOKEN_BUDGET", 1000)
+        return assemble_context(relevant_faqs, relevant_entries, language, token_budget)
         
     except Exception as e:
         logger.error(f"Error getting relevant context: {str(e)}")
@@ -50,21 +32,7 @@ def get_relevant_context(user_message: str, language: str = "ru", limit: int = 3
 def get_knowledge_base_context(user_message: str, language: str = "ru", limit: int = 3) -> List[str]:
     """Get relevant context from knowledge base"""
     try:
-        user_message_lower = user_message.lower()
-        keywords = [word for word in user_message_lower.split() if len(word) > 2]
-        
-        if not keywords:
-            return []
-        
-        # Search knowledge base for relevant chunks
-        search_conditions = []
-        for keyword in keywords[:3]:  # Limit to first 3 keywords
-            search_conditions.append(KnowledgeBase.content_chunk.ilike(f'%{keyword}%'))
-        
-        relevant_entries = KnowledgeBase.query.filter(
-            KnowledgeBase.is_active == True,
-            or_(*search_conditions)
-        ).limit(limit).all()
+        relevant_entries = search_knowledge_base(user_message, language, limit)
         
         context_parts = []
         for entry in relevant_entries:
@@ -77,6 +45,88 @@ def get_knowledge_base_context(user_message: str, language: str = "ru", limit: i
         logger.error(f"Error getting knowledge base context: {str(e)}")
         return []
 
+def get_direct_faq_answer(user_message: str, language: str = "ru") -> Optional[Tuple[FAQ, float]]:
+    """Return (faq, score) when the message is nearly the same question as a curated FAQ"""
+    threshold = current_app.config.get("FAQ_DIRECT_ANSWER_THRESHOLD", 0.8)
+    if threshold <= 0:
+        return None
+    
+    # Question words and negation are kept: "где"/"когда" or "нужны"/"не нужны" are different questions
+    message_terms = question_terms(user_message, language)
+    if not message_terms:
+        return None
+    
+    best = None
+    for faq in search_faqs(user_message, language, limit=3):
+        question = faq.question_kz if language == 'kz' else faq.question_ru
+        # Jaccard similarity of stems: 1.0 means the same question up to word forms/order
+        score = question_similarity(message_terms, question_terms(question, language))
+        if best is None or score > best[1]:
+            best = (faq, score)
+    
+    if best and best[1] >= threshold:
+        return best
+    return None
+
+def search_faqs(query: str, language: str = "ru", limit: int = 3) -> List[FAQ]:
+    """Ranked active FAQs using the configured retrieval backend"""
+    backend = current_app.config.get("RETRIEVAL_BACKEND")
+    if backend == "fts":
+        import fulltext_search
+        return _count_search('faq', backend, fulltext_search.search_faqs(query, language, limit))
+    
+    backend, index = _ranking_index(backend)
+    ranked = index.search_faqs(query, language, limit)
+    return _count_search('faq', backend, _load_ranked(FAQ, [faq_id for faq_id, _ in ranked]))
+
+def search_knowledge_base(query: str, language: str = "ru", limit: int = 3) -> List[KnowledgeBase]:
+    """Ranked active knowledge base chunks using the configured retrieval backend"""
+    backend = current_app.config.get("RETRIEVAL_BACKEND")
+    if backend == "fts":
+        import fulltext_search
+        return _count_search('kb', backend, fulltext_search.search_knowledge_base(query, language, limit))
+    
+    backend, index = _ranking_index(backend)
+    ranked = index.search_knowledge_base(query, language, limit)
+    return _count_search('kb', backend, _load_ranked(KnowledgeBase, [kb_id for kb_id, _ in ranked]))
+
+def _count_search(source: str, backend: str, results: list) -> list:
+    """Count a search as hit or miss for /metrics and pass its results through"""
+    RETRIEVAL_SEARCHES.inc(source=source, backend=backend, result='hit' if results else 'miss')
+    return results
+
+def _ranking_index(backend: str):
+    """(backend actually used, in-memory index) for the bm25 and vector backends
+
+    The vector backend (imported lazily, needs NumPy) answers with BM25 until
+    its embedding store has been written.
+    """
+    if backend == "vector":
+        import vector_search
+        index = vector_search.get_index()
+        if index is not None:
+            return backend, index
+        backend = "bm25"
+    return backend, search_index.get_index()
+
+def _load_ranked(model, ids: List[int]) -> list:
+    """Fetch active rows by primary key, preserving the ranking order"""
+    if not ids:
+        return []
+    rows = model.query.filter(model.id.in_(ids), model.is_active == True).all()
+    rows_by_id = {row.id: row for row in rows}
+    return [rows_by_id[row_id] for row_id in ids if row_id in rows_by_id]
+
+async def run_in_thread(func, *args):
+    """Run blocking code (database, retrieval) in the default executor inside the app context"""
+    from app import app
+    
+    def call():
+        with app.app_context():
+            return func(*args)
+    
+    return await asyncio.to_thread(call)
+
 def format_response_time(seconds: float) -> str:
     """Format response time for display"""
     if seconds < 1:
@@ -0,0 +1,138 @@
+import logging
+import os
+import zlib
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from text_processing import LANGUAGES, normalize_text
+
+logger = logging.getLogger(__name__)
+
+# Size of the hashed feature space (one float32 per dimension per row)
+DIMENSIONS = int(os.environ.get("VECTOR_DIMENSIONS", "512"))
+# Cosine similarity below which a hit is not worth putting into the prompt
+MIN_SCORE = float(os.environ.get("VECTOR_MIN_SCORE", "0.2"))
+
+NGRAM_SIZES = (3, 4)
+
+
+@lru_cache(maxsize=2 ** 18)
+def _feature_slot(feature: str) -> Tuple[int, float]:
+    """Stable (dimension, sign) for a feature; crc32 is identical in every process"""
+    hashed = zlib.crc32(feature.encode('utf-8'))
+    return hashed % DIMENSIONS, (1.0 if hashed & 0x80000000 else -1.0)
+
+
+def _features(text: str) -> List[str]:
+    """Whole words plus character n-grams of each word with boundary markers"""
+    features = []
+    for token in normalize_text(text).split():
+        features.append(token)
+        padded = f"<{token}>"
+        for size in NGRAM_SIZES:
+            features.extend(padded[i:i + size] for i in range(len(padded) - size + 1))
+    return features
+
+
+def embed_text(text: str) -> np.ndarray:
+    """Embed text as an L2-normalised hashed character n-gram vector"""
+    vector = np.zeros(DIMENSIONS, dtype=np.float32)
+    features = _features(text)
+    if not features:
+        return vector
+
+    slots = [_feature_slot(feature) for feature in features]
+    indices = np.fromiter((slot for slot, _ in slots), dtype=np.int64, count=len(slots))
+    signs = np.fromiter((sign for _, sign in slots), dtype=np.float32, count=len(slots))
+    vector += np.bincount(indices, weights=signs, minlength=DIMENSIONS).astype(np.float32)
+
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+
+class VectorIndex:
+    """Row ids with a contiguous float32 embedding matrix"""
+
+    def __init__(self, ids: np.ndarray, matrix: np.ndarray):
+        self.ids = ids
+        self.matrix = matrix
+
+    @classmethod
+    def from_texts(cls, rows: List[Tuple[int, str]]) -> 'VectorIndex':
+        ids = np.fromiter((row_id for row_id, _ in rows), dtype=np.int64, count=len(rows))
+        matrix = np.empty((len(rows), DIMENSIONS), dtype=np.float32)
+        for position, (_, text) in enumerate(rows):
+            matrix[position] = embed_text(text)
+        return cls(ids, matrix)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def search(self, query_vector: np.ndarray, limit: int = 3) -> List[Tuple[int, float]]:
+        """Return [(id, cosine score), ...] using one mat-vec product and argpartition"""
+        if not len(self.ids) or limit <= 0:
+            return []
+
+        scores = self.matrix @ query_vector
+        if limit < len(scores):
+            top = np.argpartition(scores, -limit)[-limit:]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(scores[top])[::-1]]
+
+        return [(int(self.ids[i]), float(scores[i])) for i in top if scores[i] >= MIN_SCORE]
+
+
+class EmbeddingIndex:
+    """Vector indexes over active FAQs (per language) and knowledge base chunks"""
+
+    def __init__(self, faq: Dict[str, VectorIndex], kb: VectorIndex):
+        self.faq = faq
+        self.kb = kb
+
+    @classmethod
+    def build(cls) -> 'EmbeddingIndex':
+        """Embed the current database contents"""
+        from app import db
+        from models import FAQ, KnowledgeBase
+
+        faq_rows = db.session.query(
+            FAQ.id, FAQ.question_ru, FAQ.answer_ru, FAQ.question_kz, FAQ.answer_kz
+        ).filter(FAQ.is_active == True).all()
+        faq = {
+            'ru': VectorIndex.from_texts([(row[0], f"{row[1]} {row[1]} {row[2]}") for row in faq_rows]),
+            'kz': VectorIndex.from_texts([(row[0], f"{row[3]} {row[3]} {row[4]}") for row in faq_rows]),
+        }
+
+        kb_rows = db.session.query(
+            KnowledgeBase.id, KnowledgeBase.content_chunk
+        ).filter(KnowledgeBase.is_active == True).all()
+        kb = VectorIndex.from_texts(kb_rows)
+
+        logger.info(f"Embedding index built: {len(faq_rows)} FAQs, {len(kb)} knowledge base chunks")
+        return cls(faq, kb)
+
+    def search_faqs(self, query: str, language: str = 'ru', limit: int = 3) -> List[Tuple[int, float]]:
+        language = language if language in LANGUAGES else 'ru'
+        return self.faq[language].search(embed_text(query), limit)
+
+    def search_knowledge_base(self, query: str, language: str = 'ru', limit: int = 3) -> List[Tuple[int, float]]:
+        return self.kb.search(embed_text(query), limit)
+
+
+def get_index() -> Optional[EmbeddingIndex]:
+    """Return the shared memory-mapped index, or None until the store exists
+
+    Embedding happens only where the store is written (the ingestion worker,
+    or a background thread when it is missing), never inside a chat request;
+    callers serve lexical results meanwhile.
+    """
+    import embedding_store
+    shared = embedding_store.get_index()
+    if shared is None:
+        embedding_store.build_in_background()
+    return shared
@@ -1,7 +1,11 @@
 # Импорт необходимых модулей
 import time
+import json
+from typing import Union
 import logging
-from flask import Blueprint, render_template, request, jsonify, session
+import metrics
+import stage_timing
+from flask import Blueprint, Response, g, render_template, request, jsonify, session, stream_with_context
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
@@ -21,6 +25,12 @@ def initialize_agent_router():
     return agent_router
 
 
+@main_bp.teardown_request
+def _finish_stage_timings(exc=None):
+    """Stage timings are per request: the worker thread serves the next request in the same context"""
+    stage_timing.finish()
+
+
 @main_bp.route('/')
 def index():
     """Main page with chat widget"""
@@ -42,8 +52,6 @@ def widget_demo():
 @main_bp.route('/api/chat', methods=['POST'])
 def chat():
     try:
-        from models import UserQuery
-        from app import db
         from flask import current_app
 
         data = request.get_json()
@@ -57,44 +65,31 @@ def chat():
         if not user_message:
             return jsonify({'error': 'Пустое сообщение'}), 400
 
+        # Слишком частые запросы одного клиента отклоняются сразу
+        limited = _rate_limited_response(language)
+        if limited is not None:
+            return limited
+
         start_time = time.time()
+        # Метки агента и языка для метрик запроса; заполняются во вложенном контексте,
+        # поэтому словарь берется из g запроса заранее
+        metric_labels = metrics.request_labels()
+        # Время по этапам (маршрутизация, кэш, FAQ, база знаний, LLM, запись в БД)
+        timings = stage_timing.start()
 
         with current_app.app_context():
             router = initialize_agent_router()
-            if agent_type:
-                # Поиск агента с нужным типом
-                for agent in router.agents:
-                    if getattr(agent, "agent_type", None) and (agent.agent_type.value == agent_type):
-                        result = agent.process_message(user_message, language)
-                        result['agent_type'] = agent.agent_type.value
-                        result['agent_name'] = agent.name
-                        result['confidence'] = 1.0
-                        break
-                else:
-                    # Если не найден — fallback на авто-выбор
-                    result = router.route_message(user_message, language)
-            else:
-                # Автоматический выбор агента
-                result = router.route_message(user_message, language)
+            # Явно выбранный агент (если не найден — авто-выбор)
+            result = router.route_message(user_message, language, agent_type)
 
             response_time = time.time() - start_time
+            metric_labels.update(agent_type=result.get('agent_type'), language=language)
+            metrics.observe_chat(result)
 
-            user_query = UserQuery(
-                user_message=user_message,
-                bot_response=result['response'],
-                language=language,
-                response_time=response_time,
-                agent_type=result.get('agent_type'),
-                agent_name=result.get('agent_name'),
-                agent_confidence=result.get('confidence', 0.0),
-                context_used=result.get('context_used', False),
-                session_id=session.get('session_id', ''),
-                ip_address=request.remote_addr,
-                user_agent=request.headers.get('User-Agent', '')
-            )
-
-            db.session.add(user_query)
-            db.session.commit()
+            # Объект этапов, а не словарь: журнал переводит его в мс при вставке, с учетом этапа db
+            with stage_timing.stage('db'):
+                save_user_query(user_message, language, result, response_time,
+                                stage_timings=timings)
 
             logger.info(
                 f"Chat response generated in {response_time:.2f}s "
@@ -103,19 +98,178 @@ def chat():
                 f"for language: {language}"
             )
 
-            return jsonify({
+            response = jsonify({
                 'response': result['response'],
                 'response_time': response_time,
                 'agent_name': result.get('agent_name'),
                 'agent_type': result.get('agent_type'),
-                'confidence': result.get('confidence', 0.0)
+                'confidence': result.get('confidence', 0.0),
+                'response_source': result.get('response_source', 'llm')
             })
+            response.headers['Server-Timing'] = timings.server_timing()
+            return response
 
     except Exception as e:
         logger.error(f"Error in chat endpoint: {str(e)}")
         error_message = "Извините, произошла ошибка. Попробуйте еще раз." if language == 'ru' else "Кешіріңіз, қате орын алды. Қайталап көріңіз."
         return jsonify({'error': error_message}), 500
         
+@main_bp.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """Chat response streamed as Server-Sent Events
+
+    Events: "token" ({"text": ...}) for every piece of the answer, then "done" with
+    the same metadata as /api/chat, or "error".
+    """
+    data = request.get_json(silent=True)
+    if not data or 'message' not in data:
+        return jsonify({'error': 'Сообщение не найдено'}), 400
+
+    user_message = data['message'].strip()
+    language = data.get('language', 'ru')
+    agent_type = data.get('agent_type')
+
+    if not user_message:
+        return jsonify({'error': 'Пустое сообщение'}), 400
+
+    limited = _rate_limited_response(language)
+    if limited is not None:
+        return limited
+
+    # Длительность учитывается по окончании потока, а не при отправке заголовков
+    g.metrics_deferred = True
+    started = time.perf_counter()
+
+    def generate():
+        result = None
+        start_time = time.time()
+        first_token_time = None
+        # Заголовки уже отправлены: этапы только сохраняются вместе с запросом
+        timings = stage_timing.start()
+        try:
+            router = initialize_agent_router()
+            stream = router.stream_message(user_message, language, agent_type)
+            for piece in stream:
+                if first_token_time is None:
+                    first_token_time = time.time() - start_time
+                yield _sse_event('token', {'text': piece})
+
+            result = stream.result
+            response_time = time.time() - start_time
+            # Запрос сохраняется только после того, как ответ отдан целиком
+            save_user_query(user_message, language, result, response_time, first_token_time,
+                            stage_timings=timings.as_ms())
+
+            logger.info(
+                f"Chat response streamed in {response_time:.2f}s "
+                f"(first token: {first_token_time or 0:.2f}s) "
+                f"by {result.get('agent_name', 'Unknown')} agent for language: {language}"
+            )
+
+            yield _sse_event('done', {
+                'response_time': response_time,
+                'first_token_time': first_token_time,
+                'agent_name': result.get('agent_name'),
+                'agent_type': result.get('agent_type'),
+                'confidence': result.get('confidence', 0.0),
+                'response_source': result.get('response_source', 'llm')
+            })
+
+        except Exception as e:
+            logger.error(f"Error in chat stream endpoint: {str(e)}")
+            error_message = "Извините, произошла ошибка. Попробуйте еще раз." if language == 'ru' else "Кешіріңіз, қате орын алды. Қайталап көріңіз."
+            yield _sse_event('error', {'error': error_message})
+        finally:
+            stage_timing.finish(timings)
+            if result is not None:
+                metrics.observe_chat(result)
+            metrics.observe_request('/api/chat/stream', 200, time.perf_counter() - started,
+                                    result.get('agent_type') if result else None, language)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            # Отключаем буферизацию ответа в nginx, иначе токены придут одним блоком
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+
+def _rate_limited_response(language: str):
+    """429 response when the client ran out of its request tokens, else None"""
+    from admission import check_rate_limit, rate_limit_message
+    
+    # remote_addr is the client's address: ProxyFix reads X-Forwarded-For (app.TRUSTED_PROXIES)
+    retry_after = check_rate_limit(request.remote_addr)
+    if retry_after is None:
+        return None
+    response = jsonify({'error': rate_limit_message(language)})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(int(retry_after + 0.999), 1))
+    return response
+
+
+def _sse_event(event: str, data: dict) -> str:
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def save_user_query(user_message: str, language: str, result: dict,
+                    response_time: float, first_token_time: float = None,
+                    stage_timings: Union[dict, stage_timing.StageTimings] = None):
+    """Store a processed chat message of the current request"""
+    record_user_query(
+        user_message, language, result, response_time, first_token_time,
+        stage_timings=stage_timings,
+        session_id=session.get('session_id', ''),
+        ip_address=request.remote_addr,
+        user_agent=request.headers.get('User-Agent', '')
+    )
+
+
+def record_user_query(user_message: str, language: str, result: dict, response_time: float,
+                      first_token_time: float = None, session_id: str = '',
+                      ip_address: str = None, user_agent: str = '',
+                      stage_timings: Union[dict, stage_timing.StageTimings] = None):
+    """Store a processed chat message for analytics and the response cache history
+
+    The row is handed to the write-behind query log, which inserts it with the
+    next batch; the chat response does not wait for the database. A
+    StageTimings object is converted to milliseconds at the insert.
+    """
+    from datetime import datetime
+    import query_log
+    from response_cache import question_hash
+
+    query_log.write({
+        'user_message': user_message,
+        'bot_response': result['response'],
+        'language': language,
+        'response_time': response_time,
+        'first_token_time': first_token_time,
+        'stage_timings': stage_timings,
+        'agent_type': result.get('agent_type'),
+        'agent_name': result.get('agent_name'),
+        'agent_confidence': result.get('confidence', 0.0),
+        'context_used': result.get('context_used', False),
+        'response_source': result.get('response_source', 'llm'),
+        'question_hash': question_hash(user_message, language, result.get('agent_type') or ''),
+        'session_id': session_id,
+        'ip_address': ip_address,
+        'user_agent': user_agent,
+        # Time of the answer, not of the batch insert
+        'created_at': datetime.utcnow()
+    })
+
+
+@main_bp.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics of all workers in the text exposition format"""
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+
 @main_bp.route('/api/health')
 def health_check():
     """Health check endpoint"""